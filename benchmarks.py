@@ -23,15 +23,21 @@ Requirements:
 
 Usage:
     $ python benchmarks.py --weights yolov5s.pt --img 640
+    $ python benchmarks.py --weights yolov5s.pt --latency --batch-sizes 1 4 --threads 1 4  # latency distribution
 """
 
 import argparse
+import contextlib
+import json
 import platform
 import sys
 import time
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import psutil
+import torch
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]  # YOLOv5 root directory
@@ -40,14 +46,155 @@ if str(ROOT) not in sys.path:
 # ROOT = ROOT.relative_to(Path.cwd())  # relative
 
 import export
+from models.common import DetectMultiBackend
 from models.experimental import attempt_load
 from models.yolo import SegmentationModel
-from segment.val import run as val_seg
 from utils import notebook_init
-from utils.general import LOGGER, check_yaml, file_size, print_args
+from utils.general import LOGGER, check_yaml, cv2, file_size, non_max_suppression, print_args, split_end2end
+from utils.preprocess import LetterboxPreprocessor
+from utils.segment.general import process_mask
 from utils.torch_utils import select_device
 from val import run as val_det
 
+val_seg = None
+with contextlib.suppress(ImportError):  # segmentation val.py is not part of every checkout
+    from segment.val import run as val_seg
+
+
+def latency(
+        weights=ROOT / 'yolov5s.pt',  # model path
+        imgsz=640,  # inference size (pixels)
+        batch_size=1,  # batch size
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        device=torch.device('cpu'),  # torch device
+        half=False,  # use FP16 half-precision inference
+        threads=None,  # PyTorch and ONNX Runtime intra-op threads, None for default
+        iters=200,  # timed calls
+        warmup=20,  # untimed calls first
+        conf_thres=0.25,  # NMS confidence threshold
+        iou_thres=0.45,  # NMS IoU threshold
+):
+    # Time the full inference pipeline (letterbox, forward, NMS, masks) per call, return latency percentiles (ms),
+    # throughput (images/s), process CPU utilization (%) and RSS (MB)
+    n0 = torch.get_num_threads()
+    if threads:
+        torch.set_num_threads(threads)
+    try:
+        model = DetectMultiBackend(weights,
+                                   device=device,
+                                   data=data,
+                                   fp16=half,
+                                   ort_options={'intra_op_num_threads': threads} if threads else None)
+        preprocess = LetterboxPreprocessor(imgsz, model.stride, auto=False, device=model.device, half=model.fp16,
+                                           buffers=model.staging)
+        im0 = cv2.imread(str(ROOT / 'data/images/bus.jpg'))  # BGR
+        im0 = [np.random.randint(0, 255, (720, 1280, 3), dtype=np.uint8) if im0 is None else im0] * batch_size
+        seg = False
+
+        def call():
+            nonlocal seg
+            im = preprocess(im0)
+            y = model(im)
+            pred = y[0] if isinstance(y, (list, tuple)) else y
+            if model.end2end:  # NMS and masks in model
+                seg = isinstance(y, (list, tuple)) and len(y) > 1
+                split_end2end(pred, len(im), conf_thres, masks=y[1] if seg else None)
+            else:
+                proto = y[1] if isinstance(y, (list, tuple)) and len(y) > 1 else None  # segmentation (bs,nm,h,w)
+                seg = isinstance(proto, torch.Tensor) and proto.ndim == 4
+                nm = proto.shape[1] if seg else 0  # number of masks, not from names which may be defaults
+                pred = non_max_suppression(pred, conf_thres, iou_thres, max_det=1000, nm=nm)
+                for i, det in enumerate(pred if seg else []):
+                    if len(det):
+                        process_mask(y[1][i], det[:, 6:], det[:, :4], im.shape[2:], upsample=True)
+            if model.device.type == 'cuda':
+                torch.cuda.synchronize()
+
+        for _ in range(warmup):
+            call()
+        proc, t = psutil.Process(), np.zeros(iters)
+        cpu, t0 = proc.cpu_times(), time.perf_counter()
+        for i in range(iters):
+            ti = time.perf_counter()
+            call()
+            t[i] = time.perf_counter() - ti
+        dt, cpu1 = time.perf_counter() - t0, proc.cpu_times()
+        t *= 1E3  # ms
+        return {
+            'task': 'segment' if seg else 'detect',
+            'min_ms': t.min(),
+            'p50_ms': np.percentile(t, 50),
+            'p90_ms': np.percentile(t, 90),
+            'p99_ms': np.percentile(t, 99),
+            'max_ms': t.max(),
+            'mean_ms': t.mean(),
+            'throughput': batch_size * iters / dt,  # images/s
+            'cpu_percent': (cpu1.user + cpu1.system - cpu.user - cpu.system) / dt * 100,  # 100 per busy core
+            'rss_mb': proc.memory_info().rss / 1E6}
+    finally:
+        torch.set_num_threads(n0)
+
+
+def run_latency(
+        weights=ROOT / 'yolov5s.pt',  # weights path
+        imgsz=640,  # inference size (pixels)
+        batch_sizes=(1, ),  # batch sizes
+        threads=(None, ),  # intra-op thread counts, None for default
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        pt_only=False,  # test PyTorch only
+        hard_fail=False,  # throw error on benchmark failure
+        iters=200,  # timed calls per configuration
+        warmup=20,  # untimed calls per configuration
+        output='benchmarks_latency',  # save results to *.json and *.csv
+):
+    # Latency distribution per export format, batch size and thread count
+    y, t = [], time.time()
+    device = select_device(device)
+    for i, (name, f, suffix, cpu, gpu) in export.export_formats().iterrows():  # index, (name, file, suffix, CPU, GPU)
+        for b in batch_sizes:
+            try:
+                assert i not in (9, 10), 'inference not supported'  # Edge TPU and TF.js are unsupported
+                assert i != 5 or platform.system() == 'Darwin', 'inference only supported on macOS>=10.13'  # CoreML
+                assert cpu if 'cpu' in device.type else gpu, f'inference not supported on {device.type.upper()}'
+                w = weights if f == '-' else \
+                    export.run(weights=weights, imgsz=[imgsz], include=[f], batch_size=b, device=device,
+                               half=half)[-1]  # static batch exports
+                assert suffix in str(w), 'export failed'
+                for n in threads:
+                    r = latency(w, imgsz, b, data, device, half, n, iters, warmup)
+                    y.append({'format': name, 'batch_size': b, 'threads': n or torch.get_num_threads(), **r})
+                    LOGGER.info(f"{name} batch {b} threads {y[-1]['threads']}: p50 {r['p50_ms']:.2f}ms, "
+                                f"p99 {r['p99_ms']:.2f}ms, {r['throughput']:.1f} img/s")
+            except Exception as e:
+                if hard_fail:
+                    assert type(e) is AssertionError, f'Benchmark --hard-fail for {name}: {e}'
+                LOGGER.warning(f'WARNING ⚠️ Benchmark failure for {name} batch {b}: {e}')
+        if pt_only and i == 0:
+            break  # break after PyTorch
+
+    # Save results
+    meta = {
+        'weights': str(weights),
+        'imgsz': imgsz,
+        'device': str(device),
+        'half': half,
+        'iters': iters,
+        'warmup': warmup,
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    py = pd.DataFrame(y)
+    py.round(3).to_csv(f'{output}.csv', index=False)
+    with open(f'{output}.json', 'w') as f:
+        json.dump({'meta': meta, 'results': py.to_dict('records')}, f, indent=2)
+    LOGGER.info(f'\nLatency benchmarks complete ({time.time() - t:.2f}s), saved to {output}.json and {output}.csv')
+    LOGGER.info(str(py.round(2)))
+    return py
+
 
 def run(
         weights=ROOT / 'yolov5s.pt',  # weights path
@@ -85,19 +232,28 @@ def run(
             assert suffix in str(w), 'export failed'
 
             # Validate
-            if model_type == SegmentationModel:
+            if model_type == SegmentationModel and val_seg is None:  # no mAP, mean full-pipeline latency instead
+                metric, speed = None, latency(w, imgsz, batch_size, data, device, half)['mean_ms']
+            elif model_type == SegmentationModel:
                 result = val_seg(data, w, batch_size, imgsz, plots=False, device=device, task='speed', half=half)
                 metric = result[0][7]  # (box(p, r, map50, map), mask(p, r, map50, map), *loss(box, obj, cls))
+                speed = result[2][1]  # times (preprocess, inference, postprocess)
             else:  # DetectionModel:
                 result = val_det(data, w, batch_size, imgsz, plots=False, device=device, task='speed', half=half)
                 metric = result[0][3]  # (p, r, map50, map, *loss(box, obj, cls))
-            speed = result[2][1]  # times (preprocess, inference, postprocess)
-            y.append([name, round(file_size(w), 1), round(metric, 4), round(speed, 2)])  # MB, mAP, t_inference
+                speed = result[2][1]  # times (preprocess, inference, postprocess)
+            speed_opt = None  # optimized PyTorch (channels_last, torch.compile) inference time
+            if f == '-' and model_type != SegmentationModel:
+                r = val_det(data, w, batch_size, imgsz, plots=False, device=device, task='speed', half=half,
+                            optimize=True)
+                speed_opt = round(r[2][1], 2)
+            metric = None if metric is None else round(metric, 4)
+            y.append([name, round(file_size(w), 1), metric, round(speed, 2), speed_opt])  # MB, mAP, t
         except Exception as e:
             if hard_fail:
                 assert type(e) is AssertionError, f'Benchmark --hard-fail for {name}: {e}'
             LOGGER.warning(f'WARNING ⚠️ Benchmark failure for {name}: {e}')
-            y.append([name, None, None, None])  # mAP, t_inference
+            y.append([name, None, None, None, None])  # mAP, t_inference
         if pt_only and i == 0:
             break  # break after PyTorch
 
@@ -105,7 +261,8 @@ def run(
     LOGGER.info('\n')
     parse_opt()
     notebook_init()  # print system info
-    c = ['Format', 'Size (MB)', 'mAP50-95', 'Inference time (ms)'] if map else ['Format', 'Export', '', '']
+    c = ['Format', 'Size (MB)', 'mAP50-95', 'Inference time (ms)', 'Optimized time (ms)'] if map else \
+        ['Format', 'Export', '', '', '']
     py = pd.DataFrame(y, columns=c)
     LOGGER.info(f'\nBenchmarks complete ({time.time() - t:.2f}s)')
     LOGGER.info(str(py if map else py.iloc[:, :2]))
@@ -159,6 +316,12 @@ def parse_opt():
     parser.add_argument('--test', action='store_true', help='test exports only')
     parser.add_argument('--pt-only', action='store_true', help='test PyTorch only')
     parser.add_argument('--hard-fail', nargs='?', const=True, default=False, help='Exception on error or < min metric')
+    parser.add_argument('--latency', action='store_true', help='latency distribution per format, batch and threads')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, help='--latency batch sizes, default --batch-size')
+    parser.add_argument('--threads', nargs='+', type=int, help='--latency intra-op thread counts, default all')
+    parser.add_argument('--iters', type=int, default=200, help='--latency timed calls per configuration')
+    parser.add_argument('--warmup', type=int, default=20, help='--latency untimed calls per configuration')
+    parser.add_argument('--output', type=str, default='benchmarks_latency', help='--latency *.json and *.csv path')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     print_args(vars(opt))
@@ -166,7 +329,23 @@ def parse_opt():
 
 
 def main(opt):
-    test(**vars(opt)) if opt.test else run(**vars(opt))
+    if opt.latency:  # latency distribution per format, batch size and thread count
+        run_latency(opt.weights,
+                    opt.imgsz,
+                    batch_sizes=opt.batch_sizes or [opt.batch_size],
+                    threads=opt.threads or [None],
+                    data=opt.data,
+                    device=opt.device,
+                    half=opt.half,
+                    pt_only=opt.pt_only,
+                    hard_fail=opt.hard_fail,
+                    iters=opt.iters,
+                    warmup=opt.warmup,
+                    output=opt.output)
+        return
+    latency_keys = 'latency', 'batch_sizes', 'threads', 'iters', 'warmup', 'output'
+    opt = {k: v for k, v in vars(opt).items() if k not in latency_keys}
+    test(**opt) if opt['test'] else run(**opt)
 
 
 if __name__ == '__main__':
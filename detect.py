@@ -43,11 +43,16 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
+from utils.cache import ResultCache
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
+                           increment_path, non_max_suppression, print_args, scale_boxes, split_end2end, strip_optimizer,
+                           xyxy2xywh)
+from utils.pipeline import Pipeline
 from utils.plots import Annotator, colors, save_one_box
+from utils.preprocess import LetterboxPreprocessor
 from utils.torch_utils import select_device, smart_inference_mode
+from utils.tracing import TRACER
 
 
 @smart_inference_mode()
@@ -68,6 +73,8 @@ def run(
         classes=None,  # filter by class: --class 0, or --class 0 2 3
         agnostic_nms=False,  # class-agnostic NMS
         augment=False,  # augmented inference
+        tta='loop',  # augmented inference: 'loop' one forward per scale/flip, 'batched' one forward for all
+        merge=False,  # merge-NMS, fuse overlapping boxes by score-weighted mean, i.e. of --augment outputs
         visualize=False,  # visualize features
         update=False,  # update all models
         project=ROOT / 'runs/detect',  # save results to project/name
@@ -79,6 +86,17 @@ def run(
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         vid_stride=1,  # video frame-rate stride
+        ov_requests=0,  # OpenVINO async infer requests in flight, -1 for device optimal, 0 for synchronous
+        gated_decode=False,  # decode only anchors with objectness > conf_thres (PyTorch models)
+        optimize=False,  # PyTorch: channels_last and torch.compile
+        pipeline=False,  # overlap decode + pre-process, inference and post-processing in threads
+        stream_policy='latest',  # stream frames: 'latest' (may repeat), 'new' (wait for next) or 'all' (queued)
+        decode_workers=0,  # image/video decode-ahead threads, 0 for synchronous decode
+        batch_size=1,  # image/video frames per inference batch
+        trace=False,  # record spans, save Chrome trace JSON and log span latency percentiles
+        cache=None,  # result cache mode, 'exact' or 'perceptual', frames matching a cached one skip inference and NMS
+        cache_size=256,  # result cache entries
+        cache_ttl=0.0,  # result cache entry lifetime (seconds), 0 for no expiry
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -95,41 +113,114 @@ def run(
 
     # Load model
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half, ov_requests=ov_requests,
+                               gate=conf_thres if gated_decode else 0.0, optimize=optimize)
     stride, names, pt = model.stride, model.names, model.pt
+    if pt:
+        model.model.tta = tta
     imgsz = check_img_size(imgsz, s=stride)  # check image size
 
     # Dataloader
     bs = 1  # batch_size
+    requests = len(model.infer_queue) if model.infer_queue is not None else 0  # OpenVINO async requests in flight
+    requests = max(requests, model.model.requests if model.triton else 0)  # Triton ?requests=n
+    threaded = pipeline and not model.pipelined  # inference in a Pipeline worker thread, see below
+    hold = requests + 2 + (3 * 2 if threaded else 0)  # frames in flight, Pipeline(maxsize=2) holds up to 3 * maxsize
+    preprocess = LetterboxPreprocessor(imgsz, stride, auto=pt, device=model.device, half=model.fp16,
+                                       buffers=model.staging)  # fused, into reused input buffers
     if webcam:
         view_img = check_imshow(warn=True)
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadStreams(source,
+                              img_size=imgsz,
+                              stride=stride,
+                              auto=pt,
+                              vid_stride=vid_stride,
+                              preprocess=False,
+                              policy=stream_policy,
+                              hold=hold)  # frames in flight across async requests and pipeline stages
         bs = len(dataset)
     elif screenshot:
-        dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
+        dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt, preprocess=False)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadImages(source,
+                             img_size=imgsz,
+                             stride=stride,
+                             auto=pt,
+                             vid_stride=vid_stride,
+                             preprocess=False,
+                             workers=decode_workers,
+                             batch=batch_size)
+        bs = batch_size
+    batched = bs > 1 or webcam  # path, im0s lists
     vid_path, vid_writer = [None] * bs, [None] * bs
 
     # Run inference
+    if trace:
+        TRACER.enable()
     model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
-    seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
-    for path, im, im0s, vid_cap, s in dataset:
-        with dt[0]:
-            im = torch.from_numpy(im).to(model.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
-            if len(im.shape) == 3:
-                im = im[None]  # expand for batch dim
+    seen, windows, dt = 0, [], (Profile(name='preprocess'), Profile(name='inference'), Profile(name='nms'))
+    results_cache = ResultCache(cache, cache_size, cache_ttl) if cache else None  # i.e. static scenes, fixed cameras
 
+    def frames():
+        for path, im, im0s, vid_cap, s in dataset:
+            idx = dataset.count if webcam else getattr(dataset, 'frame', 0)  # read here, frames() may run ahead
+            key, hit = None, None
+            with dt[0]:
+                im = preprocess(im0s)  # letterbox, BGR to RGB, BCHW, uint8 to fp16/32 and 0.0 - 1.0 in one pass
+                if results_cache:  # keyed on the letterboxed uint8 frames, NMS output of all frames reused on a hit
+                    key = tuple(results_cache.key(x) for x in preprocess.buf[:len(im)])
+                    hit = results_cache.get(key)
+            yield im, (path, im, im0s, vid_cap, s, dataset.mode, idx, key, hit)
+
+    dti = Profile(name='inference')  # inference time of the Pipeline worker thread, dt[1] stays in this one
+
+    @smart_inference_mode()  # inference mode is thread-local, Pipeline runs this in a worker thread
+    def infer(x):
+        im, data = x
+        if data[-1] is not None:  # result cache hit
+            return (None, 0.0), data
+        with dti:
+            v = increment_path(save_dir / Path(data[0]).stem, mkdir=True) if visualize else False
+            pred = model(im, augment=augment, visualize=v)
+            reused = model.engine or model.onnx and model.io_binding or model.triton and model.model.shm
+            if reused:  # outputs are reused by the next forward(), Triton ?shm=1 outputs are shared-memory views
+                pred = [x.clone() for x in pred] if isinstance(pred, list) else pred.clone()
+        return (pred, dti.dt), data  # with this frame's inference time, read in the worker thread
+
+    if model.pipelined:  # OpenVINO/Triton async models keep the next frames in flight while results are processed
+        results = model.imap(frames())
+    elif pipeline:  # frame N+1 decode + pre-process, frame N inference and frame N-1 post-processing overlap
+        preprocess.buffers, preprocess.pin = None, False  # own input tensor per frame in flight
+        results = Pipeline(frames(), infer, maxsize=2)
+    else:
+        results = ((None, x) for x in frames())
+    for pred, (path, im, im0s, vid_cap, s, mode, idx, key, hit) in results:
         # Inference
-        with dt[1]:
-            visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-            pred = model(im, augment=augment, visualize=visualize)
+        if threaded:
+            pred, t = pred
+        else:
+            with dt[1]:
+                if pred is None and hit is None:  # synchronous
+                    visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
+                    pred = model(im, augment=augment, visualize=visualize)
+            t = dt[1].dt
 
         # NMS
         with dt[2]:
-            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            if hit is not None:  # cached NMS output at inference size, boxes are rescaled in place below
+                pred = [x.clone() for x in hit]
+            elif model.end2end:  # NMS in model
+                pred = split_end2end(pred, len(im), conf_thres, classes)
+            else:
+                pred = non_max_suppression(pred,
+                                           conf_thres,
+                                           iou_thres,
+                                           classes,
+                                           agnostic_nms,
+                                           max_det=max_det,
+                                           merge=merge)
+            if results_cache and hit is None:
+                results_cache.put(key, [x.clone() for x in pred])
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
@@ -138,41 +229,45 @@ def run(
         for i, det in enumerate(pred):  # per image
             seen += 1
             if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
+                p, im0, frame = path[i], im0s[i].copy(), idx
+                s += f'{i}: '
+            elif batched:  # images, or consecutive frames of one video
+                p, im0, frame = path[i], im0s[i].copy(), idx - len(pred) + 1 + i
                 s += f'{i}: '
             else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
+                p, im0, frame = path, im0s.copy(), idx
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
+            txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # im.txt
             s += '%gx%g ' % im.shape[2:]  # print string
             gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
             imc = im0.copy() if save_crop else im0  # for save_crop
             annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, 5].unique():
-                    n = (det[:, 5] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(f'{txt_path}.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
-                        label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                    if save_crop:
-                        save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+            with TRACER.span('annotate'):
+                if len(det):
+                    # Rescale boxes from img_size to im0 size
+                    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
+
+                    # Print results
+                    for c in det[:, 5].unique():
+                        n = (det[:, 5] == c).sum()  # detections per class
+                        s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+
+                    # Write results
+                    for *xyxy, conf, cls in reversed(det):
+                        if save_txt:  # Write to file
+                            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                            line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+                            with open(f'{txt_path}.txt', 'a') as f:
+                                f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+                        if save_img or save_crop or view_img:  # Add bbox to image
+                            c = int(cls)  # integer class
+                            label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
+                            annotator.box_label(xyxy, label, color=colors(c, True))
+                        if save_crop:
+                            save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
 
             # Stream results
             im0 = annotator.result()
@@ -185,33 +280,41 @@ def run(
                 cv2.waitKey(1)  # 1 millisecond
 
             # Save results (image with detections)
-            if save_img:
-                if dataset.mode == 'image':
-                    cv2.imwrite(save_path, im0)
-                else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                        save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+            with TRACER.span('save'):
+                if save_img:
+                    if mode == 'image':
+                        cv2.imwrite(save_path, im0)
+                    else:  # 'video' or 'stream'
+                        j = i if webcam else 0  # one writer per stream, frames of a file batch share one
+                        if vid_path[j] != save_path:  # new video
+                            vid_path[j] = save_path
+                            if isinstance(vid_writer[j], cv2.VideoWriter):
+                                vid_writer[j].release()  # release previous video writer
+                            if vid_cap:  # video
+                                fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                                w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                                h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                            else:  # stream
+                                fps, w, h = 30, im0.shape[1], im0.shape[0]
+                            save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
+                            vid_writer[j] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                        vid_writer[j].write(im0)
 
         # Print time (inference-only)
-        LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt[1].dt * 1E3:.1f}ms")
+        LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{t * 1E3:.1f}ms")
 
     # Print results
-    t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
+    t = tuple(x.t / seen * 1E3 for x in (dt[0], dti if threaded else dt[1], dt[2]))  # speeds per image
     LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    if results_cache:
+        LOGGER.info(f'Result cache: {results_cache.stats()}')
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
+    if trace:
+        TRACER.summary()
+        LOGGER.info(f"Trace saved to {colorstr('bold', TRACER.export(save_dir / 'trace.json'))}")
+        TRACER.enable(False).clear()  # stop recording, i.e. when train.py calls val.run() every epoch
     if update:
         strip_optimizer(weights[0])  # update model (to fix SourceChangeWarning)
 
@@ -234,6 +337,8 @@ def parse_opt():
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --classes 0, or --classes 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta', default='loop', choices=['loop', 'batched'], help='augmented inference mode')
+    parser.add_argument('--merge', action='store_true', help='merge-NMS, fuse overlapping boxes, i.e. for --augment')
     parser.add_argument('--visualize', action='store_true', help='visualize features')
     parser.add_argument('--update', action='store_true', help='update all models')
     parser.add_argument('--project', default=ROOT / 'runs/detect', help='save results to project/name')
@@ -245,6 +350,17 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--ov-requests', type=int, default=0, help='OpenVINO async infer requests, -1 for optimal')
+    parser.add_argument('--gated-decode', action='store_true', help='decode only anchors with obj > conf-thres')
+    parser.add_argument('--optimize', action='store_true', help='PyTorch: channels_last and torch.compile')
+    parser.add_argument('--pipeline', action='store_true', help='overlap pre-process, inference and post-process')
+    parser.add_argument('--stream-policy', default='latest', choices=['latest', 'new', 'all'], help='stream frames')
+    parser.add_argument('--decode-workers', type=int, default=0, help='image/video decode-ahead threads')
+    parser.add_argument('--batch-size', type=int, default=1, help='image/video frames per inference batch')
+    parser.add_argument('--trace', action='store_true', help='save Chrome trace JSON and log span percentiles')
+    parser.add_argument('--cache', choices=['exact', 'perceptual'], help='reuse results of repeated frames')
+    parser.add_argument('--cache-size', type=int, default=256, help='result cache entries')
+    parser.add_argument('--cache-ttl', type=float, default=0.0, help='result cache entry lifetime (s), 0 for none')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
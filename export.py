@@ -28,6 +28,7 @@ Inference:
     $ python detect.py --weights yolov5s.pt                 # PyTorch
                                  yolov5s.torchscript        # TorchScript
                                  yolov5s.onnx               # ONNX Runtime or OpenCV DNN with --dnn
+                                 yolov5s-int8.onnx          # ONNX Runtime INT8 (--include onnx --int8)
                                  yolov5s_openvino_model     # OpenVINO
                                  yolov5s.engine             # TensorRT
                                  yolov5s.mlmodel            # CoreML (macOS-only)
@@ -58,6 +59,7 @@ from pathlib import Path
 
 import pandas as pd
 import torch
+import torch.nn.functional as F
 from torch.utils.mobile_optimizer import optimize_for_mobile
 
 FILE = Path(__file__).resolve()
@@ -71,7 +73,9 @@ from models.experimental import attempt_load
 from models.yolo import ClassificationModel, Detect, DetectionModel, SegmentationModel
 from utils.dataloaders import LoadImages
 from utils.general import (LOGGER, Profile, check_dataset, check_img_size, check_requirements, check_version,
-                           check_yaml, colorstr, file_size, get_default_args, print_args, url2file, yaml_save)
+                           check_yaml, colorstr, file_size, get_default_args, print_args, url2file, xywh2xyxy,
+                           yaml_save)
+from utils.segment.general import crop_mask
 from utils.torch_utils import select_device, smart_inference_mode
 
 MACOS = platform.system() == 'Darwin'  # macOS environment
@@ -96,6 +100,61 @@ class iOSModel(torch.nn.Module):
         return cls * conf, xywh * self.normalize  # confidence (3780, 80), coordinates (3780, 4)
 
 
+class ONNXNMS(torch.autograd.Function):
+    # ONNX NonMaxSuppression op, forward() only returns placeholder (n,3) [image, class, box] indices for tracing
+    @staticmethod
+    def forward(ctx, boxes, scores, max_output_boxes_per_class, iou_threshold, score_threshold):
+        i = torch.arange(min(boxes.shape[1], 100), device=boxes.device)
+        return torch.stack((torch.zeros_like(i), torch.zeros_like(i), i), 1)
+
+    @staticmethod
+    def symbolic(g, boxes, scores, max_output_boxes_per_class, iou_threshold, score_threshold):
+        return g.op('NonMaxSuppression', boxes, scores, max_output_boxes_per_class, iou_threshold, score_threshold)
+
+
+class ONNXEnd2End(torch.nn.Module):
+    # YOLOv5 model with class-aware NMS, top-k and segmentation mask assembly in the ONNX graph
+    # Outputs detections (n,7) [image, x1, y1, x2, y2, conf, cls] and for segmentation models masks (n,h,w)
+    def __init__(self, model, max_det=100, iou_thres=0.45, conf_thres=0.25):
+        super().__init__()
+        self.model = model
+        self.nm = model.model[-1].nm if isinstance(model, SegmentationModel) else 0  # number of masks
+        self.max_det = max_det
+        self.iou_thres = iou_thres
+        self.conf_thres = conf_thres
+
+    def forward(self, x):
+        y = self.model(x)  # Detect.export outputs (pred,) or (pred, proto)
+        p, d = y[0], x.device
+        mi = p.shape[2] - self.nm  # mask start index
+        box = xywh2xyxy(p[..., :4])
+        scores = p[..., 5:mi] * p[..., 4:5]  # conf = obj_conf * cls_conf
+        i = ONNXNMS.apply(box.float(), scores.transpose(1, 2).float(), torch.tensor([self.max_det], device=d),
+                          torch.tensor([self.iou_thres], device=d), torch.tensor([self.conf_thres], device=d))
+        b, c, j = i.unbind(1)  # image, class, box indices
+        s = scores[b, j, c]
+        k = (b.to(s.dtype) * 2 - s).argsort()  # by image, then by descending score (scores in [0, 1])
+        b, c, j = b[k], c[k], j[k]
+        n = (b[:, None] == torch.arange(x.shape[0], device=d)).sum(0)  # detections per image
+        k = torch.ones_like(b).cumsum(0) - 1 - (n.cumsum(0) - n)[b] < self.max_det  # top-k over classes per image
+        b, c, j = b[k], c[k], j[k]
+        box = box[b, j]
+        det = torch.cat((b[:, None].to(box.dtype), box, scores[b, j, c][:, None], c[:, None].to(box.dtype)), 1)
+        if not self.nm:
+            return det
+
+        # Masks, as process_mask(upsample=True)
+        proto = y[1]
+        bs, nm, mh, mw = proto.shape
+        ih, iw = x.shape[2:]
+        n = torch.ones_like(b).cumsum(0) - 1  # detection index
+        masks = (p[b, j, mi:] @ proto.view(bs, nm, -1))[b, n]  # coefficients @ own image protos
+        masks = masks.sigmoid().view(-1, mh, mw)
+        masks = crop_mask(masks, box * torch.tensor([mw / iw, mh / ih, mw / iw, mh / ih], device=d))
+        masks = F.interpolate(masks[None], (ih, iw), mode='bilinear', align_corners=False)[0]
+        return det, masks.gt_(0.5)
+
+
 def export_formats():
     # YOLOv5 export formats
     x = [
@@ -149,8 +208,8 @@ def export_torchscript(model, im, file, optimize, prefix=colorstr('TorchScript:'
 
 
 @try_export
-def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX:')):
-    # YOLOv5 ONNX export
+def export_onnx(model, im, file, opset, dynamic, simplify, end2end=None, prefix=colorstr('ONNX:')):
+    # YOLOv5 ONNX export, end2end=(max_det, iou_thres, conf_thres) embeds NMS and mask assembly, see ONNXEnd2End
     check_requirements('onnx>=1.12.0')
     import onnx
 
@@ -158,16 +217,23 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
     f = file.with_suffix('.onnx')
 
     output_names = ['output0', 'output1'] if isinstance(model, SegmentationModel) else ['output0']
+    axes = {}
     if dynamic:
-        dynamic = {'images': {0: 'batch', 2: 'height', 3: 'width'}}  # shape(1,3,640,640)
+        axes = {'images': {0: 'batch', 2: 'height', 3: 'width'}}  # shape(1,3,640,640)
         if isinstance(model, SegmentationModel):
-            dynamic['output0'] = {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
-            dynamic['output1'] = {0: 'batch', 2: 'mask_height', 3: 'mask_width'}  # shape(1,32,160,160)
+            axes['output0'] = {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
+            axes['output1'] = {0: 'batch', 2: 'mask_height', 3: 'mask_width'}  # shape(1,32,160,160)
         elif isinstance(model, DetectionModel):
-            dynamic['output0'] = {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
+            axes['output0'] = {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
+    if end2end:
+        assert opset >= 10, f'--end2end requires --opset >= 10 for NonMaxSuppression, not {opset}'
+        axes['output0'] = {0: 'detections'}  # shape(n,7)
+        if isinstance(model, SegmentationModel):
+            axes['output1'] = {0: 'detections', 1: 'height', 2: 'width'}  # shape(n,640,640)
 
+    m = ONNXEnd2End(model, *end2end) if end2end else model
     torch.onnx.export(
-        model.cpu() if dynamic else model,  # --dynamic only compatible with cpu
+        m.cpu() if dynamic else m,  # --dynamic only compatible with cpu
         im.cpu() if dynamic else im,
         f,
         verbose=False,
@@ -175,7 +241,7 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
         do_constant_folding=True,  # WARNING: DNN inference with torch>=1.12 may require do_constant_folding=False
         input_names=['images'],
         output_names=output_names,
-        dynamic_axes=dynamic or None)
+        dynamic_axes=axes or None)
 
     # Checks
     model_onnx = onnx.load(f)  # load onnx model
@@ -183,6 +249,8 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
 
     # Metadata
     d = {'stride': int(max(model.stride)), 'names': model.names}
+    if end2end:
+        d['end2end'] = True  # NMS in graph, see DetectMultiBackend.end2end
     for k, v in d.items():
         meta = model_onnx.metadata_props.add()
         meta.key, meta.value = k, str(v)
@@ -204,6 +272,60 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
     return f, model_onnx
 
 
+@try_export
+def export_onnx_int8(model, im, file, data, calib=300, prefix=colorstr('ONNX INT8:')):
+    # YOLOv5 ONNX static INT8 (QDQ) post-training quantization, calibrated on the first --calib train images of --data
+    check_requirements(('onnx>=1.12.0', 'onnxruntime'))
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    from utils.dataloaders import LoadImagesAndLabels
+    from utils.preprocess import LetterboxPreprocessor
+
+    LOGGER.info(f'\n{prefix} starting export with onnx {onnx.__version__}...')
+    f_onnx = file.with_suffix('.onnx')
+    f = file.with_name(f'{file.stem}-int8.onnx')
+    assert im.dtype == torch.float, '--int8 ONNX export requires an FP32 model, i.e. drop --half'
+
+    # Calibration data, letterboxed to the export input shape
+    dataset = LoadImagesAndLabels(check_dataset(data)['train'], img_size=max(im.shape[2:]), augment=False)
+    preprocess = LetterboxPreprocessor(im.shape[2:], int(max(model.stride)), auto=False)
+
+    class CalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self.i = iter(range(min(calib, len(dataset))))
+
+        def get_next(self):
+            i = next(self.i, None)
+            if i is not None:
+                x = preprocess(dataset.load_image(i)[0]).numpy()  # (1,3,h,w) float32
+                return {'images': x.repeat(im.shape[0], 0)}
+
+    # Keep Detect/Segment output decoding (and any end-to-end NMS) in FP32, quantize convolutions throughout
+    model_onnx = onnx.load(f_onnx)
+    head = f'model.{len(model.model) - 1}/'  # Detect() module scope in ONNX node names
+    exclude = [
+        x.name for x in model_onnx.graph.node if x.op_type != 'Conv' and (head in x.name or '/model.' not in x.name)]
+    LOGGER.info(f'{prefix} calibrating on {min(calib, len(dataset))} images...')
+    quantize_static(str(f_onnx),
+                    str(f),
+                    CalibrationReader(),
+                    quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    per_channel=True,
+                    nodes_to_exclude=exclude)
+
+    # Metadata
+    model_int8 = onnx.load(f)
+    del model_int8.metadata_props[:]
+    model_int8.metadata_props.extend(model_onnx.metadata_props)
+    meta = model_int8.metadata_props.add()
+    meta.key, meta.value = 'quantization', 'int8'
+    onnx.save(model_int8, f)
+    return f, model_int8
+
+
 @try_export
 def export_openvino(file, metadata, half, int8, data, prefix=colorstr('OpenVINO:')):
     # YOLOv5 OpenVINO export
@@ -707,7 +829,7 @@ def run(
         inplace=False,  # set YOLOv5 Detect() inplace=True
         keras=False,  # use Keras
         optimize=False,  # TorchScript: optimize for mobile
-        int8=False,  # CoreML/TF INT8 quantization
+        int8=False,  # CoreML/TF/OpenVINO/ONNX INT8 quantization
         dynamic=False,  # ONNX/TF/TensorRT: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset=12,  # ONNX: opset version
@@ -719,6 +841,8 @@ def run(
         topk_all=100,  # TF.js NMS: topk for all classes to keep
         iou_thres=0.45,  # TF.js NMS: IoU threshold
         conf_thres=0.25,  # TF.js NMS: confidence threshold
+        end2end=False,  # ONNX: embed NMS, top-k and mask assembly
+        calib=300,  # ONNX INT8: number of calibration images
 ):
     t = time.time()
     include = [x.lower() for x in include]  # to lowercase
@@ -739,6 +863,9 @@ def run(
     imgsz *= 2 if len(imgsz) == 1 else 1  # expand
     if optimize:
         assert device.type == 'cpu', '--optimize not compatible with cuda devices, i.e. use --device cpu'
+    if end2end:
+        assert not xml, '--end2end not compatible with OpenVINO export, i.e. export ONNX and OpenVINO separately'
+        assert not isinstance(model, ClassificationModel), '--end2end requires a detection or segmentation model'
 
     # Input
     gs = int(max(model.stride))  # grid size (max stride)
@@ -769,7 +896,10 @@ def run(
     if engine:  # TensorRT required before ONNX
         f[1], _ = export_engine(model, im, file, half, dynamic, simplify, workspace, verbose)
     if onnx or xml:  # OpenVINO requires ONNX
-        f[2], _ = export_onnx(model, im, file, opset, dynamic, simplify)
+        nms_args = (topk_all, iou_thres, conf_thres) if end2end else None  # ONNX end-to-end NMS
+        f[2], _ = export_onnx(model, im, file, opset, dynamic, simplify, nms_args)
+    if onnx and int8:  # ONNX INT8
+        f.append(export_onnx_int8(model, im, file, data, calib)[0])
     if xml:  # OpenVINO
         f[3], _ = export_openvino(file, metadata, half, int8, data)
     if coreml:  # CoreML
@@ -831,7 +961,7 @@ def parse_opt(known=False):
     parser.add_argument('--inplace', action='store_true', help='set YOLOv5 Detect() inplace=True')
     parser.add_argument('--keras', action='store_true', help='TF: use Keras')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
-    parser.add_argument('--int8', action='store_true', help='CoreML/TF/OpenVINO INT8 quantization')
+    parser.add_argument('--int8', action='store_true', help='CoreML/TF/OpenVINO/ONNX INT8 quantization')
     parser.add_argument('--dynamic', action='store_true', help='ONNX/TF/TensorRT: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset', type=int, default=17, help='ONNX: opset version')
@@ -840,9 +970,11 @@ def parse_opt(known=False):
     parser.add_argument('--nms', action='store_true', help='TF: add NMS to model')
     parser.add_argument('--agnostic-nms', action='store_true', help='TF: add agnostic NMS to model')
     parser.add_argument('--topk-per-class', type=int, default=100, help='TF.js NMS: topk per class to keep')
-    parser.add_argument('--topk-all', type=int, default=100, help='TF.js NMS: topk for all classes to keep')
-    parser.add_argument('--iou-thres', type=float, default=0.45, help='TF.js NMS: IoU threshold')
-    parser.add_argument('--conf-thres', type=float, default=0.25, help='TF.js NMS: confidence threshold')
+    parser.add_argument('--topk-all', type=int, default=100, help='TF.js/ONNX NMS: topk for all classes to keep')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='TF.js/ONNX NMS: IoU threshold')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='TF.js/ONNX NMS: confidence threshold')
+    parser.add_argument('--end2end', action='store_true', help='ONNX: add NMS and mask assembly to model')
+    parser.add_argument('--calib', type=int, default=300, help='ONNX INT8: number of calibration images')
     parser.add_argument(
         '--include',
         nargs='+',
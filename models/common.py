@@ -8,9 +8,10 @@ import contextlib
 import json
 import math
 import platform
+import threading
 import warnings
 import zipfile
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from copy import copy
 from pathlib import Path
 from urllib.parse import urlparse
@@ -25,12 +26,15 @@ from PIL import Image
 from torch.cuda import amp
 
 from utils import TryExcept
+from utils.autotune import apply_profile, load_profile
 from utils.dataloaders import exif_transpose, letterbox
 from utils.general import (LOGGER, ROOT, Profile, check_requirements, check_suffix, check_version, colorstr,
                            increment_path, is_jupyter, make_divisible, non_max_suppression, scale_boxes, xywh2xyxy,
                            xyxy2xywh, yaml_load)
 from utils.plots import Annotator, colors, save_one_box
-from utils.torch_utils import copy_attr, smart_inference_mode
+from utils.preprocess import LetterboxPreprocessor
+from utils.torch_utils import StagingBuffers, copy_attr, smart_inference_mode
+from utils.tracing import TRACER
 
 
 def autopad(k, p=None, d=1):  # kernel, padding, dilation
@@ -314,7 +318,19 @@ class Concat(nn.Module):
 
 class DetectMultiBackend(nn.Module):
     # YOLOv5 MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolov5s.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, fuse=True):
+    def __init__(self,
+                 weights='yolov5s.pt',
+                 device=torch.device('cpu'),
+                 dnn=False,
+                 data=None,
+                 fp16=False,
+                 fuse=True,
+                 max_buffers=8,
+                 ort_options=None,
+                 ov_requests=0,
+                 gate=0.0,
+                 optimize=False,
+                 threads=None):
         # Usage:
         #   PyTorch:              weights = *.pt
         #   TorchScript:                    *.torchscript
@@ -334,9 +350,22 @@ class DetectMultiBackend(nn.Module):
         w = str(weights[0] if isinstance(weights, list) else weights)
         pt, jit, onnx, xml, engine, coreml, saved_model, pb, tflite, edgetpu, tfjs, paddle, triton = self._model_type(w)
         fp16 &= pt or jit or onnx or engine or triton  # FP16
+        optimize &= pt  # torch.compile / TorchScript freeze of PyTorch models
         nhwc = coreml or saved_model or pb or tflite or edgetpu  # BHWC formats (vs torch BCWH)
         stride = 32  # default stride
+        infer_queue = None  # OpenVINO AsyncInferQueue, see imap()
+        end2end = False  # NMS and masks in model (export.py --end2end), outputs need split_end2end() not NMS
         cuda = torch.cuda.is_available() and device.type != 'cpu'  # use CUDA
+        if threads == 'auto':  # tuned CPU threads and affinity of this host and backend, see utils/autotune.py
+            threads = load_profile(self.backend_name(w))
+            LOGGER.info(f'Applying tuned CPU profile {threads}' if threads else
+                        f'WARNING ⚠️ no tuned CPU profile for {self.backend_name(w)}, run utils/autotune.py')
+        if isinstance(threads, int):  # thread count only
+            threads = {'threads': threads}
+        assert threads is None or isinstance(threads, dict), f"invalid threads {threads}, use 'auto', int or dict"
+        # torch threads here, runtime threads per backend below. threads['affinity'] is applied by the caller to its
+        # inference thread, loading a model (i.e. in a registry executor thread) does not pin the loading thread
+        apply_profile(threads, affinity=False)
         if not (pt or triton):
             w = attempt_download(w)  # download if not local
 
@@ -345,6 +374,13 @@ class DetectMultiBackend(nn.Module):
             stride = max(int(model.stride.max()), 32)  # model stride
             names = model.module.names if hasattr(model, 'module') else model.names  # get class names
             model.half() if fp16 else model.float()
+            if gate:  # decode only anchors with objectness > gate in Detect/Segment heads, see Detect.gate
+                for m in model.modules():
+                    if hasattr(m, 'gate'):
+                        m.gate = gate
+            if optimize:  # channels_last, compiled per input shape on first use, see _pt_forward()
+                model = model.to(memory_format=torch.channels_last)
+                compiled = {}  # (shape, dtype): compiled model or eager fallback
             self.model = model  # explicitly assign for to(), cpu(), cuda(), half()
         elif jit:  # TorchScript
             LOGGER.info(f'Loading {w} for TorchScript inference...')
@@ -366,15 +402,28 @@ class DetectMultiBackend(nn.Module):
             check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
             import onnxruntime
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
-            session = onnxruntime.InferenceSession(w, providers=providers)
+            ort_options = dict(ort_options or {})
+            if threads:
+                ort_options.setdefault('intra_op_num_threads', threads.get('threads'))
+                ort_options.setdefault('inter_op_num_threads', threads.get('inter_op_threads'))
+            io_binding = ort_options.pop('io_binding', True)  # bind inputs in place and outputs to reused buffers
+            f, session_options = self._ort_session_options(onnxruntime, w, ort_options)
+            session = onnxruntime.InferenceSession(f, sess_options=session_options, providers=providers)
+            input_name = session.get_inputs()[0].name
             output_names = [x.name for x in session.get_outputs()]
+            if io_binding:
+                binding = session.io_binding()
+                ort_shapes, ort_buffers = {}, StagingBuffers(device, maxsize=max_buffers)  # output shapes, buffers
             meta = session.get_modelmeta().custom_metadata_map  # metadata
             if 'stride' in meta:
                 stride, names = int(meta['stride']), eval(meta['names'])
+            end2end = meta.get('end2end') == 'True'
+            if 'quantization' in meta:  # export.py --int8, QDQ nodes run as integer kernels in ORT
+                LOGGER.info(f"ONNX Runtime {meta['quantization'].upper()} quantized model")
         elif xml:  # OpenVINO
             LOGGER.info(f'Loading {w} for OpenVINO inference...')
             check_requirements('openvino')  # requires openvino-dev: https://pypi.org/project/openvino-dev/
-            from openvino.runtime import Core, Layout, get_batch
+            from openvino.runtime import AsyncInferQueue, Core, Layout, get_batch
             ie = Core()
             if not Path(w).is_file():  # if not *.xml
                 w = next(Path(w).glob('*.xml'))  # get *.xml file from *_openvino_model dir
@@ -384,7 +433,16 @@ class DetectMultiBackend(nn.Module):
             batch_dim = get_batch(network)
             if batch_dim.is_static:
                 batch_size = batch_dim.get_length()
-            executable_network = ie.compile_model(network, device_name='CPU')  # device_name="MYRIAD" for Intel NCS2
+            config = {'PERFORMANCE_HINT': 'THROUGHPUT'} if ov_requests else {}  # multi-stream for async requests
+            if threads:
+                config['INFERENCE_NUM_THREADS'] = str(threads['threads'])
+                if threads.get('streams'):
+                    config['NUM_STREAMS'] = str(threads['streams'])
+            executable_network = ie.compile_model(network, device_name='CPU', config=config)  # "MYRIAD" for Intel NCS2
+            if ov_requests:  # ov_requests=-1 for the device's optimal number of requests
+                infer_queue = AsyncInferQueue(executable_network, max(ov_requests, 0))
+                infer_queue.set_callback(self._ov_callback)
+                LOGGER.info(f'OpenVINO async inference with {len(infer_queue)} infer requests')
             stride, names = self._load_metadata(Path(w).with_suffix('.yaml'))  # load metadata
         elif engine:  # TensorRT
             LOGGER.info(f'Loading {w} for TensorRT inference...')
@@ -461,7 +519,7 @@ class DetectMultiBackend(nn.Module):
                 interpreter = Interpreter(model_path=w, experimental_delegates=[load_delegate(delegate)])
             else:  # TFLite
                 LOGGER.info(f'Loading {w} for TensorFlow Lite inference...')
-                interpreter = Interpreter(model_path=w)  # load TFLite model
+                interpreter = Interpreter(model_path=w, num_threads=threads and threads['threads'])  # load TFLite model
             interpreter.allocate_tensors()  # allocate
             input_details = interpreter.get_input_details()  # inputs
             output_details = interpreter.get_output_details()  # outputs
@@ -500,9 +558,11 @@ class DetectMultiBackend(nn.Module):
             names = yaml_load(data)['names'] if data else {i: f'class{i}' for i in range(999)}
         if names[0] == 'n01440764' and len(names) == 1000:  # ImageNet
             names = yaml_load(ROOT / 'data/ImageNet.yaml')['names']  # human-readable names
+        staging = StagingBuffers(device, maxsize=max_buffers)  # reused input buffers, see stage()
 
         self.__dict__.update(locals())  # assign all variables to self
 
+    @TRACER.wrap('forward')
     def forward(self, im, augment=False, visualize=False):
         # YOLOv5 MultiBackend inference
         b, ch, h, w = im.shape  # batch, channel, height, width
@@ -512,7 +572,10 @@ class DetectMultiBackend(nn.Module):
             im = im.permute(0, 2, 3, 1)  # torch BCHW to numpy BHWC shape(1,320,192,3)
 
         if self.pt:  # PyTorch
-            y = self.model(im, augment=augment, visualize=visualize) if augment or visualize else self.model(im)
+            if augment or visualize:
+                y = self.model(im, augment=augment, visualize=visualize)
+            else:
+                y = self._pt_forward(im) if self.optimize else self.model(im)
         elif self.jit:  # TorchScript
             y = self.model(im)
         elif self.dnn:  # ONNX OpenCV DNN
@@ -520,8 +583,11 @@ class DetectMultiBackend(nn.Module):
             self.net.setInput(im)
             y = self.net.forward()
         elif self.onnx:  # ONNX Runtime
-            im = im.cpu().numpy()  # torch to numpy
-            y = self.session.run(self.output_names, {self.session.get_inputs()[0].name: im})
+            if self.io_binding:
+                y = self._ort_forward(im)
+            else:
+                im = im.cpu().numpy()  # torch to numpy
+                y = self.session.run(self.output_names, {self.input_name: im})
         elif self.xml:  # OpenVINO
             im = im.cpu().numpy()  # FP32
             y = list(self.executable_network([im]).values())
@@ -588,10 +654,122 @@ class DetectMultiBackend(nn.Module):
     def from_numpy(self, x):
         return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
 
-    def warmup(self, imgsz=(1, 3, 640, 640)):
-        # Warmup model by running inference once
+    def start_async(self, im, callback, userdata=None):
+        # Start OpenVINO inference on a free request of the async pool (blocks while all are busy)
+        # callback(y, userdata) is called from an OpenVINO thread on completion, y is the exception if the request
+        # failed. Input is copied into the request
+        self.infer_queue.start_async({0: im.cpu().numpy()}, (callback, userdata))
+
+    @staticmethod
+    def _ov_callback(request, userdata):
+        # OpenVINO AsyncInferQueue completion callback, copies outputs out of the request before it is reused
+        callback, userdata = userdata
+        try:
+            y = [torch.from_numpy(x.data.copy()) for x in request.output_tensors]
+            y = y[0] if len(y) == 1 else y
+        except Exception as e:  # failed request, passed on so that waiters are not blocked forever
+            y = e
+        callback(y, userdata)
+
+    @property
+    def pipelined(self):
+        # True if imap() keeps requests in flight: OpenVINO async requests or Triton ?requests=n
+        return self.infer_queue is not None or bool(self.triton and self.model.requests > 1)
+
+    def imap(self, items):
+        # Yield (y, userdata) in submission order for an iterable of (im, userdata)
+        # OpenVINO async models keep up to len(infer_queue) requests in flight, Triton models up to the URL's
+        # ?requests=n, other backends run synchronously
+        if self.triton and self.model.requests > 1:
+            ims = ((im.half() if self.fp16 else im, u) for im, u in items)
+            yield from self.model.imap((im.permute(0, 2, 3, 1) if self.nhwc else im, u) for im, u in ims)
+            return
+        if self.infer_queue is None:
+            for im, userdata in items:
+                yield self.forward(im), userdata
+            return
+
+        results, ready = {}, threading.Condition()
+
+        def callback(y, i):
+            with ready:
+                results[i] = y
+                ready.notify_all()
+
+        def result(j):
+            y = results.pop(j)
+            if isinstance(y, Exception):
+                raise y
+            return y
+
+        pending = deque()  # (index, userdata) in submission order
+        for i, (im, userdata) in enumerate(items):
+            self.start_async(im, callback, i)
+            pending.append((i, userdata))
+            while pending and pending[0][0] in results:  # deliver completed results in order
+                j, u = pending.popleft()
+                yield result(j), u
+        while pending:
+            j, u = pending.popleft()
+            with ready:
+                ready.wait_for(lambda: j in results)
+            yield result(j), u
+
+    def _ort_forward(self, im):
+        # ONNX Runtime inference with I/O binding: input bound in place, outputs written into reused buffers
+        # Outputs alias the buffers for this input shape, so they are only valid until the next forward() of it
+        im = im.contiguous()
+        d = 'cuda' if im.device.type == 'cuda' else 'cpu'
+        i, k = im.device.index or 0, tuple(im.shape)
+        np_type = {torch.float32: np.float32, torch.float16: np.float16}
+        self.binding.bind_input(self.input_name, d, i, np_type[im.dtype], k, im.data_ptr())
+        if k not in self.ort_shapes or self.end2end:  # new shape or data-dependent outputs, let ORT allocate
+            for x in self.output_names:
+                self.binding.bind_output(x, d)
+            self.session.run_with_iobinding(self.binding)
+            y = [torch.from_numpy(x).to(im.device) for x in self.binding.copy_outputs_to_cpu()]
+            self.ort_shapes[k] = [(x.shape, x.dtype) for x in y]
+            return y
+        y = [self.ort_buffers.get(*x) for x in self.ort_shapes[k]]
+        for x, b in zip(self.output_names, y):
+            self.binding.bind_output(x, d, i, np_type[b.dtype], tuple(b.shape), b.data_ptr())
+        self.session.run_with_iobinding(self.binding)
+        return y
+
+    def _pt_forward(self, im):
+        # Optimized PyTorch inference: channels_last input into a model compiled for this shape, eager on failure
+        k = tuple(im.shape), im.dtype
+        im = im.contiguous(memory_format=torch.channels_last)
+        if k not in self.compiled:
+            try:
+                self.compiled[k] = self._pt_compile(im)
+            except Exception as e:
+                LOGGER.warning(f'WARNING ⚠️ optimized PyTorch inference failed for {k}, using eager: {e}')
+                self.compiled[k] = self.model
+        return self.compiled[k](im)
+
+    def _pt_compile(self, im):
+        # torch.compile (torch>=2.0) or frozen TorchScript, run once here so that failures surface before caching
+        LOGGER.info(f'Optimizing PyTorch model for input {tuple(im.shape)}...')
+        if hasattr(torch, 'compile'):
+            f = torch.compile(self.model, dynamic=False)
+        else:
+            f = torch.jit.freeze(torch.jit.trace(self.model, im, strict=False).eval())
+            if hasattr(torch.jit, 'optimize_for_inference'):  # torch>=1.10
+                f = torch.jit.optimize_for_inference(f)
+        f(im)
+        return f
+
+    def stage(self, im):
+        # Copy uint8 BCHW/CHW frame(s) into preallocated input buffers, returning normalized model-dtype input
+        # Buffers are reused across calls, so the returned tensor is only valid until the next stage() of this shape
+        return self.staging.stage(im, torch.half if self.fp16 else torch.float)
+
+    def warmup(self, imgsz=(1, 3, 640, 640), force=False):
+        # Warmup model by running inference once, on any backend and device if force, i.e. for a new input shape
         warmup_types = self.pt, self.jit, self.onnx, self.engine, self.saved_model, self.pb, self.triton
-        if any(warmup_types) and (self.device.type != 'cpu' or self.triton):
+        warm = any(warmup_types) and (self.device.type != 'cpu' or self.triton or self.optimize)  # optimize compiles
+        if warm or force:
             im = torch.empty(*imgsz, dtype=torch.half if self.fp16 else torch.float, device=self.device)  # input
             for _ in range(2 if self.jit else 1):  #
                 self.forward(im)  # warmup
@@ -611,6 +789,47 @@ class DetectMultiBackend(nn.Module):
         triton = not any(types) and all([any(s in url.scheme for s in ['http', 'grpc']), url.netloc])
         return types + [triton]
 
+    @staticmethod
+    def backend_name(w):
+        # Return the backend name of a model path or URL, i.e. 'onnx', as keyed in utils/autotune.py profiles
+        names = ('pytorch', 'torchscript', 'onnx', 'openvino', 'engine', 'coreml', 'saved_model', 'pb', 'tflite',
+                 'edgetpu', 'tfjs', 'paddle', 'triton')
+        return next((n for n, t in zip(names, DetectMultiBackend._model_type(str(w))) if t), 'pytorch')
+
+    @staticmethod
+    def _ort_session_options(ort, w, options=None):
+        # Return (model path, onnxruntime.SessionOptions) from an options dict, i.e.
+        #   {'intra_op_num_threads': 4, 'inter_op_num_threads': 1, 'graph_optimization_level': 'all',
+        #    'execution_mode': 'sequential', 'enable_mem_pattern': True, 'optimized_model': True}
+        # optimized_model=True (or a path) saves the optimized graph on first load and loads it directly afterwards.
+        # Optimized graphs may contain hardware-specific kernels, so only reuse them on the host that created them
+        options = dict(options or {})
+        so = ort.SessionOptions()
+        levels = {
+            'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL}
+        modes = {'sequential': ort.ExecutionMode.ORT_SEQUENTIAL, 'parallel': ort.ExecutionMode.ORT_PARALLEL}
+        for k in 'intra_op_num_threads', 'inter_op_num_threads':
+            if options.get(k) is not None:
+                setattr(so, k, int(options[k]))
+        if 'graph_optimization_level' in options:
+            so.graph_optimization_level = levels[str(options['graph_optimization_level']).lower()]
+        if 'execution_mode' in options:
+            so.execution_mode = modes[str(options['execution_mode']).lower()]
+        if 'enable_mem_pattern' in options:
+            so.enable_mem_pattern = bool(options['enable_mem_pattern'])
+        f = options.get('optimized_model')
+        if f:
+            f = Path(w).with_name(f'{Path(w).stem}_optimized.onnx') if f is True else Path(f)
+            if f.exists() and f.stat().st_mtime >= Path(w).stat().st_mtime:  # reuse up-to-date optimized model
+                LOGGER.info(f'Loading optimized ONNX Runtime model {f}...')
+                w, so.graph_optimization_level = str(f), ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            else:
+                so.optimized_model_filepath = str(f)  # written during session creation
+        return w, so
+
     @staticmethod
     def _load_metadata(f=Path('path/to/meta.yaml')):
         # Load metadata from meta.yaml if it exists
@@ -629,6 +848,9 @@ class AutoShape(nn.Module):
     classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
     max_det = 1000  # maximum number of detections per image
     amp = False  # Automatic Mixed Precision (AMP) inference
+    buckets = 0  # list inputs: max inference shapes grouped by aspect ratio, 0 to pad all to the largest shape
+    cache = None  # (optional utils.cache.ResultCache) reuse NMS outputs of identical or near-identical images
+    max_letterboxes = 8  # inference shapes whose letterbox batch buffers are kept, least recently used evicted
 
     def __init__(self, model, verbose=True):
         super().__init__()
@@ -638,11 +860,23 @@ class AutoShape(nn.Module):
         self.dmb = isinstance(model, DetectMultiBackend)  # DetectMultiBackend() instance
         self.pt = not self.dmb or model.pt  # PyTorch model
         self.model = model.eval()
+        self.letterboxes = OrderedDict()  # {inference shape: LetterboxPreprocessor}, least recently used first
+        self.lock = threading.Lock()  # serializes forward(), letterbox, staging and runtime buffers are per instance
         if self.pt:
             m = self.model.model.model[-1] if self.dmb else self.model.model[-1]  # Detect()
             m.inplace = False  # Detect.inplace=False for safe multithread inference
             m.export = True  # do not output loss values
 
+    def _letterbox(self, shape):
+        # Return the LetterboxPreprocessor of an inference shape, keeping the batch buffers of max_letterboxes shapes
+        if shape not in self.letterboxes:
+            self.letterboxes[shape] = LetterboxPreprocessor(shape, auto=False)
+        self.letterboxes.move_to_end(shape)  # most recently used
+        p = self.letterboxes[shape]
+        while len(self.letterboxes) > self.max_letterboxes:
+            self.letterboxes.popitem(last=False)  # evict least recently used
+        return p
+
     def _apply(self, fn):
         # Apply to(), cpu(), cuda(), half() to model tensors that are not parameters or registered buffers
         self = super()._apply(fn)
@@ -655,7 +889,12 @@ class AutoShape(nn.Module):
         return self
 
     @smart_inference_mode()
-    def forward(self, ims, size=640, augment=False, profile=False):
+    def forward(self, ims, size=640, augment=False, profile=False, cache=True):
+        # Thread-safe inference, concurrent calls on one instance run one at a time as they share reused buffers
+        with self.lock:
+            return self._forward(ims, size, augment, profile, cache)
+
+    def _forward(self, ims, size=640, augment=False, profile=False, cache=True):
         # Inference from various sources. For size(height=640, width=1280), RGB images example inputs are:
         #   file:        ims = 'data/images/zidane.jpg'  # str or PosixPath
         #   URI:             = 'https://ultralytics.com/images/zidane.jpg'
@@ -664,6 +903,7 @@ class AutoShape(nn.Module):
         #   numpy:           = np.zeros((640,1280,3))  # HWC
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
+        # cache=False bypasses self.cache (utils.cache.ResultCache) for this call, a list of bools per image
 
         dt = (Profile(), Profile(), Profile())
         with dt[0]:
@@ -694,50 +934,106 @@ class AutoShape(nn.Module):
                 g = max(size) / max(s)  # gain
                 shape1.append([int(y * g) for y in s])
                 ims[i] = im if im.data.contiguous else np.ascontiguousarray(im)  # update
-            shape1 = [make_divisible(x, self.stride) for x in np.array(shape1).max(0)]  # inf shape
-            x = [letterbox(im, shape1, auto=False)[0] for im in ims]  # pad
-            x = np.ascontiguousarray(np.array(x).transpose((0, 3, 1, 2)))  # stack and BHWC to BCHW
-            x = torch.from_numpy(x).to(p.device).type_as(p) / 255  # uint8 to fp16/32
+            buckets = self._buckets(shape1)  # [(image indices, inference shape)]
 
+        y, keys = [None] * n, [None] * n  # keys[i] None for images that bypass the cache
+        use = [cache] * n if isinstance(cache, bool) else list(cache)  # per-image cache use
+        cache = self.cache if any(use) else None
+        classes = None if self.classes is None else tuple(self.classes)
+        context = self.conf, self.iou, classes, self.agnostic, self.multi_label, self.max_det, augment  # cache key
         with amp.autocast(autocast):
-            # Inference
-            with dt[1]:
-                y = self.model(x, augment=augment)  # forward
-
-            # Post-process
-            with dt[2]:
-                y = non_max_suppression(y if self.dmb else y[0],
-                                        self.conf,
-                                        self.iou,
-                                        self.classes,
-                                        self.agnostic,
-                                        self.multi_label,
-                                        max_det=self.max_det)  # NMS
-                for i in range(n):
-                    scale_boxes(shape1, y[i][:, :4], shape0[i])
-
-            return Detections(ims, y, files, dt, self.names, x.shape)
+            for j, shape1 in buckets:
+                with dt[0]:
+                    x = self._letterbox(shape1).letterbox([ims[i] for i in j])  # pad into reused (b,h,w,3) buffer
+                    if cache:
+                        miss = []
+                        for k, i in enumerate(j):
+                            if not use[i]:
+                                miss.append(k)
+                                continue
+                            keys[i] = cache.key(x[k], *context)
+                            y[i] = cache.get(keys[i])
+                            if y[i] is None:
+                                miss.append(k)
+                            else:  # hit, stored NMS output at shape1
+                                y[i] = y[i].clone()
+                                scale_boxes(shape1, y[i][:, :4], shape0[i])
+                        if not miss:
+                            continue
+                        x, j = (x, j) if len(miss) == len(j) else (x[miss], [j[k] for k in miss])  # infer misses
+                    x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
+                    if self.dmb:
+                        x = self.model.stage(x)  # uint8 to fp16/32 in reused input buffers
+                    else:
+                        x = torch.from_numpy(x).to(p.device).type_as(p) / 255  # uint8 to fp16/32
+
+                # Inference
+                with dt[1]:
+                    yb = self.model(x, augment=augment)  # forward
+
+                # Post-process
+                with dt[2]:
+                    yb = non_max_suppression(yb if self.dmb else yb[0],
+                                             self.conf,
+                                             self.iou,
+                                             self.classes,
+                                             self.agnostic,
+                                             self.multi_label,
+                                             max_det=self.max_det)  # NMS
+                    for i, det in zip(j, yb):
+                        if keys[i] is not None:
+                            cache.put(keys[i], det.clone())
+                        scale_boxes(shape1, det[:, :4], shape0[i])
+                        y[i] = det
+
+            shape = (n, 3, *np.array([s for _, s in buckets]).max(0).tolist())  # largest inference shape
+            return Detections(ims, y, files, dt, self.names, shape)
+
+    def _buckets(self, shape1):
+        # Group images by stride-aligned inference shape, returning [(image indices, (h, w))]. All images share the
+        # largest shape unless self.buckets > 0, then distinct shapes sorted by aspect ratio are split into at most
+        # self.buckets groups padded to their own largest shape, one forward pass each
+        shapes = [tuple(make_divisible(x, self.stride) for x in s) for s in shape1]
+        unique = sorted(set(shapes), key=lambda s: s[0] / s[1])  # by aspect ratio
+        groups = np.array_split(np.arange(len(unique)), min(self.buckets, len(unique)) or 1)
+        merged = {}  # {shape: bucket shape}
+        for g in groups:
+            s = tuple(np.array([unique[k] for k in g]).max(0).tolist())
+            merged.update({unique[k]: s for k in g})
+        buckets = {}
+        for i, s in enumerate(shapes):
+            buckets.setdefault(merged[s], []).append(i)
+        return list(zip(buckets.values(), buckets.keys()))
 
 
 class Detections:
     # YOLOv5 detections class for inference results
     def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None):
         super().__init__()
-        d = pred[0].device  # device
-        gn = [torch.tensor([*(im.shape[i] for i in [1, 0, 1, 0]), 1, 1], device=d) for im in ims]  # normalizations
         self.ims = ims  # list of images as numpy arrays
         self.pred = pred  # list of tensors pred[0] = (xyxy, conf, cls)
         self.names = names  # class names
         self.files = files  # image filenames
         self.times = times  # profiling times
-        self.xyxy = pred  # xyxy pixels
-        self.xywh = [xyxy2xywh(x) for x in pred]  # xywh pixels
-        self.xyxyn = [x / g for x, g in zip(self.xyxy, gn)]  # xyxy normalized
-        self.xywhn = [x / g for x, g in zip(self.xywh, gn)]  # xywh normalized
+        self.xyxy = pred  # xyxy pixels, xywh pixels and xyxyn, xywhn normalized are computed on first access
         self.n = len(self.pred)  # number of images (batch size)
         self.t = tuple(x.t / self.n * 1E3 for x in times)  # timestamps (ms)
         self.s = tuple(shape)  # inference BCHW shape
 
+    def __getattr__(self, k):
+        # Lazily compute box formats on first access, i.e. results.xywhn
+        if k == 'gn':  # normalizations
+            v = [torch.tensor([*(im.shape[i] for i in [1, 0, 1, 0]), 1, 1], device=x.device)
+                 for im, x in zip(self.ims, self.pred)]
+        elif k == 'xywh':
+            v = [xyxy2xywh(x) for x in self.pred]  # xywh pixels
+        elif k in ('xyxyn', 'xywhn'):
+            v = [x / g for x, g in zip(getattr(self, k[:4]), self.gn)]  # normalized
+        else:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{k}'")
+        setattr(self, k, v)  # cache
+        return v
+
     def _run(self, pprint=False, show=False, save=False, crop=False, render=False, labels=True, save_dir=Path('')):
         s, crops = '', []
         for i, (im, pred) in enumerate(zip(self.ims, self.pred)):
@@ -813,6 +1109,43 @@ class Detections:
             setattr(new, k, [pd.DataFrame(x, columns=c) for x in a])
         return new
 
+    def tojson(self, i=None, kind='xyxy', orient='records', decimals=4):
+        # return detections of image i (default all images, as a list) as a JSON string without pandas. Same schema as
+        # results.pandas().xyxy[0].to_json(orient='records'), but values are rounded to `decimals` places instead of
+        # pandas' 10 significant digits. kind is xyxy, xyxyn, xywh or xywhn, orient='columns' returns
+        # {column: [values]} instead of [{column: value}]
+        if i is None:
+            return '[' + ','.join(self.tojson(j, kind, orient, decimals) for j in range(self.n)) + ']'
+        x = getattr(self, kind)[i].float().cpu().numpy()
+        xywh = 'xcenter', 'ycenter', 'width', 'height'
+        cols = xywh if kind.startswith('xywh') else ('xmin', 'ymin', 'xmax', 'ymax')
+        cls = x[:, 5].astype(int).tolist()
+        names = self.names if isinstance(self.names, dict) else dict(enumerate(self.names))
+        if orient == 'columns':
+            d = {c: x[:, j].round(decimals).tolist() for j, c in enumerate(cols + ('confidence', ))}
+            d.update({'class': cls, 'name': [names[c] for c in cls]})
+            return json.dumps(d)
+        q = {c: json.dumps(names[c]) for c in set(cls)}  # quoted names
+        row = '{' + ''.join(f'"{c}":%.{decimals}f,' for c in cols + ('confidence', )) + '"class":%d,"name":%s}'
+        return '[' + ','.join(row % (*r[:5], c, q[c]) for r, c in zip(x.tolist(), cls)) + ']'
+
+    def tobytes(self, i=None, kind='xyxy', msgpack=False):
+        # return detections of image i (default all images) as compact bytes. Default is, per image, a little-endian
+        # uint32 count n followed by (n,6) float32 rows of box, confidence, class. msgpack=True packs
+        # {'names', 'shape', 'detections'} with 'detections' a list of per-image (n,6) float32 row buffers and
+        # 'names' keyed by str(class) as in JSON, since msgpack>=1.0 unpackb() rejects int map keys by default
+        x = getattr(self, kind) if i is None else [getattr(self, kind)[i]]
+        x = [x.float().cpu().numpy().astype('<f4') for x in x]
+        if msgpack:
+            check_requirements('msgpack')
+            import msgpack as mp
+            names = self.names if isinstance(self.names, dict) else dict(enumerate(self.names))
+            return mp.packb({
+                'names': {str(k): v for k, v in names.items()},
+                'shape': list(self.s),
+                'detections': [a.tobytes() for a in x]})
+        return b''.join(np.array(len(a), '<u4').tobytes() + a.tobytes() for a in x)
+
     def tolist(self):
         # return a list of Detections objects, i.e. 'for result in results.tolist():'
         r = range(self.n)  # iterable
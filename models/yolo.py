@@ -8,6 +8,7 @@ Usage:
 
 import argparse
 import contextlib
+import math
 import os
 import platform
 import sys
@@ -40,6 +41,7 @@ class Detect(nn.Module):
     stride = None  # strides computed during build
     dynamic = False  # force grid reconstruction
     export = False  # export mode
+    gate = 0.0  # gated decode objectness threshold, i.e. NMS conf_thres (0 to decode all anchors)
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -54,6 +56,8 @@ class Detect(nn.Module):
         self.inplace = inplace  # use inplace ops (e.g. slice assignment)
 
     def forward(self, x):
+        if self.gate and not (self.training or self.export):
+            return self._forward_gated(x)
         z = []  # inference output
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
@@ -78,6 +82,33 @@ class Detect(nn.Module):
 
         return x if self.training else (torch.cat(z, 1),) if self.export else (torch.cat(z, 1), x)
 
+    def _forward_gated(self, x):
+        # Inference decoding only anchors with objectness > self.gate, output (bs,n,no) padded with zero rows
+        # non_max_suppression(conf_thres >= gate) returns the same detections as for the full (bs,na*ny*nx,no) output
+        g = min(self.gate, 1 - 1E-7)  # gate >= 1 clamped, NMS then keeps nothing as for conf_thres >= 1
+        t = math.log(g / (1 - g))  # objectness threshold as a logit, avoids sigmoid of all anchors
+        b, z = [], []  # image indices, decoded candidates
+        for i in range(self.nl):
+            x[i] = self.m[i](x[i])  # conv
+            bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
+            x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
+            if self.dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+
+            bi, a, gy, gx = (x[i][..., 4] > t).nonzero(as_tuple=True)  # candidates
+            xy, wh, conf, mask = x[i][bi, a, gy, gx].split((2, 2, self.nc + 1, self.no - self.nc - 5), 1)
+            xy = (xy.sigmoid() * 2 + self.grid[i][0, a, gy, gx]) * self.stride[i]  # xy
+            wh = (wh.sigmoid() * 2) ** 2 * self.anchor_grid[i][0, a, gy, gx]  # wh
+            b.append(bi)
+            z.append(torch.cat((xy, wh, conf.sigmoid(), mask), 1))
+
+        b, z = torch.cat(b), torch.cat(z)
+        n = torch.bincount(b, minlength=bs)  # candidates per image
+        j = (nn.functional.one_hot(b, bs).cumsum(0) - 1).gather(1, b[:, None]).squeeze(1)  # row within image
+        y = z.new_zeros((bs, int(n.max()), self.no))
+        y[b, j] = z
+        return y, x
+
     def _make_grid(self, nx=20, ny=20, i=0, torch_1_10=check_version(torch.__version__, '1.10.0')):
         d = self.anchors[i].device
         t = self.anchors[i].dtype
@@ -164,6 +195,8 @@ class BaseModel(nn.Module):
 
 class DetectionModel(BaseModel):
     # YOLOv5 detection model
+    tta = 'loop'  # augmented inference: 'loop' forwards each scale/flip, 'batched' packs them into one forward pass
+
     def __init__(self, cfg='yolov5s.yaml', ch=3, nc=None, anchors=None):  # model, input channels, number of classes
         super().__init__()
         if isinstance(cfg, dict):
@@ -204,8 +237,8 @@ class DetectionModel(BaseModel):
         LOGGER.info('')
 
     def forward(self, x, augment=False, profile=False, visualize=False):
-        if augment:
-            return self._forward_augment(x)  # augmented inference, None
+        if augment:  # augmented inference, None
+            return self._forward_augment_batched(x) if self.tta == 'batched' else self._forward_augment(x)
         return self._forward_once(x, profile, visualize)  # single-scale inference, train
 
     def _forward_augment(self, x):
@@ -219,7 +252,29 @@ class DetectionModel(BaseModel):
             # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
             yi = self._descale_pred(yi, fi, si, img_size)
             y.append(yi)
-        y = self._clip_augmented(y)  # clip augmented tails
+        if not self.model[-1].gate:  # gated outputs are not in grid order
+            y = self._clip_augmented(y)  # clip augmented tails
+        return torch.cat(y, 1), None  # augmented inference, train
+
+    def _forward_augment_batched(self, x):
+        # Augmented inference in a single forward pass: the scaled/flipped copies are padded to the input size and
+        # stacked in one batch, then all outputs are de-scaled, de-flipped and clipped at once
+        b, img_size = x.shape[0], x.shape[-2:]  # batch size, (height, width)
+        s = [1, 0.83, 0.67]  # scales
+        f = [None, 3, None]  # flips (2-ud, 3-lr)
+        x = torch.cat([scale_img(x.flip(fi) if fi else x, si, same_shape=True) for si, fi in zip(s, f)])
+        y = self._forward_once(x)[0]
+        y = y.view(len(s), b, *y.shape[1:])  # (augmentations, batch, anchors, outputs)
+        scale = y.new_tensor(s).view(-1, 1, 1, 1)
+        xy, wh = y[..., :2] / scale, y[..., 2:4] / scale  # de-scale
+        pad = (xy[..., 0] > img_size[1]) | (xy[..., 1] > img_size[0])  # anchors in the padding of scaled copies
+        ud, lr = (y.new_tensor([fi == k for fi in f], dtype=torch.bool).view(-1, 1, 1) for k in (2, 3))
+        xy = torch.stack((torch.where(lr, img_size[1] - xy[..., 0], xy[..., 0]),
+                          torch.where(ud, img_size[0] - xy[..., 1], xy[..., 1])), -1)  # de-flip
+        y = torch.cat((xy, wh, y[..., 4:5].masked_fill(pad[..., None], 0), y[..., 5:]), -1)
+        y = list(y)  # per augmentation
+        if not self.model[-1].gate:  # gated outputs are not in grid order
+            y = self._clip_augmented(y)  # clip augmented tails
         return torch.cat(y, 1), None  # augmented inference, train
 
     def _descale_pred(self, p, flips, scale, img_size):
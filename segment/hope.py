@@ -64,10 +64,17 @@ from models.common import DetectMultiBackend
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, non_max_suppression, print_args, scale_boxes, scale_segments,
-                           strip_optimizer)
+                           split_end2end, strip_optimizer)
 from utils.plots import Annotator, colors, save_one_box
+from utils.autotune import load_profile, other_cpus, set_affinity
+from utils.cache import ResultCache
+from utils.cascade import CascadeGate
+from utils.pipeline import Worker
+from utils.preprocess import LetterboxPreprocessor
+from utils.resolution import ResolutionScheduler
 from utils.segment.general import masks2segments, process_mask, process_mask_native
 from utils.torch_utils import select_device, smart_inference_mode
+from utils.tracing import TRACER
 
 @smart_inference_mode()
 def run(
@@ -99,6 +106,20 @@ def run(
     dnn=False,  # use OpenCV DNN for ONNX inference
     vid_stride=1,  # video frame-rate stride
     retina_masks=False,
+    gated_decode=False,  # decode only anchors with objectness > conf_thres (PyTorch models)
+    img_sizes=None,  # range-adaptive inference sizes, i.e. [192, 256, 320, 416], None for fixed imgsz
+    range_thres=None,  # LiDAR distance (mm) bounds between img_sizes buckets, None for even split of 1000mm
+    marginal_conf=0.0,  # raise the next trigger's size after a best confidence below this
+    cascade_weights=None,  # classifier gate weights, the segmentation model only runs on frames it passes
+    cascade_imgsz=128,  # classifier gate inference size (pixels)
+    cascade_thres=0.3,  # classifier gate positive (hand) probability threshold
+    pipeline=False,  # post-process triggered frames in a worker thread, overlapping the next trigger's inference
+    stream_policy='new',  # stream frames: 'latest' (may repeat), 'new' (captured after the last) or 'all' (queued)
+    trace=False,  # record spans (toggle at runtime with kill -USR1), save Chrome trace JSON on exit
+    threads=None,  # CPU thread count, or 'auto' for the tuned threads and affinity of this host (utils/autotune.py)
+    cache=None,  # result cache mode, 'exact' or 'perceptual', frames matching a cached one skip inference and NMS
+    cache_size=256,  # result cache entries
+    cache_ttl=0.0,  # result cache entry lifetime (seconds), 0 for no expiry
 ):
     lidar.stop()
     source = str(source)
@@ -119,25 +140,66 @@ def run(
 
     # Load model
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    threads = int(threads) if str(threads).isdigit() else threads
+    if threads == 'auto':  # resolved here so that the tuned CPUs are pinned before the model is built
+        w = str(weights[0] if isinstance(weights, list) else weights)
+        threads = load_profile(DetectMultiBackend.backend_name(w)) or 'auto'  # 'auto' again warns if none
+    if isinstance(threads, dict):  # ONNX Runtime/OpenVINO thread pools inherit the CPUs of the loading thread
+        set_affinity(threads.get('affinity'))
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half,
+                               gate=conf_thres if gated_decode else 0.0,
+                               max_buffers=2 * len(img_sizes or []) + 8,  # uint8 + float input buffers per size
+                               threads=threads)
+    if model.threads and model.threads.get('affinity'):  # LiDAR, capture and post-processing on the other CPUs
+        set_affinity(other_cpus(model.threads['affinity']))  # inference thread pins itself in imgRec()
     stride, names, pt = model.stride, model.names, model.pt
+    retina_masks &= not model.end2end  # end-to-end models assemble masks at inference size
     imgsz = check_img_size(imgsz, s=stride)  # check image size
 
     # Dataloader
     bs = 1  # batch_size
+    staging = None if pipeline else model.staging  # reused input buffers, unless frames overlap in the pipeline
+    preprocess = LetterboxPreprocessor(imgsz, stride, auto=pt, device=model.device, half=model.fp16,
+                                       buffers=staging)  # fused, into reused input buffers
     if webcam:
         view_img = check_imshow(warn=True)
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadStreams(source,
+                              img_size=imgsz,
+                              stride=stride,
+                              auto=pt,
+                              vid_stride=vid_stride,
+                              preprocess=False,
+                              policy=stream_policy,
+                              hold=4 if pipeline else 2)  # frames queued for post-processing
         bs = len(dataset)
     elif screenshot:
-        dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
+        dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt, preprocess=False)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride, preprocess=False)
     vid_path, vid_writer = [None] * bs, [None] * bs
 
     # Run inference
+    TRACER.enable(trace).install_signal()  # SIGUSR1 toggles tracing
     model.warmup(imgsz=(1 if pt else bs, 3, *imgsz))  # warmup
-    seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
+    seen, windows, dt = 0, [], (Profile(name='preprocess'), Profile(name='inference'), Profile(name='nms'))
+
+    # Range-adaptive inference size, square buckets with their own preprocessor, all warmed up front
+    scheduler, preprocessors = None, {}
+    if img_sizes:
+        scheduler = ResolutionScheduler(img_sizes, range_thres, stride, marginal=marginal_conf)
+        for i, x in enumerate(scheduler.sizes):
+            preprocessors[i] = LetterboxPreprocessor(x, stride, auto=False, device=model.device, half=model.fp16,
+                                                     buffers=staging)
+            model.warmup(imgsz=(1 if pt else bs, 3, x, x), force=True)  # first frame of a bucket is not cold
+
+    # Two-stage cascade, low-resolution classifier gate before the segmentation model
+    cascade = CascadeGate(cascade_weights, device, cascade_imgsz, cascade_thres, half=half) if cascade_weights else None
+
+    # Result cache, a static scene from the fixed camera reuses the last inference and NMS output
+    results_cache = ResultCache(cache, cache_size, cache_ttl) if cache else None
+
+    # Pipelined post-processing, bounded and in trigger order
+    post = Worker(lambda x: imgPost(*x), maxsize=2) if pipeline else None
     
     hope = lidar.iter_measures(max_buf_meas=30000)
 
@@ -147,9 +209,9 @@ def run(
     try:
         #print('Recording measurments... Press Crl+C to stop.')
         imgRecModel = ImgRecModel(weights, source, data, imgsz, conf_thres, iou_thres, max_det, device, view_img, save_txt, save_conf, save_crop, nosave, classes, agnostic_nms, augment, visualize, update, project, name, exist_ok, line_thickness, hide_labels, hide_conf, half, dnn, vid_stride, retina_masks)
-        imgRecThread = threading.Thread(target=imgRec, args=(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names, windows, save_img), daemon=True)
+        imgRecThread = threading.Thread(target=imgRec, args=(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names, windows, save_img, preprocess), kwargs={'cache': results_cache}, daemon=True)
                 
-        for measurment in hope:
+        for measurment in TRACER.iter(hope, 'lidar wait'):
             
             angle = measurment[2]
             dis = measurment[3]
@@ -158,7 +220,8 @@ def run(
                 #print("made it in big")
                 if (not( imgRecThread.is_alive() )):
                     #print ("Creating new thread!")
-                    imgRecThread = threading.Thread(target=imgRec, args=(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names, windows, save_img), daemon=True)
+                    bucket = scheduler(dis) if scheduler else None  # inference size for this range
+                    imgRecThread = threading.Thread(target=imgRec, args=(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names, windows, save_img, preprocessors.get(bucket, preprocess), scheduler, bucket, cascade, post), kwargs={'cache': results_cache}, daemon=True)
                     imgRecThread.start()
 
                     """ Que and attempt to show detected frames
@@ -193,32 +256,66 @@ def run(
     except KeyboardInterrupt:
         print('\nStopping.')
         lidar.stop()
-
-def imgRec(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names, windows, save_img):
+        if scheduler:
+            scheduler.summary()
+        if post:
+            post.close()  # finish pending frames
+        if cascade:
+            cascade.summary()
+            n = max(cascade.seen - cascade.rejected, 1)  # frames that reached the segmentation model
+            LOGGER.info('Segmentation stage: %.1fms pre-process, %.1fms inference, %.1fms NMS per frame' %
+                        tuple(x.t / n * 1E3 for x in dt))
+        if results_cache:
+            LOGGER.info(f'Result cache: {results_cache.stats()}')
+        if TRACER.rings:  # traced at any point of the run
+            TRACER.summary()
+            LOGGER.info(f"Trace saved to {colorstr('bold', TRACER.export(save_dir / 'trace.json'))}")
+
+def imgRec(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names, windows, save_img, preprocess, scheduler=None, bucket=None, cascade=None, post=None, cache=None):
     #print ("Img Rec!")
-    for path, im, im0s, vid_cap, s in dataset:
+    set_affinity(model.threads and model.threads.get('affinity'))  # tuned inference CPUs, see utils/autotune.py
+    for path, im, im0s, vid_cap, s in TRACER.iter(dataset, 'frame wait'):
         #print ("Whatever works")
         if big:
             #print("Is BIG")
             return
 
+        if cascade and not cascade(im0s):  # rejected by the classifier gate, skip the segmentation model
+            LOGGER.info(f'{s}cascade gate {cascade.p:.2f} <= {cascade.thres}, {sum(x.dt for x in cascade.dt) * 1E3:.1f}ms')
+            print("Nothing Detected")
+            return
+
+        key, hit = None, None
         with dt[0]:
-            im = torch.from_numpy(im).to(model.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
-            if len(im.shape) == 3:
-                im = im[None]  # expand for batch dim
+            im = preprocess(im0s)  # letterbox, BGR to RGB, BCHW, uint8 to fp16/32 and 0.0 - 1.0 in one pass
+            if cache:  # keyed on the letterboxed uint8 frames
+                key = tuple(cache.key(x) for x in preprocess.buf[:len(im)])
+                hit = cache.get(key)
 
         #print ("DT 0 Completed")
         # Inference
         with dt[1]:
-            imgRecModel.visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if imgRecModel.visualize else False
-            pred, proto = model(im, augment=imgRecModel.augment, visualize=imgRecModel.visualize)[:2]
+            if hit is None:
+                imgRecModel.visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if imgRecModel.visualize else False
+                pred, proto = model(im, augment=imgRecModel.augment, visualize=imgRecModel.visualize)[:2]
+                if post and (model.engine or model.onnx and model.io_binding):  # reused by the next forward()
+                    proto = proto.clone()
 
         #print ("DT 1 Completed")
         # NMS
         with dt[2]:
-            pred = non_max_suppression(pred, imgRecModel.conf_thres, imgRecModel.iou_thres, imgRecModel.classes, imgRecModel.agnostic_nms, max_det=imgRecModel.max_det, nm=32)
+            if hit is not None:  # cached NMS output and protos (or end-to-end masks) at inference size
+                pred, proto = [x.clone() for x in hit[0]], hit[1]
+            elif model.end2end:  # NMS and masks in model, proto holds the (n,h,w) masks at inference size
+                pred, proto = split_end2end(pred, len(im), imgRecModel.conf_thres, imgRecModel.classes, masks=proto)
+            else:
+                pred = non_max_suppression(pred, imgRecModel.conf_thres, imgRecModel.iou_thres, imgRecModel.classes, imgRecModel.agnostic_nms, max_det=imgRecModel.max_det, nm=32)
+            if cache and hit is None:
+                cache.put(key, ([x.clone() for x in pred], proto.clone()))
+
+        if scheduler:  # best confidence and pre-process + inference + NMS latency for this size
+            conf = max((float(det[:, 4].max()) for det in pred if len(det)), default=0.0)
+            scheduler.update(bucket, conf, sum(x.dt for x in dt) * 1E3)
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
@@ -226,25 +323,37 @@ def imgRec(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names,
         # Process predictions
         
         #print ("DT 2 Completed")
-        for i, det in enumerate(pred):  # per image
-            #print ("Image read")
-
-            seen += 1
-            if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                s += f'{i}: '
-            else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-
-            #print ("Image aquired.")
-            p = Path(p)  # to Path
-            save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
-            imc = im0.copy() if imgRecModel.save_crop else im0  # for save_crop
-            annotator = Annotator(im0, line_width=imgRecModel.line_thickness, example=str(names))
-            if len(det):
-                if imgRecModel.retina_masks:
+        if post:  # annotate, report and write in the post-processing worker, the next trigger can start now
+            post.put((imgRecModel, dataset, path, im, im0s, pred, proto, s, seen, webcam, save_dir, names, save_img, model, dt))
+            return
+        return imgPost(imgRecModel, dataset, path, im, im0s, pred, proto, s, seen, webcam, save_dir, names, save_img, model, dt)
+
+
+def imgPost(imgRecModel, dataset, path, im, im0s, pred, proto, s, seen, webcam, save_dir, names, save_img, model, dt):
+    # Per-image mask processing, annotation, saving and serial report of one triggered frame
+    for i, det in enumerate(pred):  # per image
+        #print ("Image read")
+
+        seen += 1
+        if webcam:  # batch_size >= 1
+            p, im0, frame = path[i], im0s[i].copy(), dataset.count
+            s += f'{i}: '
+        else:
+            p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
+
+        #print ("Image aquired.")
+        p = Path(p)  # to Path
+        save_path = str(save_dir / p.name)  # im.jpg
+        txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
+        s += '%gx%g ' % im.shape[2:]  # print string
+        imc = im0.copy() if imgRecModel.save_crop else im0  # for save_crop
+        annotator = Annotator(im0, line_width=imgRecModel.line_thickness, example=str(names))
+        if len(det):
+            with TRACER.span('masks'):
+                if model.end2end:
+                    masks = proto[i]  # HWC, assembled in model
+                    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()  # rescale boxes to im0 size
+                elif imgRecModel.retina_masks:
                     # scale bbox first the crop masks
                     det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()  # rescale boxes to im0 size
                     masks = process_mask_native(proto[i], det[:, 6:], det[:, :4], im0.shape[:2])  # HWC
@@ -252,71 +361,74 @@ def imgRec(imgRecModel, dataset, big, dt, model, seen, webcam, save_dir, names,
                     masks = process_mask(proto[i], det[:, 6:], det[:, :4], im.shape[2:], upsample=True)  # HWC
                     det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()  # rescale boxes to im0 size
 
-                # Segments
-                if imgRecModel.save_txt:
-                    segments = [
-                        scale_segments(im0.shape if imgRecModel.retina_masks else im.shape[2:], x, im0.shape, normalize=True)
-                        for x in reversed(masks2segments(masks))]
+            # Segments
+            if imgRecModel.save_txt:
+                segments = [
+                    scale_segments(im0.shape if imgRecModel.retina_masks else im.shape[2:], x, im0.shape, normalize=True)
+                    for x in reversed(masks2segments(masks))]
 
-                # Print results
-                for c in det[:, 5].unique():
-                    n = (det[:, 5] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+            # Print results
+            for c in det[:, 5].unique():
+                n = (det[:, 5] == c).sum()  # detections per class
+                s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
-                # Mask plotting
+            # Mask plotting (uint8 in-place blending on CPU, float compositing on GPU)
+            with TRACER.span('annotate'):
                 annotator.masks(
                     masks,
                     colors=[colors(x, True) for x in det[:, 5]],
-                    im_gpu=torch.as_tensor(im0, dtype=torch.float16).to(imgRecModel.device).permute(2, 0, 1).flip(0).contiguous() /
+                    im_gpu=None if model.device.type == 'cpu' else
+                    torch.as_tensor(im0, dtype=torch.float16).to(model.device).permute(2, 0, 1).flip(0).contiguous() /
                     255 if imgRecModel.retina_masks else im[i])
 
-                # Write results
-                for j, (*xyxy, conf, cls) in enumerate(reversed(det[:, :6])):
-                    if imgRecModel.save_txt:  # Write to file
-                        seg = segments[j].reshape(-1)  # (n,2) to (n*2)
-                        line = (cls, *seg, conf) if imgRecModel.save_conf else (cls, *seg)  # label format
-                        with open(f'{txt_path}.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or imgRecModel.save_crop or imgRecModel.view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
-                        label = None if imgRecModel.hide_labels else (names[c] if imgRecModel.hide_conf else f'{names[c]} {conf:.2f}')
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                        # annotator.draw.polygon(segments[j], outline=colors(c, True), width=3)
-                    if imgRecModel.save_crop:
-                        save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-            
-            #print ("Image broken up")
-            # Stream results
-            im0 = annotator.result()
-            cv2.destroyAllWindows()
-            
-            """ Que variables
-            q.put(p)
-            q.put(im0)
-            q.put(det)
-            q.put(s)
-            q.put(True)
-            """
-            
-            LOGGER.info(f"{s}{'' if len(det) else 'w'}{dt[1].dt * 1E3:.1f}ms")
-            out = (f"{s}{'' if len(det) else 'w'}")
-            stuff = out.split(" ")
-            print(len(stuff))
-            if(len(stuff) <= 3):
-                print("Nothing Detected")
-                return
-            else:
-                out = stuff[3][:-1]
-                ans = out + " Dectected"
-                print(ans)
-                try:
+            # Write results
+            for j, (*xyxy, conf, cls) in enumerate(reversed(det[:, :6])):
+                if imgRecModel.save_txt:  # Write to file
+                    seg = segments[j].reshape(-1)  # (n,2) to (n*2)
+                    line = (cls, *seg, conf) if imgRecModel.save_conf else (cls, *seg)  # label format
+                    with open(f'{txt_path}.txt', 'a') as f:
+                        f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+                if save_img or imgRecModel.save_crop or imgRecModel.view_img:  # Add bbox to image
+                    c = int(cls)  # integer class
+                    label = None if imgRecModel.hide_labels else (names[c] if imgRecModel.hide_conf else f'{names[c]} {conf:.2f}')
+                    annotator.box_label(xyxy, label, color=colors(c, True))
+                    # annotator.draw.polygon(segments[j], outline=colors(c, True), width=3)
+                if imgRecModel.save_crop:
+                    save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+        
+        #print ("Image broken up")
+        # Stream results
+        im0 = annotator.result()
+        cv2.destroyAllWindows()
+        
+        """ Que variables
+        q.put(p)
+        q.put(im0)
+        q.put(det)
+        q.put(s)
+        q.put(True)
+        """
+        
+        LOGGER.info(f"{s}{'' if len(det) else 'w'}{dt[1].dt * 1E3:.1f}ms")
+        out = (f"{s}{'' if len(det) else 'w'}")
+        stuff = out.split(" ")
+        print(len(stuff))
+        if(len(stuff) <= 3):
+            print("Nothing Detected")
+            return
+        else:
+            out = stuff[3][:-1]
+            ans = out + " Dectected"
+            print(ans)
+            try:
+                with TRACER.span('serial write'):
                     sers = ser.Serial("/dev/ttyUSB1", 115200)
                     sers.write(ans)
-                except Exception as e:
-                    print(e)
-            print("BREAK!")
-            return
+            except Exception as e:
+                print(e)
+        print("BREAK!")
+        return
 
 def parse_opt():
     parser = argparse.ArgumentParser()
@@ -348,6 +460,20 @@ def parse_opt():
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
     parser.add_argument('--retina-masks', action='store_true', help='whether to plot masks in native resolution')
+    parser.add_argument('--gated-decode', action='store_true', help='decode only anchors with obj > conf-thres')
+    parser.add_argument('--img-sizes', nargs='+', type=int, help='range-adaptive inference sizes, i.e. 192 256 320 416')
+    parser.add_argument('--range-thres', nargs='+', type=float, help='LiDAR distance (mm) bounds between --img-sizes')
+    parser.add_argument('--marginal-conf', type=float, default=0.0, help='raise next size below this best confidence')
+    parser.add_argument('--cascade-weights', type=str, default=None, help='classifier gate model path')
+    parser.add_argument('--cascade-imgsz', type=int, default=128, help='classifier gate inference size (pixels)')
+    parser.add_argument('--cascade-thres', type=float, default=0.3, help='classifier gate hand probability threshold')
+    parser.add_argument('--pipeline', action='store_true', help='post-process frames in a worker thread')
+    parser.add_argument('--stream-policy', default='new', choices=['latest', 'new', 'all'], help='stream frames')
+    parser.add_argument('--trace', action='store_true', help='record spans, save Chrome trace JSON on exit')
+    parser.add_argument('--threads', type=str, default=None, help="CPU threads, 'auto' for autotune profile")
+    parser.add_argument('--cache', choices=['exact', 'perceptual'], help='reuse results of repeated frames')
+    parser.add_argument('--cache-size', type=int, default=256, help='result cache entries')
+    parser.add_argument('--cache-ttl', type=float, default=0.0, help='result cache entry lifetime (s), 0 for none')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     #print_args(vars(opt))
@@ -0,0 +1,157 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+CPU thread-count and core-affinity autotuning, tuned profiles are saved per host and backend
+
+Usage:
+    $ python -m utils.autotune --weights yolov5n.onnx --imgsz 320              # sweep, save best profile
+    $ python -m utils.autotune --weights yolov5n.onnx --imgsz 320 --reserve 1  # keep 1 core for LiDAR/capture
+    $ python segment/hope.py --weights yolov5n-seg.onnx --threads auto         # apply the tuned profile
+"""
+
+import argparse
+import multiprocessing
+import os
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.general import CONFIG_DIR, LOGGER, colorstr, print_args, yaml_load, yaml_save
+
+PROFILES = CONFIG_DIR / 'autotune.yaml'  # {host: {backend: profile}}
+PREFIX = colorstr('AutoTune: ')
+
+
+def cpus():
+    # Return the CPUs this process may run on
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+
+def set_affinity(cpu_ids=None):
+    # Pin the calling thread (and threads it creates afterwards) to cpu_ids, None for no-op. Linux only
+    if cpu_ids and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_ids)
+
+
+def other_cpus(cpu_ids):
+    # Return the CPUs of the machine not in cpu_ids, i.e. for threads that should stay off the inference cores
+    return [i for i in range(os.cpu_count() or 1) if i not in set(cpu_ids)]
+
+
+def load_profile(backend, host=None, file=PROFILES):
+    # Return the tuned profile dict of backend on host (default this host), or None
+    if not Path(file).is_file():
+        return None
+    return (yaml_load(file) or {}).get(host or platform.node(), {}).get(backend)
+
+
+def save_profile(backend, profile, host=None, file=PROFILES):
+    # Save a tuned profile of backend on host (default this host)
+    d = (yaml_load(file) if Path(file).is_file() else None) or {}
+    d.setdefault(host or platform.node(), {})[backend] = profile
+    Path(file).parent.mkdir(parents=True, exist_ok=True)
+    yaml_save(file, d)
+
+
+def apply_profile(profile, affinity=True):
+    # Apply the process-level parts of a profile: torch intra-op threads and, if affinity, affinity of the calling
+    # thread. Runtime-specific parts (ONNX Runtime, OpenVINO, TFLite threads) are applied by DetectMultiBackend
+    if profile:
+        if affinity:
+            set_affinity(profile.get('affinity'))
+        if profile.get('threads'):
+            torch.set_num_threads(profile['threads'])
+
+
+def candidates(backend, reserve=0):
+    # Return profiles to sweep: thread counts x affinity layouts (all CPUs, lowest or highest n CPUs)
+    ids = cpus()
+    ids = ids[:len(ids) - reserve] if reserve else ids  # leave the highest `reserve` CPUs to other threads
+    pinning = hasattr(os, 'sched_setaffinity')
+    profiles = []
+    for n in range(1, len(ids) + 1):
+        layouts = [ids if reserve else None] + ([ids[:n], ids[-n:]] if pinning else [])
+        for affinity in {tuple(x or ()): x for x in layouts}.values():  # unique
+            for streams in ((1, 2) if backend == 'openvino' and n > 1 else (None, )):
+                p = {'threads': n, 'affinity': list(affinity) if affinity else None}
+                if backend == 'onnx':
+                    p['inter_op_threads'] = 1
+                if streams:
+                    p['streams'] = streams
+                profiles.append(p)
+    return profiles
+
+
+def measure(weights, profile, imgsz=640, batch_size=1, iters=50, warmup=10, device=torch.device('cpu')):
+    # Return inference latency (ms) percentiles (p50, p90) of weights with profile applied
+    from models.common import DetectMultiBackend  # scoped to avoid circular import
+    ids = cpus()
+    apply_profile(profile)  # pin before the model is built, runtime thread pools inherit the creating thread's CPUs
+    try:
+        model = DetectMultiBackend(weights, device=device, threads=profile)
+        im = torch.zeros(batch_size, 3, imgsz, imgsz, device=device)
+        for _ in range(warmup):
+            model(im)
+        t = np.zeros(iters)
+        for i in range(iters):
+            ti = time.perf_counter()
+            model(im)
+            t[i] = time.perf_counter() - ti
+    finally:
+        set_affinity(ids)  # restore for the next candidate
+    return tuple(np.percentile(t * 1E3, (50, 90)))
+
+
+def autotune(weights='yolov5s.pt', imgsz=640, batch_size=1, iters=50, warmup=10, reserve=0, save=True):
+    # Sweep thread counts and affinity layouts on CPU, return (and save) the profile with the lowest p90 latency
+    from models.common import DetectMultiBackend  # scoped to avoid circular import
+    backend = DetectMultiBackend.backend_name(weights)
+    affinity, threads = cpus(), torch.get_num_threads()
+    LOGGER.info(f'{PREFIX}Tuning {backend} {weights} at {imgsz} on {platform.node()}, CPUs {affinity}')
+    results = []
+    try:
+        for p in candidates(backend, reserve):
+            try:  # fresh process per candidate, torch OpenMP workers keep the CPUs of the first parallel region
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    p50, p90 = pool.submit(measure, weights, p, imgsz, batch_size, iters, warmup).result()
+            except Exception as e:
+                LOGGER.warning(f'{PREFIX}WARNING ⚠️ {p} failed: {e}')
+                continue
+            finally:
+                set_affinity(affinity)  # restore between candidates
+                torch.set_num_threads(threads)
+            results.append((p90, p50, p))
+            LOGGER.info(f"{PREFIX}{str(p):<72s} p50 {p50:8.2f}ms  p90 {p90:8.2f}ms")
+    finally:
+        set_affinity(affinity)
+        torch.set_num_threads(threads)
+    assert results, f'{PREFIX}no profile could be measured'
+    p90, p50, best = min(results, key=lambda x: x[0])
+    best.update(p50=round(p50, 2), p90=round(p90, 2), imgsz=imgsz, batch_size=batch_size)
+    LOGGER.info(f'{PREFIX}Best {best}')
+    if save:
+        save_profile(backend, best)
+        LOGGER.info(f'{PREFIX}Saved to {PROFILES}')
+    return best
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='yolov5s.pt', help='model path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size')
+    parser.add_argument('--iters', type=int, default=50, help='timed inferences per candidate')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed inferences per candidate')
+    parser.add_argument('--reserve', type=int, default=0, help='CPUs left free for other threads, i.e. LiDAR/capture')
+    parser.add_argument('--nosave', action='store_true', help='do not save the best profile')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    autotune(opt.weights, opt.imgsz, opt.batch_size, opt.iters, opt.warmup, opt.reserve, save=not opt.nosave)
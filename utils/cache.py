@@ -0,0 +1,86 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Content-addressed inference result cache, keyed by a hash of the preprocessed input image
+
+Usage:
+    from utils.cache import ResultCache
+    model = torch.hub.load('ultralytics/yolov5', 'yolov5s')
+    model.cache = ResultCache(mode='perceptual', size=256, ttl=10)  # AutoShape
+    results = model(im)  # repeated or near-identical images skip inference and NMS
+    results = model(im, cache=False)  # bypass
+    print(model.cache.stats())
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+class ResultCache:
+    # LRU cache of per-image NMS outputs with size and TTL eviction. mode='exact' keys on a hash of the preprocessed
+    # input bytes, mode='perceptual' on a difference hash of a hash_size x hash_size grayscale downsample, so
+    # near-identical frames, i.e. sensor noise or re-encoded uploads of one image, share an entry
+    def __init__(self, mode='exact', size=1024, ttl=0.0, hash_size=16):
+        assert mode in ('exact', 'perceptual'), f"invalid cache mode '{mode}', valid modes are 'exact', 'perceptual'"
+        self.mode = mode
+        self.size = size  # max entries
+        self.ttl = ttl  # entry lifetime in seconds, 0 for no expiry
+        self.hash_size = hash_size  # perceptual hash side, hash_size ** 2 bits
+        self.entries = OrderedDict()  # {key: (time, value)}, least recently used first
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions, self.expired = 0, 0, 0, 0
+
+    def key(self, im, *context):
+        # Return the key of a preprocessed HWC uint8 image, with context (i.e. NMS settings) that must also match
+        if self.mode == 'exact':
+            h = hashlib.blake2b(np.ascontiguousarray(im).data, digest_size=16).digest()
+        else:  # difference hash, sign of horizontal gradients of a (n, n + 1) grayscale thumbnail
+            n = self.hash_size
+            g = cv2.resize(im, (n + 1, n), interpolation=cv2.INTER_AREA)
+            g = g.mean(2) if g.ndim == 3 else g
+            h = np.packbits(g[:, 1:] > g[:, :-1]).tobytes()
+        return (h, im.shape, *context)
+
+    def get(self, key):
+        # Return cached value of key or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and self.ttl and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = time.time(), value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        # Return cache counters
+        with self.lock:
+            n = self.hits + self.misses
+            return {
+                'mode': self.mode,
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / n, 4) if n else 0.0,
+                'evictions': self.evictions,
+                'expired': self.expired}
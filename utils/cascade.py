@@ -0,0 +1,56 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Two-stage cascade: a small low-resolution classifier decides whether the main model runs on a frame
+
+Usage - train a gate classifier from a detection backbone with an early cutoff:
+    $ python classify/train.py --model yolov5n.pt --cutoff 6 --img 128 --data hands
+"""
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as T
+
+from models.common import DetectMultiBackend
+from utils.augmentations import IMAGENET_MEAN, IMAGENET_STD, LetterBox, ToTensor
+from utils.general import LOGGER, Profile
+
+
+class CascadeGate:
+    # Classifier gate, i.e. gate = CascadeGate('hands-cls.pt', device); if gate(im0s): run the segmentation model
+    def __init__(self, weights, device=torch.device('cpu'), imgsz=128, thres=0.3, classes=None, half=False):
+        self.model = DetectMultiBackend(weights, device=device, fp16=half)
+        # whole frame letterboxed, not center-cropped, so hands near the left and right edges of wide frames are seen
+        self.transforms = T.Compose([LetterBox(imgsz), ToTensor(), T.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
+        names = self.model.names
+        if classes is None:  # default positives are the classes named like 'hand', else class 0
+            classes = [i for i, x in names.items() if 'hand' in str(x).lower()] or [0]
+        self.classes = list(classes)  # positive class indices, probabilities are summed
+        self.thres = thres  # run the main model above this positive probability
+        self.p = 0.0  # last positive probability
+        self.seen, self.rejected = 0, 0
+        self.dt = (Profile(), Profile())  # pre-process, inference
+        self.model.warmup(imgsz=(1, 3, imgsz, imgsz))
+        LOGGER.info(f"Cascade gate: {weights} at {imgsz}px, positive classes {[names[i] for i in self.classes]} "
+                    f'> {thres}')
+
+    def __call__(self, ims):
+        # Return True if any of the BGR HWC frame(s) passes the gate
+        ims = ims if isinstance(ims, (list, tuple)) else [ims]
+        with self.dt[0]:
+            im = torch.stack([self.transforms(x) for x in ims]).to(self.model.device)
+            im = im.half() if self.model.fp16 else im.float()
+        with self.dt[1]:
+            p = F.softmax(self.model(im), dim=1)[:, self.classes].sum(1)  # positive probability per frame
+        self.p = float(p.max())
+        self.seen += 1
+        self.rejected += self.p <= self.thres
+        return self.p > self.thres
+
+    def summary(self):
+        # Log the early-rejected fraction and mean gate latency per frame
+        n = max(self.seen, 1)
+        t = tuple(x.t / n * 1E3 for x in self.dt)  # ms per frame
+        s = f'Cascade gate: {self.rejected}/{self.seen} frames rejected early ({self.rejected / n:.1%}), ' \
+            f'{t[0]:.1f}ms pre-process, {t[1]:.1f}ms inference per frame'
+        LOGGER.info(s)
+        return s
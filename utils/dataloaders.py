@@ -12,10 +12,12 @@ import os
 import random
 import shutil
 import time
+from collections import deque
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from threading import Thread
+from queue import Queue
+from threading import Condition, Event, Thread
 from urllib.parse import urlparse
 
 import numpy as np
@@ -33,6 +35,7 @@ from utils.augmentations import (Albumentations, augment_hsv, classify_albumenta
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset, check_requirements,
                            check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy,
                            xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
+from utils.preprocess import LetterboxPreprocessor
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -189,7 +192,7 @@ class _RepeatSampler:
 
 class LoadScreenshots:
     # YOLOv5 screenshot dataloader, i.e. `python detect.py --source "screen 0 100 100 512 256"`
-    def __init__(self, source, img_size=640, stride=32, auto=True, transforms=None):
+    def __init__(self, source, img_size=640, stride=32, auto=True, transforms=None, preprocess=True):
         # source = [screen_number left top width height] (pixels)
         check_requirements('mss')
         import mss
@@ -205,6 +208,7 @@ class LoadScreenshots:
         self.img_size = img_size
         self.stride = stride
         self.transforms = transforms
+        self.preprocess = preprocess  # False yields raw im0 as im, i.e. for utils.preprocess.LetterboxPreprocessor
         self.auto = auto
         self.mode = 'stream'
         self.frame = 0
@@ -228,6 +232,8 @@ class LoadScreenshots:
 
         if self.transforms:
             im = self.transforms(im0)  # transforms
+        elif not self.preprocess:
+            im = im0  # raw frame for fused preprocessing
         else:
             im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
             im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
@@ -238,7 +244,19 @@ class LoadScreenshots:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    # workers > 0 decodes ahead: images in a thread pool, video frames in a dedicated thread, up to prefetch pending
+    # batch > 1 yields lists of up to batch images, or of consecutive frames of one video
+    def __init__(self,
+                 path,
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 preprocess=True,
+                 workers=0,
+                 prefetch=8,
+                 batch=1):
         if isinstance(path, str) and Path(path).suffix == '.txt':  # *.txt file with img/vid/dir on each line
             path = Path(path).read_text().rsplit()
         files = []
@@ -265,7 +283,12 @@ class LoadImages:
         self.mode = 'image'
         self.auto = auto
         self.transforms = transforms  # optional
+        self.preprocess = preprocess  # False yields raw im0 as im, i.e. for utils.preprocess.LetterboxPreprocessor
         self.vid_stride = vid_stride  # video frame-rate stride
+        self.workers = workers  # decode-ahead threads, 0 for synchronous decode
+        self.prefetch = max(prefetch, batch)  # decoded frames pending ahead of the consumer
+        self.batch = batch
+        self.pending = None  # frame read past the end of the last batch
         if any(videos):
             self._new_video(videos[0])  # new video
         else:
@@ -275,47 +298,115 @@ class LoadImages:
 
     def __iter__(self):
         self.count = 0
+        self.pending = None
+        self.reader = self._read()
         return self
 
     def __next__(self):
-        if self.count == self.nf:
+        x = self.pending or next(self.reader, None)
+        if x is None:
             raise StopIteration
-        path = self.files[self.count]
-
-        if self.video_flag[self.count]:
-            # Read video
+        batch, self.pending = [x], None
+        while len(batch) < self.batch:  # images only, or frames of one video
+            x = next(self.reader, None)
+            if x is None:
+                break
+            if x[0] != batch[0][0] and (self.video_flag[x[0]] or self.video_flag[batch[0][0]]):
+                self.pending = x  # first frame of the next file
+                break
+            batch.append(x)
+
+        i, cap, frame, _ = batch[-1]
+        path = self.files[i]
+        if self.video_flag[i]:
             self.mode = 'video'
-            for _ in range(self.vid_stride):
-                self.cap.grab()
-            ret_val, im0 = self.cap.retrieve()
-            while not ret_val:
-                self.count += 1
+            if cap is not self.cap:  # new video
                 self.cap.release()
-                if self.count == self.nf:  # last video
-                    raise StopIteration
-                path = self.files[self.count]
-                self._new_video(path)
-                ret_val, im0 = self.cap.read()
-
-            self.frame += 1
-            # im0 = self._cv2_rotate(im0)  # for use if cv2 autorotation is False
-            s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.frames}) {path}: '
-
+                self.cap, self.frames = cap, int(cap.get(cv2.CAP_PROP_FRAME_COUNT) / self.vid_stride)
+            self.count, self.frame = i, frame
+            frames = f'{batch[0][2]}-{frame}' if len(batch) > 1 else frame
+            s = f'video {i + 1}/{self.nf} ({frames}/{self.frames}) {path}: '
         else:
-            # Read image
-            self.count += 1
-            im0 = cv2.imread(path)  # BGR
-            assert im0 is not None, f'Image Not Found {path}'
-            s = f'image {self.count}/{self.nf} {path}: '
-
+            self.mode = 'image'
+            self.count = i + 1
+            for j, *_, im0 in batch:
+                assert im0 is not None, f'Image Not Found {self.files[j]}'
+            s = f'image {batch[0][0] + 1}-{i + 1}/{self.nf} {Path(path).parent}: ' if len(batch) > 1 else \
+                f'image {self.count}/{self.nf} {path}: '
+
+        im0 = [x[3] for x in batch]
         if self.transforms:
-            im = self.transforms(im0)  # transforms
+            im = [self.transforms(x) for x in im0]  # transforms
+        elif not self.preprocess:
+            im = im0  # raw frames for fused preprocessing
         else:
-            im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
-            im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-            im = np.ascontiguousarray(im)  # contiguous
-
-        return path, im, im0, self.cap, s
+            im = [letterbox(x, self.img_size, stride=self.stride, auto=self.auto)[0] for x in im0]  # padded resize
+            im = [np.ascontiguousarray(x.transpose((2, 0, 1))[::-1]) for x in im]  # HWC to CHW, BGR to RGB
+
+        if self.batch == 1:
+            return path, im[0], im0[0], self.cap, s
+        return [self.files[x[0]] for x in batch], im, im0, self.cap, s  # lists
+
+    def _read(self):
+        # Yield (file index, cap, frame number, im0) for every image and video frame, decoded ahead if self.workers
+        ni = self.video_flag.count(False)
+        yield from ((i, None, 0, im0) for i, im0 in enumerate(self._read_images(self.files[:ni])))
+        for i in range(ni, self.nf):
+            cap = self.cap if i == ni and self.frame == 0 else cv2.VideoCapture(self.files[i])  # first opened in init
+            for frame, im0 in enumerate(self._read_video(cap), 1):
+                # im0 = self._cv2_rotate(im0)  # for use if cv2 autorotation is False
+                yield i, cap, frame, im0
+
+    def _read_images(self, files):
+        # Yield BGR images, read by a pool of self.workers threads with at most self.prefetch pending
+        if not self.workers:
+            yield from map(cv2.imread, files)
+            return
+        with ThreadPool(self.workers) as pool:
+            pending = deque()
+            for f in files:
+                pending.append(pool.apply_async(cv2.imread, (f, )))  # cv2 releases the GIL while decoding
+                if len(pending) > self.prefetch:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def _read_video(self, cap):
+        # Yield every vid_stride-th frame of cap, decoded in a dedicated thread with self.prefetch queued if workers
+
+        def read():
+            for _ in range(self.vid_stride):
+                cap.grab()
+            success, im = cap.retrieve()
+            return im if success else None
+
+        if not self.workers:
+            im = read()
+            while im is not None:
+                yield im
+                im = read()
+            return
+        q, stop = Queue(self.prefetch), Event()
+
+        def decode():
+            while not stop.is_set():
+                im = read()
+                q.put(im)
+                if im is None:
+                    return
+
+        thread = Thread(target=decode, daemon=True)
+        thread.start()
+        try:
+            im = q.get()
+            while im is not None:
+                yield im
+                im = q.get()
+        finally:  # end of video or consumer stopped early
+            stop.set()
+            while thread.is_alive():
+                with contextlib.suppress(Exception):
+                    q.get(timeout=0.1)  # unblock a pending put()
 
     def _new_video(self, path):
         # Create a new video capture object
@@ -339,9 +430,86 @@ class LoadImages:
         return self.nf  # number of files
 
 
+class FrameStore:
+    # Preallocated frame ring of one stream with sequence numbers, written by the capture thread, read by the consumer
+    # Policies: 'latest' newest frame (may repeat), 'new' wait for a newer frame, 'all' every frame via a bounded queue
+    # Frames returned by get() stay valid for `hold` further get() calls, the ring never overwrites them earlier
+    def __init__(self, im, policy='latest', queue=4, hold=2):
+        assert policy in ('latest', 'new', 'all'), f"invalid stream policy '{policy}', valid are latest, new, all"
+        self.policy = policy
+        self.queue = queue if policy == 'all' else 1  # complete frames waiting for the consumer
+        hold = max(hold, 1)  # 'latest' re-returns the last lent frame
+        self.buf = np.empty((self.queue + hold + 1, *im.shape), dtype=im.dtype)  # preallocated frames
+        self.seq = np.zeros(len(self.buf), dtype=np.int64)  # frame sequence number per slot
+        self.t = np.zeros(len(self.buf))  # capture time per slot
+        self.ready = deque()  # complete unconsumed slots, oldest first
+        self.lent = deque(maxlen=hold)  # slots recently returned to the consumer
+        self.cond = Condition()
+        self.n, self.last = 0, 0  # last captured and last consumed sequence numbers
+        self.t0, self.captured, self.consumed, self.dropped, self.repeated, self.stale = time.time(), 0, 0, 0, 0, 0.0
+        j = self.acquire()
+        self.buf[j] = im
+        self.commit(j)
+
+    def acquire(self):
+        # Return a free slot for the capture thread to write, never one queued or held by the consumer
+        with self.cond:
+            busy = set(self.ready) | set(self.lent)
+            return next(j for j in range(len(self.buf)) if j not in busy)  # ring holds queue + hold + 1 slots
+
+    def commit(self, j):
+        # Publish slot j as the newest frame, dropping the oldest unconsumed frame if the queue is full
+        with self.cond:
+            self.n += 1
+            self.seq[j], self.t[j] = self.n, time.time()
+            self.ready.append(j)
+            if len(self.ready) > self.queue:
+                self.ready.popleft()
+                self.dropped += self.policy == 'all'  # 'latest' and 'new' drops are counted on get()
+            self.captured += 1
+            self.cond.notify_all()
+
+    def get(self, timeout=0.1):
+        # Return (frame, sequence number) per policy, or None if no frame is available within timeout
+        with self.cond:
+            if self.policy == 'latest':
+                j = self.ready[-1] if self.ready else self.lent[-1]
+            elif not self.cond.wait_for(lambda: self.ready, timeout):  # 'new' and 'all'
+                return None
+            else:
+                j = self.ready[-1] if self.policy == 'new' else self.ready[0]
+            if self.seq[j] == self.last:
+                self.repeated += 1
+            else:
+                self.dropped += max(self.seq[j] - self.last - 1, 0) if self.policy != 'all' else 0
+                self.consumed += 1
+                self.stale += time.time() - self.t[j]
+            self.last = int(self.seq[j])
+            if j in self.ready:
+                self.ready.remove(j)
+            self.lent.append(j)
+            return self.buf[j], self.last
+
+    def stats(self):
+        # Return capture FPS, captured, consumed, dropped and repeated frame counts and mean staleness (ms)
+        fps = self.captured / max(time.time() - self.t0, 1E-9)
+        return fps, self.captured, self.consumed, self.dropped, self.repeated, self.stale / max(self.consumed, 1) * 1E3
+
+
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='file.streams', img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    # Frames are captured into preallocated FrameStore rings, policy='latest', 'new' or 'all' (see FrameStore)
+    def __init__(self,
+                 sources='file.streams',
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 preprocess=True,
+                 policy='latest',
+                 queue=4,
+                 hold=2):
         torch.backends.cudnn.benchmark = True  # faster for fixed-size inference
         self.mode = 'stream'
         self.img_size = img_size
@@ -351,6 +519,7 @@ class LoadStreams:
         n = len(sources)
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
+        self.stores, self.seqs = [None] * n, [0] * n  # frame rings, sequence numbers of the last returned frames
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
@@ -372,6 +541,7 @@ class LoadStreams:
             self.fps[i] = max((fps if math.isfinite(fps) else 0) % 100, 0) or 30  # 30 FPS fallback
 
             _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.stores[i] = FrameStore(self.imgs[i], policy, queue, hold)
             self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
             LOGGER.info(f'{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)')
             self.threads[i].start()
@@ -382,23 +552,31 @@ class LoadStreams:
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         self.auto = auto and self.rect
         self.transforms = transforms  # optional
+        self.preprocess = preprocess  # False yields raw im0 list as im, i.e. for LetterboxPreprocessor
+        self.letterbox = LetterboxPreprocessor(img_size, stride, auto=self.auto)  # batched, into preallocated buffer
+        self.im = None  # preallocated (n,3,h,w) uint8 output
         if not self.rect:
             LOGGER.warning('WARNING ⚠️ Stream shapes differ. For optimal performance supply similarly-shaped streams.')
 
     def update(self, i, cap, stream):
-        # Read stream `i` frames in daemon thread
-        n, f = 0, self.frames[i]  # frame number, frame array
+        # Read stream `i` frames in daemon thread, decoding straight into the preallocated FrameStore slots
+        n, f, store = 0, self.frames[i], self.stores[i]  # frame number, frame count, frame ring
         while cap.isOpened() and n < f:
             n += 1
             cap.grab()  # .read() = .grab() followed by .retrieve()
             if n % self.vid_stride == 0:
-                success, im = cap.retrieve()
-                if success:
-                    self.imgs[i] = im
-                else:
+                j = store.acquire()
+                dst = store.buf[j]
+                success, im = cap.retrieve(dst)
+                if not success:
                     LOGGER.warning('WARNING ⚠️ Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] = np.zeros_like(self.imgs[i])
+                    dst[:] = 0
                     cap.open(stream)  # re-open stream if signal was lost
+                elif im.shape != dst.shape:  # stream resolution changed
+                    cv2.resize(im, dst.shape[1::-1], dst=dst)
+                elif not np.shares_memory(im, dst):
+                    dst[:] = im
+                store.commit(j)
             time.sleep(0.0)  # wait time
 
     def __iter__(self):
@@ -407,20 +585,43 @@ class LoadStreams:
 
     def __next__(self):
         self.count += 1
-        if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
-            cv2.destroyAllWindows()
-            raise StopIteration
+        im0 = [None] * len(self.stores)
+        while True:
+            if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
+                cv2.destroyAllWindows()
+                self.log_stats()
+                raise StopIteration
+            for i, store in enumerate(self.stores):
+                if im0[i] is None:
+                    x = store.get()
+                    if x is not None:
+                        im0[i], self.seqs[i] = x
+            if all(x is not None for x in im0):
+                break
 
-        im0 = self.imgs.copy()
         if self.transforms:
             im = np.stack([self.transforms(x) for x in im0])  # transforms
+        elif not self.preprocess:
+            im = im0  # raw frames for fused preprocessing, valid for `hold` more frames
         else:
-            im = np.stack([letterbox(x, self.img_size, stride=self.stride, auto=self.auto)[0] for x in im0])  # resize
-            im = im[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
-            im = np.ascontiguousarray(im)  # contiguous
+            x = self.letterbox.letterbox(im0)  # (n,h,w,3) BGR view of preallocated buffer
+            if self.im is None or self.im.shape != (x.shape[0], 3, *x.shape[1:3]):
+                self.im = np.empty((x.shape[0], 3, *x.shape[1:3]), dtype=np.uint8)
+            np.copyto(self.im, x[..., ::-1].transpose((0, 3, 1, 2)))  # BGR to RGB, BHWC to BCHW in one copy
+            im = self.im  # reused, valid until the next frame
 
         return self.sources, im, im0, None, ''
 
+    def stats(self):
+        # Per-stream (FPS, captured, consumed, dropped, repeated, staleness ms), see FrameStore.stats()
+        return [x.stats() for x in self.stores]
+
+    def log_stats(self):
+        s = ('%-24s' + '%11s' * 6) % ('Stream', 'FPS', 'captured', 'consumed', 'dropped', 'repeated', 'stale(ms)')
+        for source, (fps, n, c, d, r, t) in zip(self.sources, self.stats()):
+            s += f'\n{source[-24:]:<24s}{fps:11.1f}{n:11d}{c:11d}{d:11d}{r:11d}{t:11.1f}'
+        LOGGER.info(s)
+
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
@@ -0,0 +1,91 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Load-test the YOLOv5 REST API with concurrent clients, reporting latency percentiles, throughput and server metrics
+
+Usage:
+    $ python utils/flask_rest_api/loadtest.py --image data/images/zidane.jpg --concurrency 16 --requests 1000
+    $ python utils/flask_rest_api/loadtest.py --model yolov5n --concurrency 32 --duration 30
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+
+
+async def client(session, url, data, deadline, counter, latency, errors):
+    # Send requests back-to-back until counter or deadline is exhausted
+    while counter[0] > 0 and time.perf_counter() < deadline:
+        counter[0] -= 1
+        t = time.perf_counter()
+        try:
+            async with session.post(url, data=data, headers={'Content-Type': 'image/jpeg'}) as r:
+                await r.read()
+                if r.status != 200:
+                    errors.append(r.status)
+                    continue
+        except Exception as e:
+            errors.append(type(e).__name__)
+            continue
+        latency.append(time.perf_counter() - t)
+
+
+async def loadtest(url, image, concurrency=16, requests=1000, duration=0.0, warmup=10):
+    # Return latency (ms) percentiles, throughput and errors of `requests` (or `duration` seconds of) requests
+    data = Path(image).read_bytes()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await client(session, url, data, float('inf'), [warmup], [], [])  # warmup, not recorded
+        counter, latency, errors = [requests if not duration else float('inf')], [], []
+        deadline = time.perf_counter() + duration if duration else float('inf')
+        t = time.perf_counter()
+        await asyncio.gather(*(client(session, url, data, deadline, counter, latency, errors)
+                               for _ in range(concurrency)))
+        dt = time.perf_counter() - t
+        async with session.get(url.split('/v1/')[0] + '/metrics') as r:
+            server = await r.json() if r.status == 200 else None
+
+    x = np.array(latency) * 1E3 if latency else np.zeros(1)
+    return {
+        'requests': len(latency),
+        'errors': len(errors),
+        'concurrency': concurrency,
+        'seconds': round(dt, 2),
+        'requests_per_s': round(len(latency) / dt, 2),
+        'latency_ms': dict(zip(('min', 'p50', 'p90', 'p99', 'max'),
+                               np.percentile(x, (0, 50, 90, 99, 100)).round(2).tolist())),
+        'server': server}
+
+
+def run(
+        url='http://localhost:5000/v1/object-detection/{model}',  # detection endpoint
+        model='yolov5s',  # served model name, the weights stem
+        image='data/images/zidane.jpg',  # image file sent with every request
+        concurrency=16,  # concurrent clients
+        requests=1000,  # total requests, ignored if duration is set
+        duration=0.0,  # test duration in seconds, 0 to send `requests` requests
+        warmup=10,  # untimed requests before the test
+):
+    r = asyncio.run(loadtest(url.format(model=model), image, concurrency, requests, duration, warmup))
+    print(json.dumps(r, indent=2))
+    return r
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description='Load-test the YOLOv5 REST API')
+    parser.add_argument('--url', default='http://localhost:5000/v1/object-detection/{model}', help='endpoint')
+    parser.add_argument('--model', default='yolov5s', help='served model name, the weights stem')
+    parser.add_argument('--image', default='data/images/zidane.jpg', help='image file sent with every request')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=1000, help='total requests, ignored if --duration is set')
+    parser.add_argument('--duration', type=float, default=0.0, help='test duration in seconds')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests before the test')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    run(**vars(opt))
@@ -1,48 +1,261 @@
 # YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
 """
-Run a Flask REST API exposing one or more YOLOv5s models
+Run an asyncio REST API serving one or more YOLOv5 models from local weights, with dynamic micro-batching:
+concurrent requests to a model are queued and run together in one forward pass of up to --max-batch images,
+waiting at most --max-wait ms for a batch to fill
+
+Usage:
+    $ python utils/flask_rest_api/restapi.py --weights yolov5s.pt yolov5n.onnx --max-batch 8 --max-wait 5
+    $ python utils/flask_rest_api/restapi.py --weights *.onnx --budget 1024  # LRU-evict models beyond 1 GB
+    $ curl -X POST -F image=@zidane.jpg 'http://localhost:5000/v1/object-detection/yolov5s'
+    $ curl 'http://localhost:5000/metrics'
+    $ curl 'http://localhost:5000/metrics/registry'
 """
 
 import argparse
-import io
+import asyncio
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 
-import torch
-from flask import Flask, request
-from PIL import Image
+import numpy as np
 
-app = Flask(__name__)
-models = {}
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[2]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
 
-DETECTION_URL = '/v1/object-detection/<model>'
+from utils.cache import ResultCache
+from utils.general import LOGGER, check_requirements, cv2, print_args
+from utils.registry import ModelRegistry
 
+DETECTION_URL = '/v1/object-detection/{model}'
 
-@app.route(DETECTION_URL, methods=['POST'])
-def predict(model):
-    if request.method != 'POST':
-        return
 
-    if request.files.get('image'):
-        # Method 1
-        # with request.files["image"] as f:
-        #     im = Image.open(io.BytesIO(f.read()))
+class Metrics:
+    # Request, batch and latency counters of one model, over a window of recent requests and batches
+    def __init__(self, window=1000):
+        self.t0 = time.time()
+        self.requests, self.images, self.batches, self.errors = 0, 0, 0, 0
+        self.latency = deque(maxlen=window)  # request latency (ms): decode, queueing, inference, serialization
+        self.inference = deque(maxlen=window)  # batch inference time (ms): preprocess, forward, NMS
+        self.batch_sizes = deque(maxlen=window)
 
-        # Method 2
-        im_file = request.files['image']
-        im_bytes = im_file.read()
-        im = Image.open(io.BytesIO(im_bytes))
+    def report(self):
+        dt = max(time.time() - self.t0, 1E-9)
 
-        if model in models:
-            results = models[model](im, size=640)  # reduce size=320 for faster inference
-            return results.pandas().xyxy[0].to_json(orient='records')
+        def percentiles(x):
+            return dict(zip(('p50', 'p90', 'p99'), np.percentile(x, (50, 90, 99)).round(2).tolist())) if x else {}
 
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch_size': round(float(np.mean(self.batch_sizes)), 2) if self.batch_sizes else 0,
+            'requests_per_s': round(self.requests / dt, 2),
+            'latency_ms': percentiles(self.latency),
+            'inference_ms': percentiles(self.inference),
+            'uptime_s': round(dt, 1)}
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Flask API exposing YOLOv5 model')
+
+class MicroBatcher:
+    # Batches concurrent requests to one AutoShape model, i.e. body = await batcher(im)  # RGB HWC uint8 image
+    # model() returns a context manager yielding the model for one forward pass, i.e. partial(registry.get, weights)
+    def __init__(self, model, size=640, max_batch=8, max_wait=0.005, **options):
+        self.model = model
+        self.options = options  # AutoShape attributes, i.e. conf=0.25, iou=0.45
+        self.size = size  # inference size (pixels)
+        self.max_batch = max_batch
+        self.max_wait = max_wait  # seconds the first request of a batch waits for more
+        self.queue = None  # created in start(), on the server's event loop
+        self.executor = ThreadPoolExecutor(1)  # one forward pass at a time per model
+        self.metrics = Metrics()
+
+    async def __call__(self, im, format='json', cache=True):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((im, format, cache, future))
+        return await future
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        return asyncio.create_task(self.run())
+
+    async def run(self):
+        # Collect up to max_batch queued requests within max_wait of the first one, infer them as one batch
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            batch = [x for x in batch if not x[-1].done()]  # drop requests cancelled by their clients
+            if not batch:
+                continue
+            t = time.perf_counter()
+            try:
+                ims, formats, cache, _ = zip(*batch)
+                results = await loop.run_in_executor(self.executor, self.infer, ims, formats, cache)
+            except Exception as e:
+                self.metrics.errors += len(batch)
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.batches += 1
+            self.metrics.images += len(batch)
+            self.metrics.batch_sizes.append(len(batch))
+            self.metrics.inference.append((time.perf_counter() - t) * 1E3)
+            for (*_, future), r in zip(batch, results):
+                if not future.done():
+                    future.set_result(r)
+
+    def infer(self, ims, formats, cache=True):
+        # Return per-image serialized results for a list of RGB HWC uint8 images, in one forward pass
+        # cache is a bool, or a bool per image so that ?cache=0 bypasses the cache for its own request only
+        with self.model() as model:  # loaded on a registry miss, not evicted during the forward pass
+            for k, v in self.options.items():
+                setattr(model, k, v)
+            results = model(ims, size=self.size, cache=cache)
+        return [results.tobytes(i, msgpack=True) if f == 'msgpack' else results.tojson(i).encode()
+                for i, f in enumerate(formats)]
+
+
+def decode(buf):
+    # Decode encoded image bytes to an RGB HWC uint8 array, None if not an image
+    im = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR) if buf else None
+    return None if im is None else im[..., ::-1]  # BGR to RGB
+
+
+def create_app(batchers, registry=None, workers=4):
+    # aiohttp application exposing batchers {name: MicroBatcher} of models in registry
+    from aiohttp import web
+
+    decoders = ThreadPoolExecutor(workers)  # cv2.imdecode releases the GIL
+
+    async def predict(request):
+        name = request.match_info['model']
+        if name not in batchers:
+            return web.json_response({'error': f'unknown model {name}, available: {list(batchers)}'}, status=404)
+        batcher, t = batchers[name], time.perf_counter()
+        if request.content_type.startswith('multipart/'):  # curl -F image=@zidane.jpg
+            f = (await request.post()).get('image')
+            buf = f.file.read() if hasattr(f, 'file') else None
+        else:  # raw image bytes
+            buf = await request.read()
+        im = await asyncio.get_running_loop().run_in_executor(decoders, decode, buf)
+        if im is None:
+            batcher.metrics.errors += 1
+            return web.json_response({'error': 'no decodable image in request'}, status=400)
+        msgpack = request.query.get('format') == 'msgpack'  # default JSON records
+        cache = request.query.get('cache', '1') not in ('0', 'false')  # ?cache=0 bypasses the result cache
+        try:
+            body = await batcher(im, 'msgpack' if msgpack else 'json', cache)
+        except Exception as e:
+            return web.json_response({'error': str(e)}, status=500)
+        batcher.metrics.requests += 1
+        batcher.metrics.latency.append((time.perf_counter() - t) * 1E3)
+        return web.Response(body=body, content_type='application/msgpack' if msgpack else 'application/json')
+
+    async def metrics(request):
+        m = {k: v.metrics.report() for k, v in batchers.items()}
+        for k, v in batchers.items():
+            if v.options.get('cache'):
+                m[k]['cache'] = v.options['cache'].stats()  # hits, misses, hit rate, evictions
+        return web.json_response(m)
+
+    async def registry_stats(request):
+        return web.json_response(registry.stats() if registry else {})
+
+    async def start(app):
+        app['tasks'] = [b.start() for b in batchers.values()]
+
+    async def stop(app):
+        for task in app['tasks']:
+            task.cancel()
+
+    app = web.Application(client_max_size=32 * 1024 ** 2)  # 32 MB images
+    app.add_routes([
+        web.post(DETECTION_URL, predict),
+        web.get('/metrics', metrics),
+        web.get('/metrics/registry', registry_stats)])
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+
+def run(
+        weights=ROOT / 'yolov5s.pt',  # model path(s), served at /v1/object-detection/<stem>
+        imgsz=640,  # inference size (pixels)
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        conf_thres=0.25,  # confidence threshold
+        iou_thres=0.45,  # NMS IoU threshold
+        max_batch=8,  # maximum requests per forward pass
+        max_wait=5.0,  # maximum wait (ms) for a batch to fill
+        buckets=0,  # AutoShape shape buckets for mixed-size batches, 0 to pad all to the largest image
+        budget=0,  # resident models memory budget (MB), least recently used models are evicted beyond it, 0 for none
+        lazy=False,  # load models on their first request instead of pre-loading them in the background
+        cache=None,  # result cache mode per model, 'exact' or 'perceptual', None for no cache
+        cache_size=1024,  # result cache entries per model
+        cache_ttl=0.0,  # result cache entry lifetime (seconds), 0 for no expiry
+        workers=4,  # image decoding threads
+        host='0.0.0.0',  # listen address
+        port=5000,  # port number
+):
+    check_requirements('aiohttp')
+    from aiohttp import web
+
+    weights = weights if isinstance(weights, (list, tuple)) else [weights]
+    registry = ModelRegistry(budget, device, half, imgsz)  # local weights, no hub download
+    if not lazy:
+        registry.preload(*weights)
+    batchers = {}
+    for w in weights:
+        batchers[Path(w).stem] = MicroBatcher(partial(registry.get, w),
+                                              imgsz,
+                                              max_batch,
+                                              max_wait / 1E3,
+                                              conf=conf_thres,
+                                              iou=iou_thres,
+                                              buckets=buckets,
+                                              cache=ResultCache(cache, cache_size, cache_ttl) if cache else None)
+        LOGGER.info(f'Serving {w} at {DETECTION_URL.format(model=Path(w).stem)}')
+    web.run_app(create_app(batchers, registry, workers), host=host, port=port)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description='asyncio REST API exposing YOLOv5 models with micro-batching')
+    parser.add_argument('--weights', nargs='+', type=str, default=[ROOT / 'yolov5s.pt'], help='model path(s)')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    parser.add_argument('--max-batch', type=int, default=8, help='maximum requests per forward pass')
+    parser.add_argument('--max-wait', type=float, default=5.0, help='maximum wait (ms) for a batch to fill')
+    parser.add_argument('--buckets', type=int, default=0, help='shape buckets for mixed-size batches, 0 to disable')
+    parser.add_argument('--budget', type=float, default=0, help='resident models memory budget (MB), 0 for none')
+    parser.add_argument('--lazy', action='store_true', help='load models on first request, not in the background')
+    parser.add_argument('--cache', choices=['exact', 'perceptual'], help='result cache mode, default no cache')
+    parser.add_argument('--cache-size', type=int, default=1024, help='result cache entries per model')
+    parser.add_argument('--cache-ttl', type=float, default=0.0, help='result cache entry lifetime (s), 0 for none')
+    parser.add_argument('--workers', type=int, default=4, help='image decoding threads')
+    parser.add_argument('--host', default='0.0.0.0', help='listen address')
     parser.add_argument('--port', default=5000, type=int, help='port number')
-    parser.add_argument('--model', nargs='+', default=['yolov5s'], help='model(s) to run, i.e. --model yolov5n yolov5s')
     opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
 
-    for m in opt.model:
-        models[m] = torch.hub.load('ultralytics/yolov5', m, force_reload=True, skip_validation=True)
 
-    app.run(host='0.0.0.0', port=opt.port)  # debug=True causes Restarting with stat
+if __name__ == '__main__':
+    opt = parse_opt()
+    run(**vars(opt))
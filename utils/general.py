@@ -40,6 +40,7 @@ from ultralytics.yolo.utils.checks import check_requirements
 from utils import TryExcept, emojis
 from utils.downloads import curl_download, gsutil_getsize
 from utils.metrics import box_iou, fitness
+from utils.tracing import TRACER
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[1]  # YOLOv5 root directory
@@ -172,8 +173,9 @@ CONFIG_DIR = user_config_dir()  # Ultralytics settings dir
 
 class Profile(contextlib.ContextDecorator):
     # YOLOv5 Profile class. Usage: @Profile() decorator or 'with Profile():' context manager
-    def __init__(self, t=0.0):
+    def __init__(self, t=0.0, name=None):
         self.t = t
+        self.name = name  # span name recorded while utils.tracing.TRACER is enabled
         self.cuda = torch.cuda.is_available()
 
     def __enter__(self):
@@ -183,6 +185,8 @@ class Profile(contextlib.ContextDecorator):
     def __exit__(self, type, value, traceback):
         self.dt = self.time() - self.start  # delta-time
         self.t += self.dt  # accumulate dt
+        if self.name and TRACER.enabled:
+            TRACER.add(self.name, self.dt)
 
     def time(self):
         if self.cuda:
@@ -863,6 +867,7 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        merge=False,  # merge-NMS, kept boxes are score-weighted means of the boxes they suppress, i.e. for TTA
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
@@ -889,9 +894,8 @@ def non_max_suppression(
     max_wh = 7680  # (pixels) maximum box width and height
     max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
     time_limit = 0.5 + 0.05 * bs  # seconds to quit after
-    redundant = True  # require redundant detections
+    redundant = False  # merge: drop kept boxes that suppress no other box, off so isolated detections are kept
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
     mi = 5 + nc  # mask start index
@@ -966,6 +970,22 @@ def non_max_suppression(
     return output
 
 
+def split_end2end(prediction, bs, conf_thres=0.0, classes=None, masks=None):
+    """Split end-to-end model output (n,7) [image, xyxy, conf, cls] from export.py --end2end into per-image detections
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls] as non_max_suppression(),
+         and the list of (n,h,w) masks per image if masks are passed
+    """
+    keep = prediction[:, 5] > conf_thres  # NMS thresholds are fixed at export, filter to runtime settings
+    if classes is not None:
+        keep &= (prediction[:, 6:7] == torch.tensor(classes, device=prediction.device)).any(1)
+    b = prediction[:, 0].long()
+    i = [keep & (b == xi) for xi in range(bs)]
+    output = [prediction[x, 1:] for x in i]
+    return output if masks is None else (output, [masks[x] for x in i])
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -0,0 +1,238 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Local stand-in for a Triton Inference Server: the KServe v2 HTTP/REST protocol with the binary tensor and system
+shared-memory extensions, serving a YOLOv5 model (or an identity model) for testing utils/triton.py without Triton
+
+Usage:
+    $ python -m utils.kserve --weights yolov5s.onnx --port 8000  # serve a model
+    $ python -m utils.kserve --port 8000                         # identity model, output0 = images
+    $ python detect.py --weights 'http://localhost:8000?shm=1&requests=4'
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.general import LOGGER, print_args
+
+DTYPES = {
+    'BOOL': np.bool_,
+    'UINT8': np.uint8,
+    'INT8': np.int8,
+    'INT16': np.int16,
+    'INT32': np.int32,
+    'INT64': np.int64,
+    'FP16': np.float16,
+    'FP32': np.float32,
+    'FP64': np.float64}  # KServe v2 datatypes
+DATATYPES = {np.dtype(v): k for k, v in DTYPES.items()}
+HEADER = 'Inference-Header-Content-Length'  # JSON header length of binary tensor requests and responses
+
+
+class Model:
+    # Served model: fn(list of numpy inputs) -> list of numpy outputs, with KServe v2 metadata
+    def __init__(self, name, fn, inputs, outputs, platform='onnxruntime_onnx'):
+        self.name = name
+        self.fn = fn
+        self.lock = threading.Lock()  # one inference at a time
+        self.metadata = {
+            'name': name,
+            'versions': ['1'],
+            'platform': platform,
+            'inputs': [{
+                'name': n,
+                'datatype': d,
+                'shape': s} for n, d, s in inputs],
+            'outputs': [{
+                'name': n,
+                'datatype': d,
+                'shape': s} for n, d, s in outputs]}
+
+    def __call__(self, inputs):
+        with self.lock:
+            return self.fn(inputs)
+
+
+def identity_model(imgsz=640):
+    # Identity model, output0 = images, for transport tests without weights
+    return Model('identity', lambda x: [x[0]], [('images', 'FP32', [-1, 3, imgsz, imgsz])],
+                 [('output0', 'FP32', [-1, 3, imgsz, imgsz])])
+
+
+def yolov5_model(weights, imgsz=640, device='', half=False):
+    # YOLOv5 model served through DetectMultiBackend, float inputs 'images' and outputs 'output0', 'output1', ...
+    from models.common import DetectMultiBackend
+    from utils.torch_utils import select_device
+
+    model = DetectMultiBackend(weights, device=select_device(device), fp16=half)
+    dtype = 'FP16' if model.fp16 else 'FP32'
+
+    def fn(x):
+        y = model(torch.from_numpy(x[0]).to(model.device))
+        y = y if isinstance(y, (list, tuple)) else [y]
+        return [x.cpu().numpy() for x in y]
+
+    y = fn([np.zeros((1, 3, imgsz, imgsz), DTYPES[dtype])])  # warmup, output shapes
+    backend = model.backend_name(weights)
+    platform = {'onnx': 'onnxruntime_onnx', 'engine': 'tensorrt_plan', 'torchscript': 'pytorch_libtorch'}
+    inputs = [('images', dtype, [-1, 3, imgsz, imgsz])]
+    outputs = [(f'output{i}', DATATYPES[x.dtype], [-1, *x.shape[1:]]) for i, x in enumerate(y)]
+    return Model(Path(weights).stem, fn, inputs, outputs, platform.get(backend, backend))
+
+
+class Handler(BaseHTTPRequestHandler):
+    # KServe v2 endpoints of server.model, server.regions holds registered system shared-memory regions
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the Triton HTTP client expects
+
+    def log_message(self, *args):
+        pass  # quiet
+
+    def _send(self, body, status=200, headers=None):
+        body = json.dumps(body).encode() if not isinstance(body, bytes) else body
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if not headers else 'application/octet-stream')
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, msg, status=400):
+        self._send({'error': msg}, status)
+
+    def do_GET(self):
+        model, parts = self.server.model, self.path.strip('/').split('?')[0].split('/')
+        if parts in (['v2', 'health', 'live'], ['v2', 'health', 'ready']):
+            self._send(b'', headers={})
+        elif parts == ['v2']:
+            extensions = ['binary_tensor_data', 'system_shared_memory']
+            self._send({'name': 'yolov5-kserve', 'version': '2', 'extensions': extensions})
+        elif parts[:3] == ['v2', 'models', model.name] and len(parts) in (3, 5):  # v2/models/name[/versions/1]
+            self._send(model.metadata)
+        elif parts[:2] == ['v2', 'systemsharedmemory'] and parts[-1] == 'status':
+            self._send([{
+                'name': k,
+                'key': v[0],
+                'offset': v[1],
+                'byte_size': v[2]} for k, v in self.server.regions.items()])
+        else:
+            self._error(f'unknown path {self.path}', 404)
+
+    def do_POST(self):
+        model, parts = self.server.model, self.path.strip('/').split('?')[0].split('/')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if parts == ['v2', 'repository', 'index']:
+            self._send([{'name': model.name, 'version': '1', 'state': 'READY'}])
+        elif parts[:2] == ['v2', 'systemsharedmemory']:
+            self._shared_memory(parts[2:], body)
+        elif parts[:3] == ['v2', 'models', model.name] and parts[-1] == 'infer':
+            try:
+                self._infer(body)
+            except Exception as e:
+                self._error(f'{type(e).__name__}: {e}')
+        else:
+            self._error(f'unknown path {self.path}', 404)
+
+    def _shared_memory(self, parts, body):
+        # region/<name>/register, region/<name>/unregister, unregister (all)
+        regions = self.server.regions
+        if len(parts) == 3 and parts[0] == 'region' and parts[2] == 'register':
+            r = json.loads(body)
+            key, offset, size = r['key'], r.get('offset', 0), r['byte_size']
+            buf = np.memmap(f"/dev/shm/{key.lstrip('/')}", np.uint8, 'r+', offset, (size, ))  # Linux
+            regions[parts[1]] = key, offset, size, buf
+        elif len(parts) == 3 and parts[0] == 'region' and parts[2] == 'unregister':
+            regions.pop(parts[1], None)
+        elif parts == ['unregister']:
+            regions.clear()
+        else:
+            return self._error(f'unknown path {self.path}', 404)
+        self._send(b'', headers={})
+
+    def _region(self, name, size, start=0):
+        # Return a writable uint8 view of size bytes at a request's shared_memory_offset `start` within a registered
+        # system shared-memory region. The region's own registration offset into its key is applied once, by the
+        # memmap opened in _shared_memory(), so buf[0] is the region's first byte
+        _, _, byte_size, buf = self.server.regions[name]
+        assert start + size <= byte_size, f'shared memory region {name} of {byte_size} bytes is too small'
+        return buf[start:start + size]
+
+    def _infer(self, body):
+        n = int(self.headers.get(HEADER, len(body)))
+        request, data = json.loads(body[:n]), memoryview(body)[n:]
+        inputs = []
+        for i in request['inputs']:
+            dtype, shape, p = DTYPES[i['datatype']], i['shape'], i.get('parameters', {})
+            if 'shared_memory_region' in p:
+                buf = self._region(p['shared_memory_region'], p['shared_memory_byte_size'],
+                                   p.get('shared_memory_offset', 0))
+                x = buf.view(dtype).reshape(shape).copy()
+            elif 'binary_data_size' in p:
+                size = p['binary_data_size']
+                x, data = np.frombuffer(data[:size], dtype).reshape(shape), data[size:]
+            else:
+                x = np.array(i['data'], dtype).reshape(shape)
+            inputs.append(x)
+
+        y = dict(zip((o['name'] for o in self.server.model.metadata['outputs']), self.server.model(inputs)))
+        requested = request.get('outputs') or [{'name': k} for k in y]
+        binary_all = request.get('parameters', {}).get('binary_data_output', False)
+        outputs, blobs = [], []
+        for o in requested:
+            x, p = np.ascontiguousarray(y[o['name']]), o.get('parameters', {})
+            out = {'name': o['name'], 'datatype': DATATYPES[x.dtype], 'shape': list(x.shape)}
+            if 'shared_memory_region' in p:
+                buf = self._region(p['shared_memory_region'], x.nbytes, p.get('shared_memory_offset', 0))
+                buf[:] = x.reshape(-1).view(np.uint8)
+                out['parameters'] = {
+                    'shared_memory_region': p['shared_memory_region'],
+                    'shared_memory_byte_size': x.nbytes}
+            elif p.get('binary_data', binary_all):
+                out['parameters'] = {'binary_data_size': x.nbytes}
+                blobs.append(x.tobytes())
+            else:
+                out['data'] = x.reshape(-1).tolist()
+            outputs.append(out)
+        header = json.dumps({'model_name': self.server.model.name, 'model_version': '1', 'outputs': outputs}).encode()
+        if blobs:
+            self._send(header + b''.join(blobs), headers={HEADER: str(len(header))})
+        else:
+            self._send(header)
+
+
+def run(
+        weights=None,  # model path served as a YOLOv5 model, None for an identity model
+        imgsz=640,  # inference size (pixels)
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        host='127.0.0.1',  # listen address
+        port=8000,  # port number
+):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.model = yolov5_model(weights, imgsz, device, half) if weights else identity_model(imgsz)
+    server.regions = {}  # {name: (key, offset, byte_size, np.memmap)}
+    LOGGER.info(f'Serving {server.model.name} with KServe v2 protocol at http://{host}:{port}')
+    server.serve_forever()
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description='KServe v2 stand-in for a Triton Inference Server')
+    parser.add_argument('--weights', type=str, default=None, help='model path, default identity model')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--host', default='127.0.0.1', help='listen address')
+    parser.add_argument('--port', type=int, default=8000, help='port number')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    run(**vars(opt))
@@ -0,0 +1,190 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Micro-benchmarks of post-processing hot paths on synthetic inputs, with JSON baselines and regression gates
+
+Usage:
+    $ python -m utils.microbench --save                  # record baseline to utils/microbench.json
+    $ python -m utils.microbench --check                 # fail if any case is > 20% slower than its baseline
+    $ python -m utils.microbench --check --include nms   # only cases whose name contains 'nms'
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.augmentations import letterbox
+from utils.general import LOGGER, non_max_suppression, print_args, scale_boxes
+from utils.metrics import box_iou
+from utils.plots import Annotator
+from utils.segment.general import masks2segments, process_mask, process_mask_native
+
+BASELINE = Path(__file__).with_suffix('.json')  # default baseline file
+
+
+def boxes(n, h=640, w=640, min_size=8, max_size=256, g=None):
+    # Random (n,4) xyxy boxes inside a (h,w) image
+    g = g or torch.Generator().manual_seed(0)
+    wh = min_size + torch.rand(n, 2, generator=g) * (max_size - min_size)
+    xy = torch.rand(n, 2, generator=g) * (torch.tensor([w, h]) - wh)
+    return torch.cat((xy, xy + wh), 1)
+
+
+def predictions(bs=1, imgsz=640, nc=80, nm=0, candidates=300, g=None):
+    # Raw (bs,anchors,5+nc+nm) Detect/Segment output with `candidates` anchors per image above conf 0.25,
+    # clustered around few objects as in real outputs, the rest near-zero objectness
+    g = g or torch.Generator().manual_seed(0)
+    na = 3 * sum((imgsz // s) ** 2 for s in (8, 16, 32))  # anchors
+    x = torch.rand(bs, na, 5 + nc + nm, generator=g)
+    x[..., 4] *= 0.05  # background objectness
+    objects = boxes(max(candidates // 10, 1), imgsz, imgsz, g=g)  # ~10 candidates per object
+    for b in range(bs):
+        i = torch.randperm(na, generator=g)[:candidates]
+        xyxy = objects[torch.randint(len(objects), (candidates, ), generator=g)]
+        xyxy = xyxy + torch.randn(candidates, 4, generator=g) * 4  # jitter around the object
+        x[b, i, :4] = torch.cat(((xyxy[:, :2] + xyxy[:, 2:]) / 2, (xyxy[:, 2:] - xyxy[:, :2]).abs()), 1)  # xywh
+        x[b, i, 4] = 0.5 + torch.rand(candidates, generator=g) * 0.5
+        x[b, i, 5 + torch.randint(nc, (1, ), generator=g)] = 0.9  # dominant class
+    return x
+
+
+def binary_masks(n, h=160, w=160, g=None):
+    # (n,h,w) float masks of filled ellipses inside random boxes
+    g = g or torch.Generator().manual_seed(0)
+    b = boxes(n, h, w, min_size=4, max_size=min(h, w) // 2, g=g)
+    y, x = torch.arange(h)[None, :, None] + 0.5, torch.arange(w)[None, None] + 0.5
+    c, r = (b[:, :2] + b[:, 2:]) / 2, (b[:, 2:] - b[:, :2]) / 2
+    return ((((x - c[:, 0, None, None]) / r[:, 0, None, None]) ** 2 +
+             ((y - c[:, 1, None, None]) / r[:, 1, None, None]) ** 2) <= 1).float()
+
+
+def cases():
+    # Return {name: (fn, params)}, inputs are built up front so only fn() is timed
+    from val import process_batch  # deferred, val.py is a top-level script
+
+    g = torch.Generator().manual_seed(0)
+    rng = np.random.default_rng(0)
+    c = {}
+    for bs, imgsz, n in (1, 320, 30), (1, 640, 300), (8, 640, 300), (1, 640, 3000):
+        x = predictions(bs, imgsz, candidates=n, g=g)
+        c[f'nms_b{bs}_{imgsz}_n{n}'] = lambda x=x: non_max_suppression(x, 0.25, 0.45), \
+            dict(batch_size=bs, imgsz=imgsz, candidates=n)
+    x = predictions(1, 640, nm=32, candidates=300, g=g)
+    c['nms_seg_b1_640_n300'] = lambda x=x: non_max_suppression(x, 0.25, 0.45, nm=32), \
+        dict(batch_size=1, imgsz=640, candidates=300, nm=32)
+    for n in 10, 100:
+        proto, m, b = torch.randn(32, 160, 160, generator=g), torch.randn(n, 32, generator=g), boxes(n, g=g)
+        c[f'process_mask_n{n}'] = lambda p=proto, m=m, b=b: process_mask(p, m, b, (640, 640), upsample=True), \
+            dict(masks=n, imgsz=640)
+        b0 = boxes(n, 1080, 1920, g=g)
+        c[f'process_mask_native_n{n}_1080p'] = lambda p=proto, m=m, b=b0: process_mask_native(p, m, b, (1080, 1920)), \
+            dict(masks=n, shape=(1080, 1920))
+    for n in 10, 50:
+        masks = binary_masks(n, 640, 640, g=g)
+        c[f'masks2segments_n{n}'] = lambda m=masks: masks2segments(m), dict(masks=n, shape=(640, 640))
+    for h, w in (480, 640), (1080, 1920):
+        im = rng.integers(0, 255, (h, w, 3), dtype=np.uint8)
+        c[f'letterbox_{h}x{w}'] = lambda im=im: letterbox(im, 640, stride=32, auto=False), dict(shape=(h, w))
+    b = boxes(1000, g=g)
+    c['scale_boxes_n1000'] = lambda b=b: scale_boxes((640, 640), b.clone(), (1080, 1920)), dict(boxes=1000)
+    b1, b2 = boxes(100, g=g), boxes(1000, g=g)
+    c['box_iou_100x1000'] = lambda: box_iou(b1, b2), dict(boxes=(100, 1000))
+    for n in 10, 50:
+        im, masks = rng.integers(0, 255, (1080, 1920, 3), dtype=np.uint8), binary_masks(n, 640, 640, g=g)
+        colors = [tuple(int(v) for v in rng.integers(0, 255, 3)) for _ in range(n)]
+        c[f'annotator_masks_n{n}_1080p'] = lambda im=im, m=masks, cl=colors: Annotator(im.copy()).masks(m, cl), \
+            dict(masks=n, shape=(1080, 1920))
+    for n, m in (100, 20), (1000, 100):
+        d = torch.cat((boxes(n, g=g), torch.rand(n, 1, generator=g), torch.randint(80, (n, 1), generator=g)), 1)
+        lb = torch.cat((torch.randint(80, (m, 1), generator=g), boxes(m, g=g)), 1)
+        iouv = torch.linspace(0.5, 0.95, 10)
+        c[f'process_batch_n{n}_m{m}'] = lambda d=d, lb=lb, iouv=iouv: process_batch(d, lb, iouv), \
+            dict(detections=n, labels=m)
+    return c
+
+
+def timeit(fn, min_time=0.2, repeat=5, warmup=2):
+    # Return median seconds per call over `repeat` runs of at least min_time seconds each
+    for _ in range(warmup):
+        fn()
+    t = time.perf_counter()
+    fn()
+    number = max(int(min_time / max(time.perf_counter() - t, 1E-9)), 1)  # calls per run
+    runs = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - t) / number)
+    return float(np.median(runs))
+
+
+def run(
+        baseline=BASELINE,  # baseline JSON path
+        save=False,  # save results as the new baseline
+        check=False,  # fail on regressions beyond tolerance
+        tolerance=0.2,  # allowed slowdown vs baseline, 0.2 = 20%
+        include=None,  # only cases whose name contains any of these strings
+        threads=1,  # torch threads, 1 for stable timings
+        min_time=0.2,  # seconds per timing run
+        repeat=5,  # timing runs per case, median reported
+):
+    torch.set_num_threads(threads)
+    base = json.loads(Path(baseline).read_text()) if Path(baseline).is_file() else {}
+    results, failures = {}, []
+    LOGGER.info(('%-36s' + '%12s' * 3) % ('Case', 'ms', 'baseline', 'change'))
+    for name, (fn, params) in cases().items():
+        if include and not any(x in name for x in include):
+            continue
+        ms = timeit(fn, min_time, repeat) * 1E3
+        results[name] = {'ms': ms, 'params': params}
+        b = base.get('results', {}).get(name, {}).get('ms')
+        change = ms / b - 1 if b else float('nan')
+        if b and change > tolerance:
+            failures.append(name)
+        LOGGER.info(f"{name:<36s}{ms:>12.3f}{b or float('nan'):>12.3f}{change:>+12.1%}{' FAIL' * (name in failures)}")
+
+    meta = {
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'threads': threads,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if base and base.get('meta', {}).get('host') != meta['host']:
+        LOGGER.warning(f"WARNING ⚠️ baseline recorded on {base['meta'].get('host')}, timings may not be comparable")
+    if save:
+        base_results = base.get('results', {}) if include else {}  # keep cases not re-run
+        Path(baseline).write_text(json.dumps({'meta': meta, 'results': {**base_results, **results}}, indent=2))
+        LOGGER.info(f'Baseline saved to {baseline}')
+    if check and failures:
+        LOGGER.error(f'{len(failures)} regression(s) > {tolerance:.0%}: {", ".join(failures)}')
+        sys.exit(1)
+    return results, failures
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', type=str, default=BASELINE, help='baseline JSON path')
+    parser.add_argument('--save', action='store_true', help='save results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='exit 1 on regressions beyond --tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown vs baseline, 0.2 = 20%%')
+    parser.add_argument('--include', nargs='+', type=str, help='only cases whose name contains these strings')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs per case, median reported')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    run(**vars(opt))
@@ -0,0 +1,86 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Pipelined execution: stages in worker threads connected by bounded queues, results in submission order
+"""
+
+from queue import Queue
+from threading import Thread
+
+from utils.general import LOGGER
+
+_END = object()  # end of stream sentinel
+
+
+class _Failure:
+    # Exception raised by a stage, passed down the pipeline in place of its item and re-raised to the consumer
+    def __init__(self, e):
+        self.e = e
+
+
+class Worker:
+    # Daemon thread applying fn to queued items in FIFO order, i.e. w = Worker(fn); w.put(x); ...; w.close()
+    # put() blocks while maxsize items are pending. Results go to output(y), i.e. the next stage's put()
+    def __init__(self, fn, maxsize=2, output=None):
+        self.fn = fn
+        self.output = output
+        self.queue = Queue(maxsize)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, x):
+        self.queue.put(x)
+
+    def close(self):
+        # Finish pending items and stop the thread
+        self.queue.put(_END)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            x = self.queue.get()
+            if x is _END:
+                if self.output:
+                    self.output(_END)
+                return
+            if not isinstance(x, _Failure):
+                try:
+                    x = self.fn(x)
+                except Exception as e:
+                    x = _Failure(e)
+            if self.output:
+                self.output(x)
+            elif isinstance(x, _Failure):
+                LOGGER.warning(f'WARNING ⚠️ pipeline stage {self.fn.__name__} failed: {x.e}')
+
+
+class Pipeline:
+    # Ordered multi-stage pipeline, i.e. for y in Pipeline(frames, infer): postprocess(y)
+    # Source iteration and each stage run in their own thread, so throughput approaches the slowest stage
+    # rather than the sum of all of them. Items in flight between stages are bounded by maxsize per queue
+    def __init__(self, source, *stages, maxsize=2):
+        self.output = Queue(maxsize)
+        put = self.output.put
+        self.workers = []
+        for fn in reversed(stages):
+            self.workers.insert(0, Worker(fn, maxsize, output=put))
+            put = self.workers[0].put
+        self.feeder = Thread(target=self._feed, args=(source, put), daemon=True)
+        self.feeder.start()
+
+    @staticmethod
+    def _feed(source, put):
+        try:
+            for x in source:
+                put(x)
+        except Exception as e:
+            put(_Failure(e))
+        put(_END)
+
+    def __iter__(self):
+        while True:
+            y = self.output.get()
+            if y is _END:
+                return
+            if isinstance(y, _Failure):
+                raise y.e
+            yield y
@@ -7,6 +7,7 @@ import contextlib
 import math
 import os
 from copy import copy
+from functools import lru_cache
 from pathlib import Path
 from urllib.error import URLError
 
@@ -116,14 +117,16 @@ class Annotator:
                             thickness=tf,
                             lineType=cv2.LINE_AA)
 
-    def masks(self, masks, colors, im_gpu, alpha=0.5, retina_masks=False):
+    def masks(self, masks, colors, im_gpu=None, alpha=0.5, retina_masks=False):
         """Plot masks at once.
         Args:
             masks (tensor): predicted masks on cuda, shape: [n, h, w]
             colors (List[List[Int]]): colors for predicted masks, [[r, g, b] * n]
-            im_gpu (tensor): img is in cuda, shape: [3, h, w], range: [0, 1]
+            im_gpu (tensor): img is in cuda, shape: [3, h, w], range: [0, 1]. None or CPU tensor for uint8 blending
             alpha (float): mask transparency: 0.0 fully transparent, 1.0 opaque
         """
+        if im_gpu is None or im_gpu.device.type == 'cpu':
+            return self.masks_uint8(masks, colors, alpha)
         if self.pil:
             # convert to numpy first
             self.im = np.asarray(self.im).copy()
@@ -146,6 +149,48 @@ class Annotator:
             # convert im back to PIL and update draw
             self.fromarray(self.im)
 
+    def masks_uint8(self, masks, colors, alpha=0.5):
+        """Plot masks at once with uint8 color LUTs, blending in place into each mask's bbox region of self.im.
+        CPU equivalent of masks(), which composites in float on im_gpu and rescales the whole image to self.im.
+        Args:
+            masks (tensor | np.ndarray): predicted masks at model input or native resolution, shape: [n, h, w]
+            colors (List[List[Int]]): colors for predicted masks, [[b, g, r] * n]
+            alpha (float): mask transparency: 0.0 fully transparent, 1.0 opaque
+        """
+        if self.pil:
+            # convert to numpy first
+            self.im = np.asarray(self.im).copy()
+        if len(masks):
+            masks = masks.byte().cpu().numpy() if isinstance(masks, torch.Tensor) else masks.astype(np.uint8)
+            (mh, mw), (h, w) = masks.shape[1:], self.im.shape[:2]
+            gain = min(mh / h, mw / w)  # gain  = old / new, same letterbox geometry as scale_image()
+            pad = (mw - w * gain) / 2, (mh - h * gain) / 2  # wh padding
+            top, left = int(pad[1]), int(pad[0])  # y, x
+            sy, sx = h / (int(mh - pad[1]) - top), w / (int(mw - pad[0]) - left)  # mask to image scale
+            ch = np.arange(3)  # channel index for LUT lookups
+            for m, c in zip(masks[::-1], colors[::-1]):  # paint back to front so that masks[0] ends on top
+                x, y, bw, bh = cv2.boundingRect(m)  # mask bbox (mask pixels)
+                x1, y1 = min(math.ceil((x + bw - left) * sx), w), min(math.ceil((y + bh - top) * sy), h)
+                x0, y0 = max(int((x - left) * sx), 0), max(int((y - top) * sy), 0)
+                if x1 <= x0 or y1 <= y0:
+                    continue
+                rows = np.minimum(((np.arange(y0, y1) + 0.5) / sy + top).astype(int), mh - 1)  # nearest mask rows
+                cols = np.minimum(((np.arange(x0, x1) + 0.5) / sx + left).astype(int), mw - 1)  # nearest mask cols
+                sel = m[rows[:, None], cols[None]].astype(bool)  # mask resampled to image bbox region
+                region = self.im[y0:y1, x0:x1]  # view, written in place
+                region[sel] = self._mask_lut(tuple(int(x) for x in c), alpha)[region[sel], ch]
+        if self.pil:
+            # convert im back to PIL and update draw
+            self.fromarray(self.im)
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _mask_lut(color, alpha=0.5):
+        # Return uint8 (256,3) blend LUT for one mask color, matching masks() compositing for overlapping masks
+        v = np.arange(256, dtype=np.float32)[:, None]  # pixel values
+        return (v * (1 - alpha) + np.array(color, dtype=np.float32) * alpha * (1 - alpha) * 2).clip(0, 255).astype(
+            np.uint8)
+
     def rectangle(self, xy, fill=None, outline=None, width=1):
         # Add rectangle to image (PIL-only)
         self.draw.rectangle(xy, fill, outline, width)
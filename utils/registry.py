@@ -0,0 +1,193 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Model registry for multi-model serving: shared loaded models with LRU eviction under a memory budget
+
+Usage:
+    from utils.registry import ModelRegistry
+    registry = ModelRegistry(budget=2048, device='cpu')  # MB
+    registry.preload('yolov5s.pt', 'yolov5n.onnx')  # load in the background
+    with registry.get('yolov5s.pt') as model:  # AutoShape(DetectMultiBackend), exclusive and not evicted while in use
+        results = model(im)
+"""
+
+import contextlib
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import psutil
+import torch
+
+from utils.general import LOGGER, colorstr
+from utils.torch_utils import select_device
+
+PREFIX = colorstr('Registry: ')
+MB = 1 << 20  # bytes
+
+
+class _Entry:
+    # Loaded model with its estimated memory footprint and in-flight reference count
+    def __init__(self, model, size):
+        self.model = model
+        self.size = size  # bytes
+        self.refs = 0  # requests in flight
+        self.lock = threading.Lock()  # held by get(), models reuse per-instance input and output buffers
+
+
+def _file_size(path):
+    # Return size in bytes of a weights file or directory, i.e. OpenVINO or saved_model
+    p = Path(path)
+    if p.is_dir():
+        return sum(f.stat().st_size for f in p.rglob('*') if f.is_file())
+    return p.stat().st_size if p.is_file() else 0
+
+
+class ModelRegistry:
+    # YOLOv5 model registry keyed by (weights, backend, device, dtype, imgsz). Models are loaded once and shared by
+    # concurrent callers, one caller at a time per model. Least-recently-used models with no requests in flight
+    # (waiting or running) are evicted beyond budget MB
+    def __init__(self, budget=0, device='', half=False, imgsz=640, autoshape=True, workers=1):
+        self.budget = budget * MB  # bytes, 0 for unlimited
+        self.device = select_device(device) if isinstance(device, str) else device
+        self.half = half
+        self.imgsz = imgsz
+        self.autoshape = autoshape  # wrap models in AutoShape
+        self.entries = OrderedDict()  # {key: _Entry}, least recently used first
+        self.loading = {}  # {key: Future} of models being loaded
+        self.lock = threading.Lock()  # guards entries and loading
+        self.load_lock = threading.Lock()  # one load at a time, for clean memory accounting
+        self.executor = ThreadPoolExecutor(workers)  # background pre-loading
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def key(self, weights, half=None, imgsz=None):
+        # Return registry key of weights with this registry's device and optional dtype and imgsz overrides
+        from models.common import DetectMultiBackend  # scoped to avoid circular import
+        w = str(weights) if str(weights).startswith(('http:/', 'https:/', 'grpc:/')) else str(Path(weights).resolve())
+        half = self.half if half is None else half
+        return w, DetectMultiBackend.backend_name(w), str(self.device), 'fp16' if half else 'fp32', imgsz or self.imgsz
+
+    @contextlib.contextmanager
+    def get(self, weights, half=None, imgsz=None):
+        # Context manager yielding the loaded model, loading it on a miss. The model is not evicted until exit, and
+        # concurrent get() of one model wait for each other, as its staging and runtime buffers are per instance
+        key = self.key(weights, half, imgsz)
+        entry = self._acquire(key)
+        try:
+            with entry.lock:
+                yield entry.model
+        finally:
+            with self.lock:
+                entry.refs -= 1
+                evicted = self._evict()
+            del entry  # no reference left to an evicted model
+            if evicted:
+                self._collect()
+
+    def preload(self, *weights, half=None, imgsz=None):
+        # Load weights in the background, returning a list of Futures
+        return [self.executor.submit(self._load, self.key(w, half, imgsz)) for w in weights]
+
+    def _acquire(self, key):
+        # Return the _Entry of key with its reference count incremented, loading it on a miss
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.hits += 1
+                self.entries.move_to_end(key)  # most recently used
+                entry.refs += 1
+                return entry
+            self.misses += 1
+        return self._load(key, acquire=True)
+
+    def _load(self, key, acquire=False):
+        # Load model of key, or wait for a concurrent load of it. Returns its _Entry, referenced if acquire
+        with self.lock:
+            entry, future = self.entries.get(key), self.loading.get(key)
+            owner = entry is None and future is None
+            if owner:
+                future = self.loading[key] = Future()
+        if owner:
+            try:
+                entry = self._create(key)
+            except Exception as e:
+                with self.lock:
+                    self.loading.pop(key)
+                future.set_exception(e)
+                raise
+        elif entry is None:
+            entry = future.result()  # loaded by another thread
+        with self.lock:
+            entry = self.entries.get(key, entry)  # resident, or loaded but evicted while waiting
+            self.entries[key] = entry  # (re)insert as most recently used
+            self.entries.move_to_end(key)
+            entry.refs += 1  # not evicted below
+            if owner:
+                self.loading.pop(key)
+            evicted = self._evict()
+            if not acquire:
+                entry.refs -= 1
+        if owner:
+            future.set_result(entry)
+        if evicted:
+            self._collect()
+        return entry
+
+    def _create(self, key):
+        # Create model of key, returning an _Entry with the memory it added: process RSS plus CUDA allocations,
+        # at least its weights file size
+        from models.common import AutoShape, DetectMultiBackend  # scoped to avoid circular import
+        w, backend, _, dtype, imgsz = key
+        process, cuda = psutil.Process(os.getpid()), self.device.type == 'cuda'
+        with self.load_lock:
+            rss, mem = process.memory_info().rss, torch.cuda.memory_allocated(self.device) if cuda else 0
+            t = time.time()
+            model = DetectMultiBackend(w, device=self.device, fp16=dtype == 'fp16')
+            model.warmup(imgsz=(1, 3, imgsz, imgsz), force=True)  # a real forward, activations and arenas counted
+            model = AutoShape(model, verbose=False) if self.autoshape else model
+            size = process.memory_info().rss - rss + (torch.cuda.memory_allocated(self.device) - mem if cuda else 0)
+            size = max(size, _file_size(w))
+        LOGGER.info(f'{PREFIX}loaded {backend} {Path(w).name} ({size / MB:.1f} MB) in {time.time() - t:.2f}s')
+        return _Entry(model, size)
+
+    def _evict(self):
+        # Evict least recently used models with no requests in flight until within budget, returning True if any
+        # were. Call with self.lock held, then _collect() after releasing it
+        if not self.budget:
+            return False
+        total, evicted = sum(e.size for e in self.entries.values()), False
+        for key in [k for k, e in self.entries.items() if e.refs == 0]:  # least recently used first
+            if total <= self.budget:
+                break
+            entry = self.entries.pop(key)
+            total -= entry.size
+            self.evictions += 1
+            evicted = True
+            LOGGER.info(f'{PREFIX}evicted {Path(key[0]).name} ({entry.size / MB:.1f} MB)')
+        return evicted
+
+    def _collect(self):
+        # Free memory of evicted models, without self.lock held so that get() is not stalled
+        gc.collect()
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        # Return registry counters and resident models
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'resident_mb': round(sum(e.size for e in self.entries.values()) / MB, 1),
+                'budget_mb': round(self.budget / MB, 1),
+                'models': [{
+                    'weights': Path(k[0]).name,
+                    'backend': k[1],
+                    'dtype': k[3],
+                    'imgsz': k[4],
+                    'size_mb': round(e.size / MB, 1),
+                    'refs': e.refs} for k, e in self.entries.items()]}
@@ -0,0 +1,52 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Range-adaptive inference resolution: pick the inference size per trigger from a set of pre-warmed buckets
+"""
+
+from collections import deque
+
+import numpy as np
+
+from utils.general import LOGGER, check_img_size
+
+
+class ResolutionScheduler:
+    # LiDAR range-adaptive inference size, i.e. i = scheduler(distance); ...; scheduler.update(i, conf, ms)
+    # Close objects fill the frame and need fewer pixels, so shorter ranges map to smaller sizes. A marginal
+    # confidence on the previous trigger moves the next one up a bucket
+    def __init__(self, sizes=(192, 256, 320, 416), ranges=None, stride=32, max_range=1000, marginal=0.0):
+        self.sizes = sorted({check_img_size(x, s=stride) for x in sizes})  # square sizes, ascending
+        n = len(self.sizes)
+        self.ranges = sorted(ranges) if ranges else [max_range * (i + 1) / n for i in range(n - 1)]  # bucket bounds
+        assert len(self.ranges) == n - 1, f'{n} sizes need {n - 1} range thresholds, not {len(self.ranges)}'
+        self.marginal = marginal  # previous best confidence below this (and above 0) raises the size
+        self.conf = None  # previous best confidence
+        self.counts = [0] * n  # triggers per bucket
+        self.times = [deque(maxlen=1000) for _ in range(n)]  # recent latencies (ms) per bucket
+
+    def __call__(self, distance):
+        # Return the bucket index for a LiDAR distance (same units as ranges, i.e. mm)
+        i = int(np.searchsorted(self.ranges, distance, side='right'))
+        if self.conf is not None and 0 < self.conf < self.marginal:
+            i = min(i + 1, len(self.sizes) - 1)  # marginal previous detection, use more resolution
+        self.counts[i] += 1
+        return i
+
+    def imgsz(self, i):
+        # Return (h, w) inference size of bucket i
+        return self.sizes[i], self.sizes[i]
+
+    def update(self, i, conf, t):
+        # Record the best detection confidence (0 if none) and latency (ms) of a trigger run at bucket i
+        self.conf = conf
+        self.times[i].append(t)
+
+    def summary(self):
+        # Log chosen-size distribution and latency per bucket
+        total = max(sum(self.counts), 1)
+        s = ('%10s' * 5) % ('imgsz', 'triggers', 'share', 'p50(ms)', 'p95(ms)')
+        for size, n, t in zip(self.sizes, self.counts, self.times):
+            p50, p95 = np.percentile(t, (50, 95)) if t else (float('nan'),) * 2
+            s += f'\n{size:>10d}{n:>10d}{n / total:>10.1%}{p50:>10.1f}{p95:>10.1f}'
+        LOGGER.info(f'Resolution scheduler:\n{s}')
+        return s
@@ -9,7 +9,8 @@ import platform
 import subprocess
 import time
 import warnings
-from contextlib import contextmanager
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from copy import deepcopy
 from pathlib import Path
 
@@ -401,6 +402,41 @@ class EarlyStopping:
         return stop
 
 
+class StagingBuffers:
+    # YOLOv5 LRU pool of preallocated input tensors keyed by (shape, dtype, pinned), reused across frames
+    def __init__(self, device=torch.device('cpu'), maxsize=8, torch_1_9=check_version(torch.__version__, '1.9.0')):
+        self.device = device
+        self.maxsize = maxsize  # maximum number of retained buffers, least recently used evicted first
+        self.buffers = OrderedDict()
+        self.torch_1_9 = torch_1_9
+
+    def get(self, shape, dtype=torch.float, pinned=False):
+        # Return the buffer for shape and dtype, on self.device or in pinned host memory if pinned=True
+        k = tuple(shape), dtype, pinned
+        if k in self.buffers:
+            self.buffers.move_to_end(k)  # most recently used
+            return self.buffers[k]
+        with torch.inference_mode(False) if self.torch_1_9 else nullcontext():  # normal tensors, usable in any mode
+            b = torch.empty(k[0], dtype=dtype, device='cpu' if pinned else self.device, pin_memory=pinned)
+        self.buffers[k] = b
+        while len(self.buffers) > self.maxsize:
+            self.buffers.popitem(last=False)  # evict least recently used
+        return b
+
+    def stage(self, im, dtype=torch.float):
+        # Copy uint8 frame(s) into reused buffers, returning a BCHW tensor of dtype on self.device scaled to 0.0 - 1.0
+        im = torch.from_numpy(im) if not isinstance(im, torch.Tensor) else im
+        if im.ndim == 3:
+            im = im[None]  # expand for batch dim
+        if self.device.type == 'cuda' and im.device.type == 'cpu':  # pinned host to device uint8 copy
+            im = self.get(im.shape, im.dtype, pinned=True).copy_(im)
+            im = self.get(im.shape, im.dtype).copy_(im, non_blocking=True)
+        return self.get(im.shape, dtype).copy_(im).div_(255)  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
+
+    def clear(self):
+        self.buffers.clear()
+
+
 class ModelEMA:
     """ Updated Exponential Moving Average (EMA) from https://github.com/rwightman/pytorch-image-models
     Keeps a moving average of everything in the model state_dict (parameters and buffers)
@@ -0,0 +1,171 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Tracing: nested spans recorded into per-thread ring buffers, Chrome trace export and latency percentiles
+
+Usage:
+    from utils.tracing import TRACER
+    TRACER.enable()
+    with TRACER.span('nms'):
+        ...
+    TRACER.export('trace.json')  # open in chrome://tracing or https://ui.perfetto.dev
+    TRACER.summary()  # count, mean, p50, p95, p99 per span
+"""
+
+import contextlib
+import functools
+import json
+import os
+import signal
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+_NULL = contextlib.nullcontext()  # shared no-op span while tracing is disabled
+
+
+class _Ring:
+    # Fixed-size event buffer of one thread, only that thread appends to it
+    def __init__(self, size):
+        self.events = deque(maxlen=size)  # (name, start, duration, args), oldest dropped first, nesting by time
+        self.tid = threading.get_ident()
+        self.name = threading.current_thread().name
+
+
+class _Span:
+    # Context manager recording one span into the calling thread's ring on exit
+    __slots__ = 'ring', 'name', 'args', 'sync', 'start'
+
+    def __init__(self, ring, name, args, sync):
+        self.ring, self.name, self.args, self.sync = ring, name, args, sync
+
+    def __enter__(self):
+        if self.sync:
+            self.sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.sync:
+            self.sync()
+        self.ring.events.append((self.name, self.start, time.perf_counter() - self.start, self.args))
+
+
+class Tracer:
+    # YOLOv5 tracer, disabled by default. Spans cost one attribute check while disabled
+    def __init__(self, size=100000):
+        self.enabled = False
+        self.size = size  # events kept per thread
+        self.t0 = time.perf_counter()  # trace time origin
+        self.local = threading.local()
+        self.rings = []  # all threads' rings, for export
+        self.lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        return self
+
+    def clear(self):
+        # Drop recorded events, keeping the threads' rings
+        with self.lock:
+            for ring in self.rings:
+                ring.events.clear()
+        self.t0 = time.perf_counter()
+
+    def _ring(self):
+        ring = getattr(self.local, 'ring', None)
+        if ring is None:
+            ring = self.local.ring = _Ring(self.size)
+            with self.lock:
+                self.rings.append(ring)
+        return ring
+
+    def span(self, name, sync=False, **args):
+        # Span context manager, i.e. with TRACER.span('nms'): ... sync=True waits for CUDA around the span
+        if not self.enabled:
+            return _NULL
+        sync = torch.cuda.synchronize if sync and torch.cuda.is_available() else None
+        return _Span(self._ring(), name, args or None, sync)
+
+    def add(self, name, dt, **args):
+        # Record a span of dt seconds that ended now, i.e. from an existing Profile timer
+        if self.enabled:
+            self._ring().events.append((name, time.perf_counter() - dt, dt, args or None))
+
+    def wrap(self, name=None):
+        # Decorator tracing every call of a function, i.e. @TRACER.wrap('forward')
+        def decorator(fn):
+
+            @functools.wraps(fn)
+            def wrapper(*a, **kw):
+                if not self.enabled:
+                    return fn(*a, **kw)
+                with self.span(name or fn.__qualname__):
+                    return fn(*a, **kw)
+
+            return wrapper
+
+        return decorator
+
+    def iter(self, iterable, name):
+        # Iterate, recording the time spent waiting for each item, i.e. for x in TRACER.iter(lidar, 'lidar wait')
+        it = iter(iterable)
+        while True:
+            t = time.perf_counter()
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - t)
+            yield x
+
+    def install_signal(self, sig='SIGUSR1'):
+        # Toggle tracing at runtime with a signal, i.e. kill -USR1 <pid> (POSIX, main thread only)
+        if hasattr(signal, sig) and threading.current_thread() is threading.main_thread():
+            signal.signal(getattr(signal, sig), lambda *_: self.enable(not self.enabled))
+
+    def events(self):
+        # Return (ring, events) snapshots of all threads
+        with self.lock:
+            rings = list(self.rings)
+        return [(ring, ring.events.copy()) for ring in rings]  # deque.copy() is atomic under the GIL
+
+    def export(self, file='trace.json'):
+        # Save recorded spans as Chrome trace JSON, timestamps in microseconds
+        pid, trace = os.getpid(), []
+        for ring, events in self.events():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ring.tid, 'args': {'name': ring.name}})
+            for name, t, dt, args in events:
+                e = {'name': name, 'ph': 'X', 'pid': pid, 'tid': ring.tid, 'ts': (t - self.t0) * 1E6, 'dur': dt * 1E6}
+                if args:
+                    e['args'] = {k: str(v) for k, v in args.items()}
+                trace.append(e)
+        with open(file, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return file
+
+    def stats(self):
+        # Return {name: (count, total, mean, p50, p95, p99, max)} span durations in ms, over all threads
+        durations = {}
+        for _, events in self.events():
+            for name, _, dt, _ in events:
+                durations.setdefault(name, []).append(dt)
+        stats = {}
+        for name, x in durations.items():
+            x = np.array(x) * 1E3
+            stats[name] = (len(x), x.sum(), x.mean(), *np.percentile(x, (50, 95, 99)), x.max())
+        return stats
+
+    def summary(self):
+        # Log span latency table, slowest total first
+        from utils.general import LOGGER  # deferred, utils.general imports this module
+        s = ('%-24s' + '%10s' * 7) % ('Span', 'count', 'total(ms)', 'mean', 'p50', 'p95', 'p99', 'max')
+        for name, (n, *t) in sorted(self.stats().items(), key=lambda x: -x[1][1]):
+            s += f'\n{name[:24]:<24s}{n:>10d}' + ('%10.2f' * 6) % tuple(t)
+        LOGGER.info(f'Trace:\n{s}')
+        return s
+
+
+TRACER = Tracer()  # global tracer
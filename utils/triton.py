@@ -2,16 +2,37 @@
 """ Utils to interact with the Triton Inference Server
 """
 
+import atexit
+import os
 import typing
-from urllib.parse import urlparse
+from collections import deque
+from concurrent.futures import Future
+from urllib.parse import parse_qs, urlparse
 
+import numpy as np
 import torch
 
 
+class _Slot:
+    """ Cached request placeholders for one input shape, and the shared-memory regions backing them if enabled.
+    Up to `requests` slots per shape let requests in flight use separate regions.
+    """
+
+    def __init__(self, inputs, outputs, input_regions=None, output_regions=None):
+        self.inputs = inputs  # InferInput per model input
+        self.outputs = outputs  # InferRequestedOutput per model output
+        self.input_regions = input_regions  # shared-memory handle per input, or None
+        self.output_regions = output_regions  # (handle, dtype, shape) per output, or None
+
+
 class TritonRemoteModel:
     """ A wrapper over a model served by the Triton Inference Server. It can
     be configured to communicate over GRPC or HTTP. It accepts Torch Tensors
     as input and returns them as outputs.
+
+    High-throughput options are given as URL query parameters, i.e. http://localhost:8000?shm=1&requests=4
+        shm=1: pass tensors through system shared-memory regions registered once per input shape (same host only)
+        requests=n: requests kept in flight by imap()
     """
 
     def __init__(self, url: str):
@@ -21,31 +42,33 @@ class TritonRemoteModel:
         """
 
         parsed_url = urlparse(url)
+        query = parse_qs(parsed_url.query)
+        self.shm = query.get('shm', ['0'])[0].lower() not in ('0', 'false')  # system shared memory
+        self.requests = max(int(query.get('requests', ['1'])[0]), 1)  # requests in flight
+        self.url = parsed_url
         if parsed_url.scheme == 'grpc':
-            from tritonclient.grpc import InferenceServerClient, InferInput
+            from tritonclient.grpc import InferenceServerClient, InferInput, InferRequestedOutput
 
             self.client = InferenceServerClient(parsed_url.netloc)  # Triton GRPC client
             model_repository = self.client.get_model_repository_index()
             self.model_name = model_repository.models[0].name
             self.metadata = self.client.get_model_metadata(self.model_name, as_json=True)
 
-            def create_input_placeholders() -> typing.List[InferInput]:
-                return [
-                    InferInput(i['name'], [int(s) for s in i['shape']], i['datatype']) for i in self.metadata['inputs']]
-
         else:
-            from tritonclient.http import InferenceServerClient, InferInput
+            from tritonclient.http import InferenceServerClient, InferInput, InferRequestedOutput
 
-            self.client = InferenceServerClient(parsed_url.netloc)  # Triton HTTP client
+            self.client = InferenceServerClient(parsed_url.netloc, concurrency=self.requests)  # Triton HTTP client
             model_repository = self.client.get_model_repository_index()
             self.model_name = model_repository[0]['name']
             self.metadata = self.client.get_model_metadata(self.model_name)
 
-            def create_input_placeholders() -> typing.List[InferInput]:
-                return [
-                    InferInput(i['name'], [int(s) for s in i['shape']], i['datatype']) for i in self.metadata['inputs']]
-
-        self._create_input_placeholders_fn = create_input_placeholders
+        self._infer_input, self._infer_requested_output = InferInput, InferRequestedOutput
+        self._slots = {}  # {(slot, input shapes): _Slot}, placeholders built once per shape
+        self._output_shapes = {}  # {input shapes: [(dtype, shape)]}, for shared-memory output regions
+        self._regions = []  # registered shared-memory (name, handle)
+        self._aio_client = None  # created by infer_async() on the running event loop
+        if self.shm:
+            atexit.register(self.close)
 
     @property
     def runtime(self):
@@ -56,30 +79,145 @@ class TritonRemoteModel:
         """ Invokes the model. Parameters can be provided via args or kwargs.
         args, if provided, are assumed to match the order of inputs of the model.
         kwargs are matched with the model input names.
+        With shm=1 outputs are views of shared memory, valid until the next call with the same input shape.
         """
-        inputs = self._create_inputs(*args, **kwargs)
-        response = self.client.infer(model_name=self.model_name, inputs=inputs)
-        result = []
-        for output in self.metadata['outputs']:
-            tensor = torch.as_tensor(response.as_numpy(output['name']))
-            result.append(tensor)
+        slot = self._prepare(self._create_values(*args, **kwargs))
+        response = self.client.infer(model_name=self.model_name, inputs=slot.inputs, outputs=slot.outputs)
+        return self._collect(response, slot)
+
+    def imap(self, items):
+        """ Yields (outputs, userdata) in submission order for an iterable of (input, userdata), keeping up to
+        `requests` requests in flight with async_infer. With shm=1 outputs are only valid until the next item.
+        """
+        pending = deque()  # (wait, slot, userdata) in submission order
+        for i, (x, userdata) in enumerate(items):
+            slot = self._prepare(self._create_values(x), i % self.requests)
+            pending.append((self._start(slot), slot, userdata))
+            if len(pending) >= self.requests:  # the oldest slot is reused by the next item
+                wait, slot, userdata = pending.popleft()
+                yield self._collect(wait(), slot), userdata
+        while pending:
+            wait, slot, userdata = pending.popleft()
+            yield self._collect(wait(), slot), userdata
+
+    async def infer_async(self, *args, **kwargs):
+        """ Invokes the model with an asyncio (tritonclient aio) client, i.e. y = await model.infer_async(im).
+        Placeholders are cached as in __call__, tensors are sent in the request body rather than shared memory.
+        """
+        if self._aio_client is None:
+            if self.url.scheme == 'grpc':
+                from tritonclient.grpc.aio import InferenceServerClient
+            else:
+                from tritonclient.http.aio import InferenceServerClient
+            self._aio_client = InferenceServerClient(self.url.netloc)
+        values = self._create_values(*args, **kwargs)
+        key = ('aio', tuple(x.shape for x in values))
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = self._create_slot(values, shm=False)
+        for input, x in zip(slot.inputs, values):  # serialized when infer() starts, before other coroutines run
+            input.set_data_from_numpy(x)
+        response = await self._aio_client.infer(model_name=self.model_name, inputs=slot.inputs, outputs=slot.outputs)
+        return self._collect(response, slot)
+
+    def close(self):
+        """ Unregisters and destroys shared-memory regions """
+        if self._regions:
+            from tritonclient.utils import shared_memory as shm
+            for name, handle in self._regions:
+                try:
+                    self.client.unregister_system_shared_memory(name)
+                except Exception:
+                    pass  # server gone
+                shm.destroy_shared_memory_region(handle)
+            self._regions, self._slots = [], {}
+
+    def _start(self, slot):
+        # Start an async request, returning a function that waits for its response
+        if self.url.scheme == 'grpc':
+            future = Future()
+
+            def callback(result, error):
+                future.set_exception(error) if error else future.set_result(result)
+
+            self.client.async_infer(self.model_name, slot.inputs, callback, outputs=slot.outputs)
+            return future.result
+        return self.client.async_infer(self.model_name, slot.inputs, outputs=slot.outputs).get_result
+
+    def _prepare(self, values, i=0):
+        # Return the cached slot i of these input shapes with values written to its inputs
+        key = (i, tuple(x.shape for x in values))
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = self._create_slot(values, self.shm)
+        if slot.input_regions:
+            from tritonclient.utils import shared_memory as shm
+            for handle, x in zip(slot.input_regions, values):
+                shm.set_shared_memory_region(handle, [x])  # one copy into the registered region
+        else:
+            for input, x in zip(slot.inputs, values):
+                input.set_data_from_numpy(x)
+        return slot
+
+    def _create_slot(self, values, shm=False):
+        # Build InferInput/InferRequestedOutput placeholders, registering shared-memory regions if shm
+        inputs = [
+            self._infer_input(i['name'], list(x.shape), i['datatype']) for i, x in zip(self.metadata['inputs'], values)]
+        outputs = [self._infer_requested_output(o['name']) for o in self.metadata['outputs']]
+        if not shm:
+            return _Slot(inputs, outputs)
+
+        shapes = tuple(x.shape for x in values)
+        if shapes not in self._output_shapes:  # one regular request to learn output sizes of this input shape
+            for input, x in zip(inputs, values):
+                input.set_data_from_numpy(x)
+            response = self.client.infer(model_name=self.model_name, inputs=inputs, outputs=outputs)
+            y = [response.as_numpy(o['name']) for o in self.metadata['outputs']]
+            self._output_shapes[shapes] = [(x.dtype, x.shape) for x in y]
+        input_regions = [self._create_region(x.nbytes) for x in values]
+        output_regions = [(self._create_region(int(np.prod(s)) * np.dtype(d).itemsize), d, s)
+                          for d, s in self._output_shapes[shapes]]
+        for input, x, (name, _) in zip(inputs, values, input_regions):
+            input.set_shared_memory(name, x.nbytes)
+        for output, ((name, _), d, s) in zip(outputs, output_regions):
+            output.set_shared_memory(name, int(np.prod(s)) * np.dtype(d).itemsize)
+        return _Slot(inputs, outputs, [h for _, h in input_regions], [(h, d, s) for (_, h), d, s in output_regions])
+
+    def _create_region(self, nbytes):
+        # Create and register a system shared-memory region, returning (name, handle)
+        from tritonclient.utils import shared_memory as shm
+        name = f'yolov5_{os.getpid()}_{id(self)}_{len(self._regions)}'
+        handle = shm.create_shared_memory_region(name, f'/{name}', nbytes)
+        self.client.register_system_shared_memory(name, f'/{name}', nbytes)
+        self._regions.append((name, handle))
+        return name, handle
+
+    def _collect(self, response, slot):
+        # Return output tensors of a response, views of the slot's shared-memory regions if registered
+        if slot.output_regions:
+            from tritonclient.utils import shared_memory as shm
+            result = [torch.from_numpy(shm.get_contents_as_numpy(h, d, s)) for h, d, s in slot.output_regions]
+        else:
+            result = [torch.as_tensor(response.as_numpy(o['name'])) for o in self.metadata['outputs']]
         return result[0] if len(result) == 1 else result
 
-    def _create_inputs(self, *args, **kwargs):
+    def _create_values(self, *args, **kwargs):
+        # Return input numpy arrays in model input order, in the model input datatypes
+        from tritonclient.utils import triton_to_np_dtype
+
         args_len, kwargs_len = len(args), len(kwargs)
         if not args_len and not kwargs_len:
             raise RuntimeError('No inputs provided.')
         if args_len and kwargs_len:
             raise RuntimeError('Cannot specify args and kwargs at the same time')
 
-        placeholders = self._create_input_placeholders_fn()
+        inputs = self.metadata['inputs']
         if args_len:
-            if args_len != len(placeholders):
-                raise RuntimeError(f'Expected {len(placeholders)} inputs, got {args_len}.')
-            for input, value in zip(placeholders, args):
-                input.set_data_from_numpy(value.cpu().numpy())
+            if args_len != len(inputs):
+                raise RuntimeError(f'Expected {len(inputs)} inputs, got {args_len}.')
+            values = args
         else:
-            for input in placeholders:
-                value = kwargs[input.name]
-                input.set_data_from_numpy(value.cpu().numpy())
-        return placeholders
+            values = [kwargs[i['name']] for i in inputs]
+        return [
+            np.ascontiguousarray(x.cpu().numpy() if isinstance(x, torch.Tensor) else x,
+                                 dtype=triton_to_np_dtype(i['datatype'])) for i, x in zip(inputs, values)]
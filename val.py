@@ -4,6 +4,7 @@ Validate a trained YOLOv5 detection model on a detection dataset
 
 Usage:
     $ python val.py --weights yolov5s.pt --data coco128.yaml --img 640
+    $ python val.py --task compare --weights yolov5s.onnx yolov5s-int8.onnx  # accuracy vs latency
 
 Usage - formats:
     $ python val.py --weights yolov5s.pt                 # PyTorch
@@ -40,11 +41,13 @@ from models.common import DetectMultiBackend
 from utils.callbacks import Callbacks
 from utils.dataloaders import create_dataloader
 from utils.general import (LOGGER, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size, check_requirements,
-                           check_yaml, coco80_to_coco91_class, colorstr, increment_path, non_max_suppression,
-                           print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
+                           check_yaml, coco80_to_coco91_class, colorstr, file_size, increment_path, non_max_suppression,
+                           print_args, scale_boxes, split_end2end, xywh2xyxy, xyxy2xywh)
 from utils.metrics import ConfusionMatrix, ap_per_class, box_iou
 from utils.plots import output_to_target, plot_images, plot_val_study
+from utils.preprocess import LetterboxPreprocessor
 from utils.torch_utils import select_device, smart_inference_mode
+from utils.tracing import TRACER
 
 
 def save_one_txt(predn, save_conf, shape, file):
@@ -109,6 +112,8 @@ def run(
         workers=8,  # max dataloader workers (per RANK in DDP mode)
         single_cls=False,  # treat as single-class dataset
         augment=False,  # augmented inference
+        tta='loop',  # augmented inference: 'loop' one forward per scale/flip, 'batched' one forward for all
+        merge=False,  # merge-NMS, fuse overlapping boxes by score-weighted mean, i.e. of --augment outputs
         verbose=False,  # verbose output
         save_txt=False,  # save results to *.txt
         save_hybrid=False,  # save label+prediction hybrid results to *.txt
@@ -119,6 +124,9 @@ def run(
         exist_ok=False,  # existing project/name ok, do not increment
         half=True,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        ov_requests=0,  # OpenVINO async infer requests in flight, -1 for device optimal, 0 for synchronous
+        optimize=False,  # PyTorch: channels_last and torch.compile
+        trace=False,  # record spans, save Chrome trace JSON and log span latency percentiles
         model=None,
         dataloader=None,
         save_dir=Path(''),
@@ -140,8 +148,11 @@ def run(
         (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
         # Load model
-        model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+        model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half, ov_requests=ov_requests,
+                                   optimize=optimize)
         stride, pt, jit, engine = model.stride, model.pt, model.jit, model.engine
+        if pt:
+            model.model.tta = tta
         imgsz = check_img_size(imgsz, s=stride)  # check image size
         half = model.fp16  # FP16 supported on limited backends with CUDA
         if engine:
@@ -190,24 +201,35 @@ def run(
     class_map = coco80_to_coco91_class() if is_coco else list(range(1000))
     s = ('%22s' + '%11s' * 6) % ('Class', 'Images', 'Instances', 'P', 'R', 'mAP50', 'mAP50-95')
     tp, fp, p, r, f1, mp, mr, map50, ap50, map = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
-    dt = Profile(), Profile(), Profile()  # profiling times
+    dt = Profile(name='preprocess'), Profile(name='inference'), Profile(name='nms')  # profiling times
+    preprocess = LetterboxPreprocessor(device=device, half=half)  # fused H2D copy, dtype and 0-1 normalization
     loss = torch.zeros(3, device=device)
     jdict, stats, ap, ap_class = [], [], [], []
     callbacks.run('on_val_start')
+    if trace:
+        TRACER.enable()
     pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT)  # progress bar
-    for batch_i, (im, targets, paths, shapes) in enumerate(pbar):
-        callbacks.run('on_val_batch_start')
-        with dt[0]:
-            if cuda:
-                im = im.to(device, non_blocking=True)
-                targets = targets.to(device)
-            im = im.half() if half else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
-            nb, _, height, width = im.shape  # batch size, channels, height, width
+
+    def batches():
+        for im, targets, paths, shapes in pbar:
+            callbacks.run('on_val_batch_start')
+            with dt[0]:
+                if cuda:
+                    targets = targets.to(device)
+                im = preprocess.normalize(im)  # uint8 to fp16/32, 0 - 255 to 0.0 - 1.0
+            yield im, (im, targets, paths, shapes)
+
+    # OpenVINO and Triton async models keep the next batches in flight while NMS and metrics run
+    ov_async = not training and model.pipelined
+    end2end = not training and model.end2end  # export.py --end2end model
+    results = model.imap(batches()) if ov_async else ((None, x) for x in batches())
+    for batch_i, (preds, (im, targets, paths, shapes)) in enumerate(results):
+        nb, _, height, width = im.shape  # batch size, channels, height, width
 
         # Inference
         with dt[1]:
-            preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
+            if preds is None:  # synchronous
+                preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
 
         # Loss
         if compute_loss:
@@ -217,51 +239,56 @@ def run(
         targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
         lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
         with dt[2]:
-            preds = non_max_suppression(preds,
-                                        conf_thres,
-                                        iou_thres,
-                                        labels=lb,
-                                        multi_label=True,
-                                        agnostic=single_cls,
-                                        max_det=max_det)
+            if end2end:  # NMS in model, with the thresholds it was exported with
+                preds = split_end2end(preds, nb, conf_thres)
+            else:
+                preds = non_max_suppression(preds,
+                                            conf_thres,
+                                            iou_thres,
+                                            labels=lb,
+                                            multi_label=True,
+                                            agnostic=single_cls,
+                                            max_det=max_det,
+                                            merge=merge)
 
         # Metrics
-        for si, pred in enumerate(preds):
-            labels = targets[targets[:, 0] == si, 1:]
-            nl, npr = labels.shape[0], pred.shape[0]  # number of labels, predictions
-            path, shape = Path(paths[si]), shapes[si][0]
-            correct = torch.zeros(npr, niou, dtype=torch.bool, device=device)  # init
-            seen += 1
-
-            if npr == 0:
+        with TRACER.span('metrics'):
+            for si, pred in enumerate(preds):
+                labels = targets[targets[:, 0] == si, 1:]
+                nl, npr = labels.shape[0], pred.shape[0]  # number of labels, predictions
+                path, shape = Path(paths[si]), shapes[si][0]
+                correct = torch.zeros(npr, niou, dtype=torch.bool, device=device)  # init
+                seen += 1
+
+                if npr == 0:
+                    if nl:
+                        stats.append((correct, *torch.zeros((2, 0), device=device), labels[:, 0]))
+                        if plots:
+                            confusion_matrix.process_batch(detections=None, labels=labels[:, 0])
+                    continue
+
+                # Predictions
+                if single_cls:
+                    pred[:, 5] = 0
+                predn = pred.clone()
+                scale_boxes(im[si].shape[1:], predn[:, :4], shape, shapes[si][1])  # native-space pred
+
+                # Evaluate
                 if nl:
-                    stats.append((correct, *torch.zeros((2, 0), device=device), labels[:, 0]))
+                    tbox = xywh2xyxy(labels[:, 1:5])  # target boxes
+                    scale_boxes(im[si].shape[1:], tbox, shape, shapes[si][1])  # native-space labels
+                    labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
+                    correct = process_batch(predn, labelsn, iouv)
                     if plots:
-                        confusion_matrix.process_batch(detections=None, labels=labels[:, 0])
-                continue
-
-            # Predictions
-            if single_cls:
-                pred[:, 5] = 0
-            predn = pred.clone()
-            scale_boxes(im[si].shape[1:], predn[:, :4], shape, shapes[si][1])  # native-space pred
-
-            # Evaluate
-            if nl:
-                tbox = xywh2xyxy(labels[:, 1:5])  # target boxes
-                scale_boxes(im[si].shape[1:], tbox, shape, shapes[si][1])  # native-space labels
-                labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
-                correct = process_batch(predn, labelsn, iouv)
-                if plots:
-                    confusion_matrix.process_batch(predn, labelsn)
-            stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))  # (correct, conf, pcls, tcls)
-
-            # Save/log
-            if save_txt:
-                save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / f'{path.stem}.txt')
-            if save_json:
-                save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
-            callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
+                        confusion_matrix.process_batch(predn, labelsn)
+                stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))  # (correct, conf, pcls, tcls)
+
+                # Save/log
+                if save_txt:
+                    save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / f'{path.stem}.txt')
+                if save_json:
+                    save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
+                callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
 
         # Plot images
         if plots and batch_i < 3:
@@ -331,6 +358,10 @@ def run(
     if not training:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
+    if trace:
+        TRACER.summary()
+        LOGGER.info(f"Trace saved to {colorstr('bold', TRACER.export(save_dir / 'trace.json'))}")
+        TRACER.enable(False).clear()  # stop recording, i.e. when train.py calls val.run() every epoch
     maps = np.zeros(nc) + map
     for i, c in enumerate(ap_class):
         maps[c] = ap[i]
@@ -346,11 +377,13 @@ def parse_opt():
     parser.add_argument('--conf-thres', type=float, default=0.001, help='confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.6, help='NMS IoU threshold')
     parser.add_argument('--max-det', type=int, default=300, help='maximum detections per image')
-    parser.add_argument('--task', default='val', help='train, val, test, speed or study')
+    parser.add_argument('--task', default='val', help='train, val, test, speed, study or compare')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--workers', type=int, default=8, help='max dataloader workers (per RANK in DDP mode)')
     parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta', default='loop', choices=['loop', 'batched'], help='augmented inference mode')
+    parser.add_argument('--merge', action='store_true', help='merge-NMS, fuse overlapping boxes, i.e. for --augment')
     parser.add_argument('--verbose', action='store_true', help='report mAP by class')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-hybrid', action='store_true', help='save label+prediction hybrid results to *.txt')
@@ -361,6 +394,9 @@ def parse_opt():
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--ov-requests', type=int, default=0, help='OpenVINO async infer requests, -1 for optimal')
+    parser.add_argument('--optimize', action='store_true', help='PyTorch: channels_last and torch.compile')
+    parser.add_argument('--trace', action='store_true', help='save Chrome trace JSON and log span percentiles')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     opt.save_json |= opt.data.endswith('coco.yaml')
@@ -400,8 +436,20 @@ def main(opt):
                 np.savetxt(f, y, fmt='%10.4g')  # save
             subprocess.run(['zip', '-r', 'study.zip', 'study_*.txt'])
             plot_val_study(x=x)  # plot
+
+        elif opt.task == 'compare':  # accuracy vs latency, i.e. FP32 vs INT8
+            # python val.py --task compare --data coco.yaml --batch 1 --weights yolov5s.onnx yolov5s-int8.onnx...
+            y = []
+            for opt.weights in weights:
+                r, _, t = run(**vars(opt), plots=False)
+                y.append((Path(opt.weights).name, file_size(opt.weights), r[2], r[3], t[1]))  # mAP50, mAP, inference
+            s = ('\n%24s' + '%11s' * 6) % ('Model', 'Size(MB)', 'mAP50', 'mAP50-95', 'ms/img', 'speedup', 'dmAP')
+            for name, mb, map50, map, ms in y:
+                s += f'\n{name:>24s}{mb:11.1f}{map50:11.3f}{map:11.3f}{ms:11.1f}{y[0][4] / ms:10.2f}x'
+                s += f'{map - y[0][3]:+11.3f}'
+            LOGGER.info(f'{s}\nSpeedup and dmAP relative to {y[0][0]}')
         else:
-            raise NotImplementedError(f'--task {opt.task} not in ("train", "val", "test", "speed", "study")')
+            raise NotImplementedError(f'--task {opt.task} not in ("train", "val", "test", "speed", "study", "compare")')
 
 
 if __name__ == '__main__':